@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014 Geoscience Australia
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A cache of compiled input files.
+
+Files derived from the inputs (e.g. vulnerability curves as arrays,
+or exposure columns as memory mappable arrays) are stored in a cache
+directory. The cache names include a hash of the input file content,
+so a changed input is never read from the cache.
+
+The cache directory is ~/.cache/hazimp, or the HAZIMP_CACHE_DIR
+environment variable if it is set.
+"""
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+
+import numpy
+import pandas as pd
+
+from hazimp.misc import RESOURCE_DIR, INTID, csv2dict
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = 'HAZIMP_CACHE_DIR'
+
+# The prefix of the cached exposure files and directories
+EXPOSURE_PREFIX = 'exposure'
+
+# Change this when the layout of the cached exposure changes
+EXPOSURE_VERSION = 1
+
+# The file describing the columns of a cached exposure
+MANIFEST = 'manifest.json'
+
+
+def cache_dir():
+    """
+    :returns: The directory the cached files are stored in.
+    """
+    directory = os.environ.get(CACHE_DIR_ENV)
+    if not directory:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'hazimp')
+    return directory
+
+
+def file_hash(filename, block_size=2 ** 20):
+    """
+    Calculate the hash of a file's content.
+
+    :param filename: The file to hash.
+    :param block_size: The number of bytes read at a time.
+    :returns: The sha1 hex digest of the file.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file_handle:
+        for block in iter(lambda: file_handle.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_path(name):
+    """
+    :param name: The file name of the cached file.
+    :returns: The full path of the cached file.
+    """
+    return os.path.join(cache_dir(), name)
+
+
+def write_cache_file(name, write_funct):
+    """
+    Write a file to the cache. The file is written to a temporary file
+    first and then moved, so a partly written cache file is never read.
+
+    :param name: The file name of the cached file.
+    :param write_funct: A function that writes to the open file handle
+        it is passed.
+    :returns: The full path of the cached file.
+    """
+    directory = cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file_handle:
+            write_funct(file_handle)
+        os.replace(tmp_name, cache_path(name))
+    except BaseException:
+        os.remove(tmp_name)
+        raise
+    return cache_path(name)
+
+
+def write_cache_dir(name, write_funct):
+    """
+    Write a directory to the cache. The directory is written to a
+    temporary directory first and then moved, so a partly written cache
+    directory is never read.
+
+    :param name: The name of the cached directory.
+    :param write_funct: A function that writes files to the directory
+        it is passed.
+    :returns: The full path of the cached directory.
+    """
+    directory = cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    tmp_name = tempfile.mkdtemp(dir=directory, suffix='.tmp')
+    try:
+        write_funct(tmp_name)
+        os.rename(tmp_name, cache_path(name))
+    except OSError:
+        shutil.rmtree(tmp_name, ignore_errors=True)
+        # Another process wrote the same directory first
+        if not os.path.isdir(cache_path(name)):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_name, ignore_errors=True)
+        raise
+    return cache_path(name)
+
+
+def clear_cache(prefix=None):
+    """
+    Remove files from the cache.
+
+    :param prefix: Only remove the cached files and directories with
+        names that start with this. e.g. EXPOSURE_PREFIX. Everything is
+        removed if this is None.
+    :returns: The list of names removed.
+    """
+    directory = cache_dir()
+    if not os.path.isdir(directory):
+        return []
+    removed = []
+    for name in sorted(os.listdir(directory)):
+        if prefix is not None and not name.startswith(prefix):
+            continue
+        path = cache_path(name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        removed.append(name)
+    return removed
+
+
+def source_hash(filename):
+    """
+    Get the hash of a file's content, without reading the file again if
+    its size and modification time are the same as when it was hashed.
+
+    The size, modification time and hash are stored in the cache, in an
+    index file for the file path.
+
+    :param filename: The file to hash.
+    :returns: The sha1 hex digest of the file.
+    """
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    name = '%s-index-%s.json' % (
+        EXPOSURE_PREFIX, hashlib.sha1(path.encode('utf-8')).hexdigest())
+    try:
+        with open(cache_path(name)) as file_handle:
+            index = json.load(file_handle)
+        if (index['size'] == stat.st_size and
+                index['mtime'] == stat.st_mtime_ns):
+            return index['hash']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = {'path': path, 'size': stat.st_size,
+             'mtime': stat.st_mtime_ns, 'hash': file_hash(filename)}
+    try:
+        write_cache_file(name, lambda file_handle: file_handle.write(
+            json.dumps(index).encode('utf-8')))
+    except OSError as err:
+        LOGGER.warning('Could not cache the hash of %s: %s', filename, err)
+    return index['hash']
+
+
+def exposure_cache_name(filename, dtype=None, categorical='auto'):
+    """
+    :param filename: The exposure file.
+    :param dtype: The dtype of columns, as passed to misc.csv2dict.
+    :param categorical: The categorical columns, as passed to
+        misc.csv2dict.
+    :returns: The name of the cached exposure directory. This is based
+        on the file content and the options used to read it.
+    """
+    if dtype is not None:
+        dtype = dict((key, str(value)) for key, value in dtype.items())
+    options = json.dumps({'dtype': dtype, 'categorical': categorical},
+                         sort_keys=True)
+    return '%s-%s-%s-v%i' % (EXPOSURE_PREFIX, source_hash(filename),
+                             hashlib.sha1(options.encode('utf-8')).hexdigest(),
+                             EXPOSURE_VERSION)
+
+
+def save_exposure(dframe, directory):
+    """
+    Save the columns of an exposure dataframe as npy files, which can
+    be memory mapped. Categorical and string columns are saved as
+    integer codes, and their values are saved in the manifest.
+
+    :param dframe: A dataframe, as returned by misc.csv2dict.
+    :param directory: The directory to save the files in.
+    :raises ValueError: If a column can't be saved.
+    """
+    columns = []
+    for i, key in enumerate(dframe.columns):
+        values = dframe[key].values
+        column = {'name': key, 'file': '%i.npy' % i}
+        if isinstance(values, pd.Categorical):
+            column['kind'] = 'category'
+            categories = values.categories.tolist()
+            values = values.codes
+        elif values.dtype == object:
+            column['kind'] = 'object'
+            values, categories = pd.factorize(values)
+            categories = categories.tolist()
+        elif values.dtype.kind in 'biuf':
+            column['kind'] = 'array'
+            categories = []
+        else:
+            raise ValueError("Column '%s' has dtype %s" % (key, values.dtype))
+        if not all(isinstance(value, str) for value in categories):
+            raise ValueError("Column '%s' has values that are not strings"
+                             % key)
+        if column['kind'] != 'array':
+            column['values'] = categories
+        numpy.save(os.path.join(directory, column['file']), values)
+        columns.append(column)
+    with open(os.path.join(directory, MANIFEST), 'w') as file_handle:
+        json.dump({'columns': columns}, file_handle)
+
+
+def load_exposure(directory, usecols=None):
+    """
+    Load an exposure dataframe saved by save_exposure. The numeric
+    columns and the codes of categorical columns are memory mapped, so
+    the file content is only read when it is used.
+
+    The arrays are mapped copy on write, so changing them does not
+    change the cache.
+
+    :param directory: The directory of the cached exposure.
+    :param usecols: Optional. A list of the columns to load. Columns
+        that are not in the cache are ignored. All columns are loaded
+        if this is None.
+    :returns: A dataframe.
+    """
+    with open(os.path.join(directory, MANIFEST)) as file_handle:
+        manifest = json.load(file_handle)
+    data = {}
+    for column in manifest['columns']:
+        if usecols is not None and column['name'] not in usecols:
+            continue
+        values = numpy.load(os.path.join(directory, column['file']),
+                            mmap_mode='c')
+        if column['kind'] == 'category':
+            values = pd.Categorical.from_codes(values, column['values'])
+        elif column['kind'] == 'object':
+            # Missing values have the code -1
+            strings = numpy.array(column['values'] + [numpy.nan],
+                                  dtype=object)
+            values = strings[values]
+        data[column['name']] = values
+    # copy=False keeps the memory mapped arrays
+    return pd.DataFrame(data, copy=False)
+
+
+def cached_csv2dict(filename, add_ids=False, dtype=None, categorical=None,
+                    usecols=None):
+    """
+    Read an exposure file like misc.csv2dict, using a binary copy of
+    the file in the hazimp cache. The first read of a file parses it
+    and saves all of its columns in the cache. Later reads memory map
+    the cached columns, rather than parsing the file again.
+
+    :param filename: The csv, parquet or feather file path string.
+    :param add_ids: If True add a key, value of ids, from 0 to n
+    :param dtype: Optional. A dictionary of the dtype of columns.
+    :param categorical: The string columns stored as categoricals.
+    :param usecols: Optional. A list of the columns to read. Columns
+        that are not in the file are ignored. All columns are read if
+        this is None.
+    :returns: A dataframe of the columns.
+    """
+    name = exposure_cache_name(filename, dtype=dtype,
+                               categorical=categorical)
+    path = cache_path(name)
+    if usecols is not None:
+        usecols = set(usecols) | set([INTID])
+    if os.path.isdir(path):
+        try:
+            dframe = load_exposure(path, usecols=usecols)
+            LOGGER.info('Loaded %s from the cache', filename)
+            if not add_ids:
+                del dframe[INTID]
+            return dframe
+        except (OSError, ValueError, KeyError) as err:
+            LOGGER.warning('Could not read cached %s: %s', path, err)
+
+    dframe = csv2dict(filename, add_ids=True, dtype=dtype,
+                      categorical=categorical)
+    try:
+        write_cache_dir(name,
+                        lambda directory: save_exposure(dframe, directory))
+        LOGGER.info('Cached %s', filename)
+    except (OSError, ValueError) as err:
+        # The cache is only an optimisation
+        LOGGER.warning('Could not cache %s: %s', filename, err)
+    if usecols is not None:
+        dframe = dframe[[key for key in dframe.columns if key in usecols]]
+    if not add_ids:
+        del dframe[INTID]
+    return dframe
+
+
+def compile_vulnerability(paths):
+    """
+    Compile vulnerability xml files into the cache.
+
+    :param paths: A list of xml files or directories of xml files.
+    :returns: The list of xml files compiled.
+    """
+    # Imported here since the vulnerability model uses this module
+    from hazimp.jobs.vulnerability_model import compile_vuln_file
+
+    compiled = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames = sorted(glob.glob(os.path.join(path, '*.xml')))
+        else:
+            filenames = [path]
+        for filename in filenames:
+            if compile_vuln_file(filename) is not None:
+                compiled.append(filename)
+    return compiled
+
+
+def cli():
+    "Command-line interface to the hazimp cache"
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog='hazimp-cache')
+    subparsers = parser.add_subparsers(dest='command')
+    compile_parser = subparsers.add_parser(
+        'compile',
+        help="""Compile vulnerability xml files into the cache.
+        The packaged resources are compiled if no path is given.""")
+    compile_parser.add_argument('paths', nargs='*', default=[RESOURCE_DIR],
+                                help="xml files or directories")
+    warm_parser = subparsers.add_parser(
+        'warm',
+        help="""Cache exposure files, so they are loaded quickly
+        by load_exposure with use_cache.""")
+    warm_parser.add_argument('paths', nargs='+', help="exposure files")
+    warm_parser.add_argument(
+        '--categorical', nargs='*', default='auto',
+        help="""The categorical columns used by load_exposure, if they
+        are not the default""")
+    clear_parser = subparsers.add_parser(
+        'clear', help="Remove files from the cache.")
+    clear_parser.add_argument('--exposure', action='store_true',
+                              help="Only remove the cached exposure files")
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        for filename in compile_vulnerability(args.paths):
+            LOGGER.info('Compiled %s', filename)
+        LOGGER.info('Cache directory is %s', cache_dir())
+    elif args.command == 'warm':
+        categorical = args.categorical or None
+        for filename in args.paths:
+            cached_csv2dict(filename, add_ids=True, categorical=categorical)
+        LOGGER.info('Cache directory is %s', cache_dir())
+    elif args.command == 'clear':
+        prefix = EXPOSURE_PREFIX if args.exposure else None
+        removed = clear_cache(prefix=prefix)
+        LOGGER.info('Removed %i files from %s', len(removed), cache_dir())
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    cli()
@@ -26,7 +26,7 @@ Calculations
 
 import sys
 
-from hazimp.jobs.jobs import Job
+from hazimp.jobs.jobs import Job, EACH_BLOCK
 from hazimp import misc
 
 STRUCT_LOSS = 'structural_loss'
@@ -48,6 +48,8 @@ class Calculator(Job):
         Initalise a Calculator object.
         """
         super(Calculator, self).__init__()
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
     def calc(self):
         """
@@ -61,19 +63,33 @@ class Calculator(Job):
     def __call__(self, context, **kwargs):
         """
         This calls calc, passing in context.exposure_att and **kwargs.
+
+        The context exposure_const values are passed in without being
+        expanded to the site shape. If all of the inputs are
+        exposure_const values the results are too.
         """
         args_in = []
         for job_arg in self.context_args_in:
             # A calc with no input is ok.
             # print (job_arg)
-            if job_arg not in context.exposure_att:
+            try:
+                args_in.append(context.get_exposure_column(job_arg))
+            except KeyError:
                 raise RuntimeError(
                     'No correct variables, %s .' % job_arg)
-            args_in.append(context.exposure_att[job_arg])
+        const = (len(self.context_args_in) > 0 and
+                 all(context.is_exposure_const(job_arg)
+                     for job_arg in self.context_args_in))
         args_out = self.calc(*args_in, **kwargs)
         assert len(args_out) == len(self.args_out)
         for i, arg_out in enumerate(self.args_out):
-            context.exposure_att[arg_out] = args_out[i]
+            context.set_exposure_column(arg_out, args_out[i], const=const)
+
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The columns passed to calc.
+        """
+        return list(self.context_args_in)
 
 
 class MultiplyTest(Calculator):
@@ -32,6 +32,7 @@ import numpy
 
 from hazimp.calcs.calcs import CALCS
 from hazimp.calcs import calcs
+from hazimp.context import Context
 
 
 class Dummy(object):
@@ -40,8 +41,14 @@ class Dummy(object):
     Dummy class for testing
     """
 
+    # The exposure data methods of the context
+    get_exposure_column = Context.get_exposure_column
+    is_exposure_const = Context.is_exposure_const
+    set_exposure_column = Context.set_exposure_column
+
     def __init__(self):
-        pass
+        self.exposure_att = {}
+        self.exposure_const = {}
 
 
 class TestCalcs(unittest.TestCase):
@@ -52,7 +59,7 @@ class TestCalcs(unittest.TestCase):
 
     def test_Add(self):
         inst = CALCS['add_test']
-        context = Dummy
+        context = Dummy()
         context.exposure_att = {'a_test': 5, 'b_test': 20}
         inst(context)
         self.assertEqual(context.exposure_att['c_test'], 25)
@@ -61,7 +68,7 @@ class TestCalcs(unittest.TestCase):
 
     def test_AddII(self):
         inst = CALCS['add_test']
-        context = Dummy
+        context = Dummy()
         context.exposure_att = {'a_test': numpy.array([1, 2]),
                                 'b_test': numpy.array([3, 4])}
         inst(context)
@@ -73,7 +80,7 @@ class TestCalcs(unittest.TestCase):
     def test_AddIII(self):
         # FIXME convert to strings
         inst = CALCS['add_test']
-        context = Dummy
+        context = Dummy()
         context.exposure_att = {'a_test': numpy.array(['a', 'b']),
                                 'b_test': numpy.array(['c', 'd'])}
         inst(context)
@@ -85,7 +92,7 @@ class TestCalcs(unittest.TestCase):
     def test_MultipleValuesTest(self):
         # Not such a good test though
         inst = CALCS['multiple_values_test']
-        context = Dummy
+        context = Dummy()
         context.exposure_att = {'a_test': 5, 'b_test': 20}
         inst(context)
         self.assertEqual(context.exposure_att['e_test'], 5)
@@ -96,14 +103,14 @@ class TestCalcs(unittest.TestCase):
 
     def test_ConstantTestTest(self):
         inst = CALCS['constant_test']
-        context = Dummy
+        context = Dummy()
         context.exposure_att = {'a_test': 5, 'b_test': 20}
         inst(context, **{'constant': 5})
         self.assertEqual(context.exposure_att['g_test'], 5 * 2)
 
     def test_CalcLoss(self):
         inst = CALCS[calcs.STRUCT_LOSS]
-        context = Dummy
+        context = Dummy()
         context.exposure_att = {'structural_loss_ratio': 5,
                                 'REPLACEMENT_VALUE': 20}
         inst(context)
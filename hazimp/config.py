@@ -21,6 +21,7 @@ Functions concerning the yaml configuration file.
 
 import yaml
 from hazimp.templates import READERS, TEMPLATE, DEFAULT
+from hazimp.config_build import set_exposure_columns
 
 
 def read_file(file_name):
@@ -86,6 +87,7 @@ def instance_builder(config_list):
             'Invalid template name, %s in config file.' % template)
 
     jobs = reader_function(config_list)
+    set_exposure_columns(jobs)
     return jobs
 
 
@@ -67,6 +67,25 @@ def add_job(jobs, new_job, atts=None):
     jobs.append(caj)
 
 
+def set_exposure_columns(jobs):
+    """
+    Set the columns loaded by the exposure loading jobs with
+    usecols 'auto', to the exposure columns the jobs use.
+
+    :param jobs: A list of ConfigAwareJob instances.
+    """
+    used = []
+    for job in jobs:
+        atts = job.atts_to_add or {}
+        for column in job.job_instance.get_exposure_columns(atts):
+            if column not in used:
+                used.append(column)
+    for job in jobs:
+        atts = job.atts_to_add or {}
+        if atts.get('usecols') == 'auto':
+            job.atts_to_add = dict(atts, usecols=used)
+
+
 def get_job_or_calcs(job_names):
     """
     Given a list of job or calc names, return a list of job or calc
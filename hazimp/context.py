@@ -30,9 +30,11 @@ order. The order is determined by the queue of jobs.
 import os
 import sys
 import getpass
+from collections import OrderedDict
 from datetime import datetime
 import logging
 import csv
+import tempfile
 
 import numpy
 import pandas as pd
@@ -41,10 +43,15 @@ from prov.model import ProvDocument
 
 from hazimp import misc
 from hazimp import parallel
+from hazimp.spatial_index import GridIndex
+from hazimp.partial_aggregation import PartialAggregation
 
 LOGGER = logging.getLogger(__name__)
 DATEFMT = "%Y-%m-%d %H:%M:%S %Z"
 
+# The number of rows written to a csv file at a time
+CSV_CHUNK_SIZE = 100000
+
 # The standard string names in the context instance
 EX_LAT = 'exposure_latitude'
 EX_LONG = 'exposure_longitude'
@@ -78,15 +85,52 @@ class Context(object):
         self.exposure_lat = None
         self.exposure_long = None
 
+        # A spatial index of the exposure points, used to clip them.
+        # Only used while its lat and long arrays are the exposure ones.
+        self.exposure_index = None
+
         # Data with a site dimension
         # key - data name
         # value - A numpy array. First dimension is site. (0 axis)
         # Has a site dimension
         self.exposure_att = None
 
+        # Data with a site dimension that is the same for every site.
+        # It is not expanded to the site shape until it is saved, or a
+        # job that uses exposure_att directly needs it.
+        # key - data name
+        # value - A numpy scalar, or an array that broadcasts to the
+        #         site shape.
+        self.exposure_const = {}
+
+        # A temporary directory the numeric exposure_att columns are
+        # memory mapped from, or None if they are held in memory.
+        # See set_exposure_scratch.
+        self.exposure_scratch = None
+
+        # The memory mapped files of the exposure_att columns.
+        # key - data name
+        # value - The .npy file name, in the exposure_scratch directory.
+        self.exposure_scratch_files = {}
+
         # Data for aggregation across sites
         self.exposure_agg = None
 
+        # When the exposure is processed a block of sites at a time,
+        # an iterator of the (latitude, longitude, exposure_att) of the
+        # blocks, set by the exposure loader. See pipeline.PipeLine.run
+        self.exposure_blocks = None
+
+        # The number of the block of sites in the context, or None if
+        # all of the sites are in the context.
+        self.exposure_block = None
+
+        # Results accumulated over the blocks of sites.
+        # key - identifies the result, e.g. the file it is saved to
+        # value - (result, finish). finish(result) is called after the
+        #         last block.
+        self.block_results = OrderedDict()
+
         #
         # --------------  The above variables are saved ----
 
@@ -152,70 +196,341 @@ class Context(object):
             shape = self.exposure_long.shape
         return shape
 
+    def set_exposure_block(self, number, lat, lon, exposure_att):
+        """
+        Replace the sites in the context with a block of sites.
+
+        :param number: The number of the block, from 0.
+        :param lat: The latitude of the sites.
+        :param lon: The longitude of the sites.
+        :param exposure_att: The exposure data of the sites.
+        """
+        self.exposure_block = number
+        self.exposure_lat = lat
+        self.exposure_long = lon
+        self.exposure_att = exposure_att
+        self.exposure_index = None
+        self.exposure_vuln_curves = None
+
+    def get_block_result(self, key, start):
+        """
+        Get a result accumulated over the blocks of sites.
+
+        :param key: Identifies the result.
+        :param start: A function called on the first block, returning
+            the (result, finish) of a new result. finish(result) is
+            called after the last block, by finish_exposure_blocks.
+        :return: The result.
+        """
+        if key not in self.block_results:
+            self.block_results[key] = start()
+        return self.block_results[key][0]
+
+    def finish_exposure_blocks(self):
+        """
+        Finish the results accumulated over the blocks of sites, after
+        the last block.
+        """
+        results = self.block_results
+        self.block_results = OrderedDict()
+        self.exposure_block = None
+        for result, finish in results.values():
+            finish(result)
+
+    def get_exposure_column(self, key):
+        """
+        Get exposure data that has a site dimension.
+
+        :param key: The data name.
+        :return: The exposure_att values, or the exposure_const value,
+            which broadcasts to the site shape.
+        """
+        if key in self.exposure_att:
+            return self.exposure_att[key]
+        return self.exposure_const[key]
+
+    def is_exposure_const(self, key):
+        """
+        :param key: The data name.
+        :return: True if the data is the same for every site.
+        """
+        return key in self.exposure_const
+
+    def set_exposure_const(self, key, value):
+        """
+        Set exposure data that is the same for every site, without
+        expanding it to the site shape.
+
+        :param key: The data name.
+        :param value: A scalar, or an array that broadcasts to the site
+            shape.
+        """
+        value = numpy.asarray(value)
+        try:
+            numpy.broadcast_to(value, self.get_site_shape())
+        except ValueError:
+            msg = 'The %s value shape %s does not broadcast to the ' \
+                  'site shape %s.' % (key, value.shape, self.get_site_shape())
+            raise RuntimeError(msg)
+        if key in self.exposure_att:
+            del self.exposure_att[key]
+        self.exposure_const[key] = value
+
+    def set_exposure_column(self, key, value, const=False):
+        """
+        Set exposure data that has a site dimension.
+
+        :param key: The data name.
+        :param value: The values of the data.
+        :param const: True if the value is the same for every site, e.g.
+            it was calculated from exposure_const values only.
+        """
+        if const:
+            self.set_exposure_const(key, value)
+        else:
+            self.exposure_const.pop(key, None)
+            self.exposure_att[key] = value
+
+    def materialize_exposure_const(self, keys=None):
+        """
+        Expand exposure_const values to the site shape and move them to
+        exposure_att.
+
+        :param keys: The data names to expand. Names that are not
+            exposure_const data are ignored. All of the exposure_const
+            data is expanded if this is None.
+        """
+        if keys is None:
+            keys = list(self.exposure_const)
+        shape = self.get_site_shape()
+        for key in keys:
+            if key in self.exposure_const:
+                value = self.exposure_const.pop(key)
+                self.exposure_att[key] = numpy.broadcast_to(value,
+                                                            shape).copy()
+
+    def set_exposure_scratch(self, directory=None):
+        """
+        Keep the numeric exposure_att columns in memory mapped files,
+        rather than in memory, so the exposure data can be larger than
+        the memory. The operating system page cache holds the values in
+        use. The files are in a temporary directory, removed when the
+        context is.
+
+        :param directory: Optional. The directory the temporary directory
+            is made in. The system temporary directory if this is None.
+        """
+        self.exposure_scratch = tempfile.TemporaryDirectory(
+            prefix='hazimp-exposure-', dir=directory)
+        self.exposure_scratch_files = {}
+        self.map_exposure_columns()
+
+    def map_exposure_columns(self):
+        """
+        Move the numeric exposure_att columns that are in memory to
+        memory mapped files in the exposure_scratch directory. It is
+        called after each job, so the columns the job added are moved.
+        String and categorical columns stay in memory.
+        """
+        if self.exposure_scratch is None or self.exposure_att is None:
+            return
+        columns = {}
+        for key in self.exposure_att:
+            values = self.exposure_att[key]
+            values = getattr(values, 'values', values)
+            if isinstance(values, numpy.ndarray) and \
+                    values.dtype.kind in 'biuf' and \
+                    not misc.is_memory_mapped(values):
+                columns[key] = self._map_exposure_column(key, values)
+        if not columns:
+            return
+        if isinstance(self.exposure_att, dict):
+            self.exposure_att.update(columns)
+        else:
+            data = dict((key, columns.get(key, self.exposure_att[key]))
+                        for key in self.exposure_att)
+            # copy=False keeps the memory mapped arrays
+            self.exposure_att = pd.DataFrame(
+                data, index=self.exposure_att.index, copy=False)
+
+    def _map_exposure_column(self, key, values):
+        """
+        Write an exposure_att column to a file in the exposure_scratch
+        directory, replacing the file of the column's old values.
+
+        :returns: The memory mapped values.
+        """
+        handle, filename = tempfile.mkstemp(
+            suffix='.npy', dir=self.exposure_scratch.name)
+        os.close(handle)
+        mapped = misc.memory_map(values, filename)
+        old = self.exposure_scratch_files.pop(key, None)
+        if old is not None:
+            try:
+                os.remove(old)
+            except OSError:
+                # The file is still mapped, e.g. on Windows. It is
+                # removed with the directory.
+                pass
+        self.exposure_scratch_files[key] = filename
+        return mapped
+
+    def _exposure_att_with_const(self, columns=None):
+        """
+        :param columns: Optional. A list of the data names to include.
+            All of the data is included if this is None.
+        :return: A copy of exposure_att, with the exposure_const data
+            expanded to the site shape.
+        """
+        if columns is None:
+            if isinstance(self.exposure_att, dict):
+                write_dict = self.exposure_att.copy()
+            else:
+                # A shallow copy, so memory mapped columns are not read
+                write_dict = self.exposure_att.copy(deep=False)
+            const_keys = list(self.exposure_const)
+        else:
+            missing = [key for key in columns if key not in
+                       self.exposure_att and key not in self.exposure_const]
+            if missing:
+                msg = 'Columns %s are not in the exposure data.' % missing
+                raise RuntimeError(msg)
+            att_keys = [key for key in columns if key in self.exposure_att]
+            if isinstance(self.exposure_att, dict):
+                write_dict = dict((key, self.exposure_att[key])
+                                  for key in att_keys)
+            else:
+                write_dict = self.exposure_att[att_keys].copy()
+            const_keys = [key for key in columns
+                          if key in self.exposure_const]
+        shape = self.get_site_shape()
+        for key in const_keys:
+            write_dict[key] = numpy.broadcast_to(self.exposure_const[key],
+                                                 shape)
+        return write_dict
+
+    def get_exposure_index(self):
+        """
+        Get the spatial index of the exposure points. It is built if
+        the exposure points have changed since it was built.
+
+        :return: A GridIndex instance.
+        """
+        index = self.exposure_index
+        if (index is None or index.lon is not self.exposure_long or
+                index.lat is not self.exposure_lat):
+            index = GridIndex(self.exposure_long, self.exposure_lat)
+            self.exposure_index = index
+        return index
+
     def clip_exposure(self, min_long, min_lat, max_long, max_lat):
         """ min_long, min_lat, max_long, max_lat
         Clip the exposure data so only the exposure values within
         the rectangle formed by  max_lat, min_lat, max_long and
         min_long are included.
 
+        A site with a NAN latitude or longitude is only removed if its
+        other coordinate is outside the rectangle.
+
         Note: This must be called before the exposure_vuln_curves
         are determined, since the curves have a site dimension.
         """
+        index = self.get_exposure_index()
+        good_indexes = index.bbox(min_long, min_lat, max_long, max_lat)
+
+        # The index does not have the sites without a location
+        unlocated = numpy.flatnonzero(~(numpy.isfinite(self.exposure_long) &
+                                        numpy.isfinite(self.exposure_lat)))
+        if unlocated.size > 0:
+            lon = self.exposure_long[unlocated]
+            lat = self.exposure_lat[unlocated]
+            with numpy.errstate(invalid='ignore'):
+                outside = ((lon < min_long) | (lon > max_long) |
+                           (lat < min_lat) | (lat > max_lat))
+            good_indexes = numpy.union1d(good_indexes, unlocated[~outside])
+        self.take_exposure(good_indexes)
+
+    def clip_exposure_to_polygon(self, vertices):
+        """
+        Clip the exposure data so only the exposure values within
+        a polygon are included.
+
+        :param vertices: An array, shape (vertices, 2), of the
+            (longitude, latitude) of the polygon vertices.
+        """
+        index = self.get_exposure_index()
+        self.take_exposure(index.polygon(vertices))
+
+    def take_exposure(self, good_indexes):
+        """
+        Keep a subset of the exposure data.
+
+        Note: This must be called before the exposure_vuln_curves
+        are determined, since the curves have a site dimension.
+
+        :param good_indexes: A 1D integer array of the sites kept.
+        """
         assert self.exposure_vuln_curves is None
 
-        bad_indexes = set()
-        bad_indexes = bad_indexes.union(numpy.where(
-            self.exposure_long < min_long)[0])
-        bad_indexes = bad_indexes.union(numpy.where(
-            self.exposure_long > max_long)[0])
-        bad_indexes = bad_indexes.union(numpy.where(
-            self.exposure_lat < min_lat)[0])
-        bad_indexes = bad_indexes.union(numpy.where(
-            self.exposure_lat > max_lat)[0])
-        good_indexes = numpy.array(list(set(
-            range(self.exposure_lat.size)).difference(bad_indexes)), dtype=int)
-
-        if good_indexes.shape[0] == 0:
-            self.exposure_lat = numpy.array([])
-            self.exposure_long = numpy.array([])
-        else:
-            self.exposure_lat = self.exposure_lat[good_indexes]
-            self.exposure_long = self.exposure_long[good_indexes]
+        # The constants that vary along the site dimension are subset.
+        # The others broadcast to any number of sites.
+        site_dims = len(self.get_site_shape())
+        for key, value in self.exposure_const.items():
+            if value.ndim == site_dims and value.shape[0] > 1:
+                self.exposure_const[key] = value[good_indexes]
+
+        index = self.get_exposure_index()
+        self.exposure_lat = self.exposure_lat[good_indexes]
+        self.exposure_long = self.exposure_long[good_indexes]
+        self.exposure_index = index.take(good_indexes, self.exposure_long,
+                                         self.exposure_lat)
 
         if isinstance(self.exposure_att, dict):
             for key in self.exposure_att:
-                if good_indexes.shape[0] == 0:
-                    exp_att = numpy.array([])
-                else:
-                    exp_att = self.exposure_att[key][good_indexes]
-                self.exposure_att[key] = exp_att
+                self.exposure_att[key] = self.exposure_att[key][good_indexes]
         else:
             self.exposure_att = self.exposure_att.take(good_indexes)
 
-    def save_exposure_atts(self, filename, use_parallel=True):
+    def save_exposure_atts(self, filename, use_parallel=True,
+                           compression=None, columns=None):
         """
         Save the exposure attributes, including latitude and longitude.
         The file type saved is based on the filename extension.
         Options
+           '.csv': Save the arrays as a csv file. Arrays with more than
+                   one dimension are averaged.
+           '.parquet', '.feather': Save the arrays into a columnar file,
+                   keeping their dtype and shape.
            '.npz': Save the arrays into a single file in uncompressed .npz
                    format.
 
         :param use_parallel: Set to True for parallel behaviour
         Which is only node 0 writing to file.
         :param filename: The file to be written.
+        :param compression: Optional. The compression of a parquet or
+            feather file. See misc.write_columnar.
+        :param columns: Optional. A list of the attributes saved, as well
+            as the latitude and longitude. All are saved if this is None.
         :return write_dict: The whole dictionary, returned for testing.
         """
+        if self.exposure_block is not None:
+            # The file is written a block of sites at a time
+            writer = self.get_block_result(
+                ('save_exposure_atts', filename),
+                lambda: self._start_exposure_writer(filename, compression))
+            write_dict = self._exposure_att_with_const(columns)
+            write_dict[EX_LAT] = self.exposure_lat
+            write_dict[EX_LONG] = self.exposure_long
+            writer.write(write_dict)
+            return write_dict
+
         [filename, bucket_name, bucket_key] = misc.create_temporary_file_path_for_s3_if_applicable(filename)
-        s1 = self.prov.entity(":HazImp output file",
-                              {"prov:label": "Full HazImp output file",
-                               "prov:type": "void:Dataset",
-                               "prov:atLocation": os.path.basename(filename)})
-        a1 = self.prov.activity(":SaveImpactData",
-                                datetime.now().strftime(DATEFMT),
-                                None)
-        self.prov.wasGeneratedBy(s1, a1)
-        self.prov.wasInformedBy(a1, self.provlabel)
-        write_dict = self.exposure_att.copy()
+        self._prov_save_exposure_atts(filename)
+        if columns is not None and use_parallel and \
+                misc.INTID not in columns:
+            # The internal ids are needed to gather the sites
+            columns = list(columns) + [misc.INTID]
+        write_dict = self._exposure_att_with_const(columns)
         write_dict[EX_LAT] = self.exposure_lat
         write_dict[EX_LONG] = self.exposure_long
 
@@ -227,6 +542,9 @@ class Context(object):
         if parallel.STATE.rank == 0 or not use_parallel:
             if filename[-4:] == '.csv':
                 save_csv(write_dict, filename)
+            elif misc.columnar_format(filename) is not None:
+                misc.write_columnar(write_dict, filename,
+                                    compression=compression)
             else:
                 numpy.savez(filename, **write_dict)
             misc.upload_to_s3_if_applicable(filename, bucket_name, bucket_key)
@@ -235,17 +553,64 @@ class Context(object):
             # of the context info
             return write_dict
 
-    def save_exposure_aggregation(self, filename, use_parallel=True):
+    def _prov_save_exposure_atts(self, filename):
+        """
+        Add the provenance of saving the exposure attributes.
+        """
+        s1 = self.prov.entity(":HazImp output file",
+                              {"prov:label": "Full HazImp output file",
+                               "prov:type": "void:Dataset",
+                               "prov:atLocation": os.path.basename(filename)})
+        a1 = self.prov.activity(":SaveImpactData",
+                                datetime.now().strftime(DATEFMT),
+                                None)
+        self.prov.wasGeneratedBy(s1, a1)
+        self.prov.wasInformedBy(a1, self.provlabel)
+
+    def _start_exposure_writer(self, filename, compression=None):
+        """
+        Start writing the exposure attributes a block of sites at a time.
+
+        :param filename: The file to be written. Only csv, parquet and
+            feather files can be written a block at a time.
+        :param compression: Optional. The compression of a parquet or
+            feather file.
+        :return: The (writer, finish) of the file. See get_block_result.
+        """
+        [filename, bucket_name, bucket_key] = \
+            misc.create_temporary_file_path_for_s3_if_applicable(filename)
+        self._prov_save_exposure_atts(filename)
+        if filename[-4:] == '.csv':
+            writer = CsvWriter(filename)
+        elif misc.columnar_format(filename) is not None:
+            writer = misc.ColumnarWriter(filename, compression=compression)
+        else:
+            msg = 'Only csv, parquet and feather files can be saved a ' \
+                  'block of sites at a time, not %s.' % filename
+            raise RuntimeError(msg)
+
+        def finish(writer):
+            writer.close()
+            misc.upload_to_s3_if_applicable(filename, bucket_name, bucket_key)
+        return writer, finish
+
+    def save_exposure_aggregation(self, filename, use_parallel=True,
+                                  compression=None):
         """
         Save the aggregated exposure attributes.
         The file type saved is based on the filename extension.
         Options
+           '.csv': Save the aggregation as a csv file.
+           '.parquet', '.feather': Save the aggregation into a columnar
+                   file, keeping the column dtypes.
            '.npz': Save the arrays into a single file in uncompressed .npz
                    format.
 
         :param use_parallel: Set to True for parallel behaviour which
         is only node 0 writing to file.
         :param filename: The file to be written.
+        :param compression: Optional. The compression of a parquet or
+            feather file. See misc.write_columnar.
         :return write_dict: The whole dictionary, returned for testing.
         """
         write_dict = self.exposure_agg.copy()
@@ -263,6 +628,9 @@ class Context(object):
         if parallel.STATE.rank == 0 or not use_parallel:
             if filename[-4:] == '.csv':
                 save_csv_agg(write_dict, filename)
+            elif misc.columnar_format(filename) is not None:
+                misc.write_columnar(write_dict, filename,
+                                    compression=compression)
             else:
                 numpy.savez(filename, **write_dict)
             # The write_dict is returned for testing
@@ -280,10 +648,36 @@ class Context(object):
                                   is only node 0 writing to file
 
         """
+        if self.exposure_block is not None:
+            # Aggregate a block of sites at a time
+            aggregation = self.get_block_result(
+                ('save_aggregation', filename),
+                lambda: (PartialAggregation(impactcode,
+                                            misc.CHOROPLETH_REPORT),
+                         lambda aggregation: self._save_aggregation(
+                             aggregation.result(), filename, boundaries,
+                             boundarycode, use_parallel)))
+            aggregation.add(self._exposure_att_with_const(
+                [impactcode] + list(misc.CHOROPLETH_REPORT)))
+            return
+
+        write_dict = self._exposure_att_with_const()
+        aggregate = write_dict.groupby(
+            impactcode, observed=True).agg(misc.CHOROPLETH_REPORT)
+        self._save_aggregation(aggregate, filename, boundaries,
+                               boundarycode, use_parallel)
+
+    def _save_aggregation(self, aggregate, filename, boundaries,
+                          boundarycode, use_parallel=True):
+        """
+        Save the data aggregated to geospatial regions.
+
+        :param aggregate: A dataframe of the misc.CHOROPLETH_REPORT
+            aggregation, indexed by the region code.
+        """
         LOGGER.info("Saving aggregated data")
         boundaries = misc.download_file_from_s3_if_needed(boundaries)
         [filename, bucket_name, bucket_key] = misc.create_temporary_file_path_for_s3_if_applicable(filename)
-        write_dict = self.exposure_att.copy()
         dt = datetime.now().strftime(DATEFMT)
         atts = {"prov:type": "void:Dataset",
                 "prov:atLocation": os.path.basename(boundaries),
@@ -300,8 +694,8 @@ class Context(object):
         self.prov.wasInformedBy(aggact, self.provlabel)
         self.prov.wasGeneratedBy(aggfileent, aggact)
         if parallel.STATE.rank == 0 or not use_parallel:
-            misc.choropleth(write_dict, boundaries, impactcode,
-                            boundarycode, filename)
+            misc.save_choropleth(aggregate, boundaries, boundarycode,
+                                 filename)
             misc.upload_to_s3_if_applicable(filename, bucket_name, bucket_key)
             if bucket_name is not None and bucket_key is not None and bucket_key.endswith('.shp'):
                 [rootname, ext] = os.path.splitext(filename)
@@ -335,6 +729,28 @@ class Context(object):
         https://pandas.pydata.org/pandas-docs/stable/user_guide/groupby.html#aggregation
         for more guidance on using aggregation with `DataFrames`
 
+        """
+        if self.exposure_block is not None:
+            # Aggregate a block of sites at a time
+            aggregation = self.get_block_result(
+                ('aggregate_loss', repr(groupby), repr(kwargs)),
+                lambda: self._start_aggregate_loss(groupby, kwargs))
+            aggregation.add(self.exposure_att)
+            return
+
+        self._prov_aggregate_loss(groupby)
+        grouped = self.exposure_att.groupby(groupby, as_index=False,
+                                            observed=True)
+
+        outdf = grouped.agg(kwargs)
+        outdf.columns = ['_'.join(col).strip() for col in outdf.columns.values]
+        outdf.reset_index(col_level=1)
+        outdf.columns = outdf.columns.get_level_values(0)
+        self.exposure_agg = outdf
+
+    def _prov_aggregate_loss(self, groupby):
+        """
+        Add the provenance of the loss aggregation.
         """
         a1 = self.prov.activity(":AggregateLoss",
                                 datetime.now().strftime(DATEFMT),
@@ -342,13 +758,23 @@ class Context(object):
                                 {"prov:type": "Aggregation",
                                  "void:aggregator": repr(groupby)})
         self.prov.wasInformedBy(a1, self.provlabel)
-        grouped = self.exposure_att.groupby(groupby, as_index=False)
 
-        outdf = grouped.agg(kwargs)
-        outdf.columns = ['_'.join(col).strip() for col in outdf.columns.values]
-        outdf.reset_index(col_level=1)
-        outdf.columns = outdf.columns.get_level_values(0)
-        self.exposure_agg = outdf
+    def _start_aggregate_loss(self, groupby, kwargs):
+        """
+        Start aggregating the loss a block of sites at a time.
+
+        :return: The (aggregation, finish) of the aggregation. See
+            get_block_result.
+        """
+        self._prov_aggregate_loss(groupby)
+
+        def finish(aggregation):
+            outdf = aggregation.result().reset_index()
+            # The same columns as aggregating all of the sites at once
+            outdf.columns = ['_'.join(col).strip()
+                             for col in outdf.columns.values]
+            self.exposure_agg = outdf
+        return PartialAggregation(groupby, kwargs), finish
 
     def categorise(self, bins, labels, field_name):
         """
@@ -410,6 +836,55 @@ class Context(object):
                 "Maybe you need to run a categorise job before this one?")
             return
 
+        if self.exposure_block is not None:
+            # Tabulate a block of sites at a time
+            aggregation = self.get_block_result(
+                ('tabulate', file_name),
+                lambda: self._start_tabulate(file_name, index, columns,
+                                             aggfunc))
+            aggregation.add(self.exposure_att)
+            return
+
+        pivot = self.exposure_att.pivot_table(index=index,
+                                              columns=columns,
+                                              aggfunc=aggfunc,
+                                              fill_value=0,
+                                              observed=True)
+        self._save_tabulation(pivot, file_name, index, columns, aggfunc)
+
+    def _start_tabulate(self, file_name, index, columns, aggfunc):
+        """
+        Start tabulating a block of sites at a time.
+
+        Only the 'size' aggfunc, or a dictionary of aggregations of
+        columns, can be calculated a block at a time.
+
+        :return: The (aggregation, finish) of the table. See
+            get_block_result.
+        """
+        if aggfunc == 'size':
+            aggregation = PartialAggregation([index, columns], None)
+        elif isinstance(aggfunc, dict):
+            aggregation = PartialAggregation([index, columns], aggfunc)
+        else:
+            msg = "Only the 'size' aggfunc, or a dictionary of " \
+                  "aggregations, can be tabulated a block of sites at " \
+                  "a time, not %s." % aggfunc
+            raise RuntimeError(msg)
+
+        def finish(aggregation):
+            if aggfunc == 'size':
+                table = aggregation.size()
+            else:
+                table = aggregation.result()
+            pivot = table.unstack(columns, fill_value=0)
+            self._save_tabulation(pivot, file_name, index, columns, aggfunc)
+        return aggregation, finish
+
+    def _save_tabulation(self, pivot, file_name, index, columns, aggfunc):
+        """
+        Save a pivot table to an Excel file.
+        """
         dt = datetime.now().strftime(DATEFMT)
         a1 = self.prov.activity(":Tabulate", dt, None,
                                 {"prov:type": "Tabulation",
@@ -421,10 +896,7 @@ class Context(object):
                    "prov:generatedAtTime": dt}
         tblfileent = self.prov.entity(":TabulationFile", tblatts)
 
-        self.pivot = self.exposure_att.pivot_table(index=index,
-                                                   columns=columns,
-                                                   aggfunc=aggfunc,
-                                                   fill_value=0)
+        self.pivot = pivot
         try:
             self.pivot.to_excel(file_name)
         except TypeError as te:
@@ -441,7 +913,7 @@ class Context(object):
             self.prov.wasInformedBy(a1, self.provlabel)
 
 
-def save_csv(write_dict, filename):
+def save_csv(write_dict, filename, chunk_size=CSV_CHUNK_SIZE, append=False):
     """
     Save a dictionary of arrays as a csv file.
     the first dimension in the arrays is assumed to have the save length
@@ -451,9 +923,15 @@ def save_csv(write_dict, filename):
     If the array is higher than 1d the other dimensions are averaged to get a
     1d array.
 
+    The file is written a block of rows at a time, and each column of a
+    block is formatted in one go, keeping its own type.
+
     :param  write_dict: Write as a csv file.
     :type write_dict: Dictionary.
     :param filename: The csv file will be written here.
+    :param chunk_size: The number of rows written at a time.
+    :param append: If True, add the rows to the end of the file, without
+        the header.
     """
     keys = list(write_dict.keys())
     header = list(keys)
@@ -463,30 +941,88 @@ def save_csv(write_dict, filename):
     header.remove(EX_LONG)
     header.insert(0, EX_LAT)
     header.insert(1, EX_LONG)
-    body = None
+
+    columns = []
     for key in header:
-        #  Only one dimension can be saved.
-        #  Average the results to the Site (first) dimension.
-        only_1d = misc.squash_narray(write_dict[key])
-        if body is None:
-            body = only_1d
+        column = write_dict[key]
+        if isinstance(column, pd.Series):
+            column = column.values
         else:
-            # NUMPY1.6 loses significant figures
-            body = numpy.column_stack((body, only_1d))
-    # Need numpy 1.7 > to do headers
-    # numpy.savetxt(filename, body, delimiter=',', header='yeah')
+            column = numpy.asarray(column)
+        columns.append(column)
+    rows = len(columns[0])
 
     dirname = os.path.dirname(filename)
     if dirname and not os.path.isdir(dirname):
         LOGGER.warning(f"{dirname} does not exist - trying to create it")
         os.makedirs(dirname)
 
-    hnd = open(filename, 'w', newline='')
+    with open(filename, 'a' if append else 'w', newline='') as hnd:
+        if not append:
+            writer = csv.writer(hnd, delimiter=',')
+            writer.writerow(header)
+        for start in range(0, rows, chunk_size):
+            #  Only one dimension can be saved.
+            #  Average the results to the Site (first) dimension.
+            block = [_csv_text(misc.squash_narray(
+                column[start:start + chunk_size])) for column in columns]
+            hnd.writelines(','.join(line) + '\r\n' for line in zip(*block))
 
-    writer = csv.writer(hnd, delimiter=',')
-    writer.writerow(header)
-    for i in range(body.shape[0]):
-        writer.writerow(list(body[i, :]))
+
+class CsvWriter(object):
+
+    """
+    Write a csv file a block of rows at a time. See save_csv.
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: The csv file will be written here.
+        """
+        self.filename = filename
+        self.header = None
+
+    def write(self, write_dict):
+        """
+        Write a block of rows. Every block has the columns of the first.
+
+        :param write_dict: A dictionary of arrays.
+        """
+        if self.header is None:
+            self.header = list(write_dict.keys())
+            save_csv(write_dict, self.filename)
+        else:
+            if list(write_dict.keys()) != self.header:
+                msg = "The columns of a block of %s don't match the " \
+                      "first block." % self.filename
+                raise RuntimeError(msg)
+            save_csv(write_dict, self.filename, append=True)
+
+    def close(self):
+        """
+        Finish writing the file.
+        """
+
+
+def _csv_text(values):
+    """
+    Format the values of a 1D array as csv text, the same as a csv
+    writer would.
+
+    Booleans are written as 1.0 and 0.0, as they always have been.
+
+    :param values: A 1D array.
+    :returns: A list of the text of the values.
+    """
+    kind = getattr(values.dtype, 'kind', 'O')
+    if kind == 'b':
+        values = values.astype(float)
+    if kind in 'biuf':
+        return list(map(repr, values.tolist()))
+    text = list(map(str, values.tolist()))
+    return [('"%s"' % value.replace('"', '""'))
+            if any(char in value for char in ',"\r\n') else value
+            for value in text]
 
 
 def save_csv_agg(write_dict, filename):
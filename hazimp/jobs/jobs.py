@@ -37,6 +37,7 @@ is not present Error out.
 
 import os
 import sys
+import logging
 import scipy
 import numpy as np
 
@@ -44,9 +45,15 @@ from prov.dot import prov_to_dot
 
 from hazimp import parallel
 from hazimp import misc
+from hazimp import cache
 from hazimp import raster as raster_module
 from hazimp.context import EX_LAT, EX_LONG
-from hazimp.jobs.vulnerability_model import vuln_sets_from_xml_file
+from hazimp import spatial_index
+from hazimp.jobs.vulnerability_model import (vuln_sets_from_xml_file,
+                                             cached_vuln_sets_from_xml_file,
+                                             lazy_vuln_sets_from_xml_file)
+
+LOGGER = logging.getLogger(__name__)
 
 ADD = 'add'
 MULT = 'mult'
@@ -70,6 +77,18 @@ TABULATE = 'tabulate'
 CATEGORISE = 'categorise'
 SAVEPROVENANCE = 'saveprovenance'
 
+# How a job is run when the exposure is processed a block of sites at a
+# time. See pipeline.PipeLine.run.
+# EACH_BLOCK - On every block. The job works on each site on its own.
+# FIRST_BLOCK - On the first block. The job does not use the site data.
+# ALL_BLOCKS - On every block, combining the results of the blocks after
+#              the last block. e.g. aggregating the sites.
+# AFTER_BLOCKS - Once, after the results of the blocks are combined.
+EACH_BLOCK = 'each_block'
+FIRST_BLOCK = 'first_block'
+ALL_BLOCKS = 'all_blocks'
+AFTER_BLOCKS = 'after_blocks'
+
 
 class Job(object):
 
@@ -83,6 +102,12 @@ class Job(object):
          allargspec_call and args_in.
         """
         self.call_funct = None
+        # True if the job handles the context exposure_const data,
+        # so the pipeline does not have to expand it first.
+        self.broadcasts_const = False
+        # How the job is run on blocks of sites. None if the job needs
+        # all of the sites at once.
+        self.block_mode = None
 
     def get_call_funct(self):
         """
@@ -112,6 +137,29 @@ class Job(object):
 
         return args, defaults
 
+    def get_exposure_columns(self, atts):
+        """
+        Get the exposure columns the job reads, so only these columns
+        need to be loaded.
+
+        :param atts: The attributes the job is called with.
+        :returns: A list of exposure column titles. This can include
+            columns calculated by other jobs.
+        """
+        return []
+
+
+def _column_list(columns):
+    """
+    :param columns: None, a column title or a list of column titles.
+    :returns: A list of the column titles.
+    """
+    if columns is None:
+        return []
+    if isinstance(columns, str):
+        return [columns]
+    return list(columns)
+
 
 class ConstTest(Job):
 
@@ -122,6 +170,7 @@ class ConstTest(Job):
     def __init__(self):
         super(ConstTest, self).__init__()
         self.call_funct = 'const_test'
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, c_test=None):
         """
@@ -142,6 +191,8 @@ class Const(Job):
     def __init__(self):
         super(Const, self).__init__()
         self.call_funct = CONSTANT
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, var, value):
         """
@@ -151,10 +202,9 @@ class Const(Job):
         :param var: Variable to add to context.
         :param value: Value of the variable added.
         """
-        shape = context.get_site_shape()
-        # This uses a lot of memory,
-        # but it keeps the context instance simple.
-        context.exposure_att[var] = scipy.tile(scipy.asarray(value), shape)
+        # The value is broadcast to the sites when it is used, so it
+        # is not stored for every site.
+        context.set_exposure_const(var, value)
 
 
 class RandomConst(Job):
@@ -167,6 +217,7 @@ class RandomConst(Job):
     def __init__(self):
         super(RandomConst, self).__init__()
         self.call_funct = RANDOM_CONSTANT
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, var, values, forced_random=None):
         """
@@ -197,6 +248,8 @@ class Add(Job):
     def __init__(self):
         super(Add, self).__init__()
         self.call_funct = ADD
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, var1, var2, var_out):
         """
@@ -207,8 +260,18 @@ class Add(Job):
         :param var2: The values in this column are added.
         :param var_out: The new column name, with the values of var1 + var2.
         """
-        context.exposure_att[var_out] = misc.add(context.exposure_att[var1],
-                                                 context.exposure_att[var2])
+        context.set_exposure_column(
+            var_out,
+            misc.add(context.get_exposure_column(var1),
+                     context.get_exposure_column(var2)),
+            const=(context.is_exposure_const(var1) and
+                   context.is_exposure_const(var2)))
+
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The columns that are added.
+        """
+        return _column_list(atts.get('var1')) + _column_list(atts.get('var2'))
 
 
 class Mult(Job):
@@ -220,6 +283,8 @@ class Mult(Job):
     def __init__(self):
         super(Mult, self).__init__()
         self.call_funct = MULT
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, var1, var2, var_out):
         """
@@ -230,8 +295,18 @@ class Mult(Job):
         :param var2: The values in this column are Multiplied.
         :param var_out: The new column name, with the values of var1 * var2.
         """
-        context.exposure_att[var_out] = (context.exposure_att[var1] *
-                                         context.exposure_att[var2])
+        context.set_exposure_column(
+            var_out,
+            (context.get_exposure_column(var1) *
+             context.get_exposure_column(var2)),
+            const=(context.is_exposure_const(var1) and
+                   context.is_exposure_const(var2)))
+
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The columns that are multiplied.
+        """
+        return _column_list(atts.get('var1')) + _column_list(atts.get('var2'))
 
 
 class MultipleDimensionMult(Job):
@@ -246,6 +321,8 @@ class MultipleDimensionMult(Job):
     def __init__(self):
         super(MultipleDimensionMult, self).__init__()
         self.call_funct = MDMULT
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, var1, var2, var_out):
         """
@@ -261,6 +338,7 @@ class MultipleDimensionMult(Job):
         """
         # print "var1 ", context.exposure_att[var1].shape
 
+        context.materialize_exposure_const([var1, var2])
         rolled = context.exposure_att[var1]
         context.exposure_att[var1] = scipy.rollaxis(rolled, 0,
                                                     rolled.ndim)
@@ -283,6 +361,12 @@ class MultipleDimensionMult(Job):
         # print "var2", context.exposure_att[var2].shape
         # print "var_out]", context.exposure_att[var_out].shape
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The columns that are multiplied.
+        """
+        return _column_list(atts.get('var1')) + _column_list(atts.get('var2'))
+
 
 class LoadCsvExposure(Job):
 
@@ -300,14 +384,41 @@ class LoadCsvExposure(Job):
             file_name,
             exposure_latitude=None,
             exposure_longitude=None,
-            use_parallel=True):
+            use_parallel=True,
+            categorical='auto',
+            dtype=None,
+            usecols=None,
+            use_cache=False,
+            chunk_size=None,
+            scratch_dir=None):
         """
         Read a csv exposure file into the context object.
 
         :param context: The context instance, used to move data around.
-        :param file_name: The csv file to load.
+        :param file_name: The csv file to load. Parquet and feather files
+            are loaded too, based on the file extension.
         :param exposure_latitude: the title string of the latitude column.
         :param exposure_longitude: the title string of the longitude column.
+        :param categorical: The string columns stored as categoricals,
+            which store each string once. 'auto' is the string columns
+            with few unique values, e.g. vulnerability function IDs.
+            Or a list of column names, or None.
+        :param dtype: Optional. A dictionary of the dtype of columns,
+            e.g. {'REPLACEMENT_VALUE': 'float32'}.
+        :param usecols: Optional. A list of the columns to load, as well
+            as the latitude and longitude. Columns that are not in the
+            file are ignored. All columns are loaded if this is None.
+            'auto' is replaced by the columns the other jobs use when
+            the jobs are built. See config_build.set_exposure_columns.
+        :param use_cache: If True, keep a binary copy of the file in the
+            hazimp cache, and memory map it in later runs rather than
+            parsing the file again.
+        :param chunk_size: Optional. The number of sites in a block. If
+            given, the file is read and processed a block of sites at a
+            time, rather than all at once. See pipeline.PipeLine.run.
+        :param scratch_dir: Optional. A directory to keep the numeric
+            exposure columns in, as memory mapped files, rather than in
+            memory. See Context.set_exposure_scratch.
 
         Content return:
             exposure_att: Add the file values into this dictionary.
@@ -322,39 +433,94 @@ class LoadCsvExposure(Job):
                                       'prov:generatedAtTime': dt,
                                       'prov:atLocation': os.path.basename(file_name)})
         context.prov.used(context.provlabel, expent)
-        data_frame = parallel.csv2dict(file_name, use_parallel=use_parallel)
-        # FIXME Need to do better error handling
-        # FIXME this function can only be called once.
-        # Multiple calls will corrupt the context data.
 
         if exposure_latitude is None:
             lat_key = EX_LAT
         else:
             lat_key = exposure_latitude
-
-        try:
-            context.exposure_lat = data_frame[lat_key].values
-            del data_frame[lat_key]
-        except KeyError:
-            msg = "No Exposure latitude column labelled '%s'." % lat_key
-            raise RuntimeError(msg)
-
         if exposure_longitude is None:
             long_key = EX_LONG
         else:
             long_key = exposure_longitude
 
-        try:
-            context.exposure_long = data_frame[long_key].values
-            del data_frame[long_key]
-        except KeyError:
-            msg = "No Exposure longitude column labelled '%s'." % long_key
-            raise RuntimeError(msg)
+        if usecols == 'auto':
+            LOGGER.warning('The exposure columns used are not known. '
+                           'Loading all of the columns.')
+            usecols = None
+        elif usecols is not None:
+            usecols = [lat_key, long_key] + list(usecols)
+
+        if scratch_dir is not None:
+            context.set_exposure_scratch(scratch_dir)
+
+        if chunk_size is not None:
+            if parallel.STATE.is_parallel and use_parallel:
+                raise RuntimeError('The exposure can not be processed a '
+                                   'block of sites at a time in parallel.')
+            if use_cache:
+                blocks = misc.dataframe_blocks(
+                    cache.cached_csv2dict(file_name, add_ids=True,
+                                          dtype=dtype,
+                                          categorical=categorical,
+                                          usecols=usecols), chunk_size)
+            else:
+                blocks = misc.csv2dict_blocks(file_name, chunk_size,
+                                              add_ids=True, dtype=dtype,
+                                              categorical=categorical,
+                                              usecols=usecols)
+            context.exposure_blocks = (
+                _split_lat_long(block, lat_key, long_key)
+                for block in blocks)
+            return
+
+        data_frame = parallel.csv2dict(file_name, use_parallel=use_parallel,
+                                       dtype=dtype, categorical=categorical,
+                                       usecols=usecols, use_cache=use_cache)
+        # FIXME Need to do better error handling
+        # FIXME this function can only be called once.
+        # Multiple calls will corrupt the context data.
 
-        context.exposure_att = data_frame
+        (context.exposure_lat, context.exposure_long,
+         context.exposure_att) = _split_lat_long(data_frame, lat_key,
+                                                 long_key)
+        context.exposure_index = spatial_index.GridIndex(
+            context.exposure_long, context.exposure_lat)
         # for key in data_frame:
         #    context.exposure_att[key] = data_frame[key].values
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The latitude and longitude columns.
+        """
+        return [atts.get('exposure_latitude') or EX_LAT,
+                atts.get('exposure_longitude') or EX_LONG]
+
+
+def _split_lat_long(data_frame, lat_key, long_key):
+    """
+    Split the latitude and longitude columns from the exposure data.
+
+    :param data_frame: A dataframe of the exposure data.
+    :param lat_key: The title of the latitude column.
+    :param long_key: The title of the longitude column.
+    :returns: The latitude, longitude and other exposure data.
+    """
+    try:
+        lat = data_frame[lat_key].values
+        del data_frame[lat_key]
+    except KeyError:
+        msg = "No Exposure latitude column labelled '%s'." % lat_key
+        raise RuntimeError(msg)
+
+    try:
+        lon = data_frame[long_key].values
+        del data_frame[long_key]
+    except KeyError:
+        msg = "No Exposure longitude column labelled '%s'." % long_key
+        raise RuntimeError(msg)
+
+    return lat, lon, data_frame
+
 
 class LoadXmlVulnerability(Job):
 
@@ -365,16 +531,30 @@ class LoadXmlVulnerability(Job):
     def __init__(self):
         super(LoadXmlVulnerability, self).__init__()
         self.call_funct = LOADXMLVULNERABILITY
+        self.broadcasts_const = True
+        self.block_mode = FIRST_BLOCK
 
-    def __call__(self, context, file_name):
+    def __call__(self, context, file_name, use_cache=False, lazy=True):
         """
-        Read a csv exposure file into the context object.
+        Read a vulnerability xml file into the context object.
 
         :param context: The context instance, used to move data around.
         :param file_name: The xml file to load.
+        :param use_cache: If True, load the compiled curves from the
+            hazimp cache, compiling them on the first load. The default
+            is False, so runs don't write to the cache directory.
+        :param lazy: If True, only index the file. The vulnerability
+            sets are loaded when they are used, and SelectVulnFunction
+            only loads the vulnerability functions the exposure uses.
         """
         if file_name is not None:
-            vuln_sets = vuln_sets_from_xml_file(file_name)
+            if lazy:
+                vuln_sets = lazy_vuln_sets_from_xml_file(file_name,
+                                                         use_cache=use_cache)
+            elif use_cache:
+                vuln_sets = cached_vuln_sets_from_xml_file(file_name)
+            else:
+                vuln_sets = vuln_sets_from_xml_file(file_name)
             context.vulnerability_sets.update(vuln_sets)
             dt = misc.get_file_mtime(file_name)
             vulent = context.prov.entity(":vulnerability file",
@@ -395,6 +575,8 @@ class SimpleLinker(Job):
     def __init__(self):
         super(SimpleLinker, self).__init__()
         self.call_funct = SIMPLELINKER
+        self.broadcasts_const = True
+        self.block_mode = FIRST_BLOCK
 
     def __call__(self, context, vul_functions_in_exposure):
         """
@@ -418,6 +600,12 @@ class SimpleLinker(Job):
             context.prov.specializationOf(k1, ":vulnerability file")
         context.vul_function_titles.update(vul_functions_in_exposure)
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The vulnerability function ID columns.
+        """
+        return list(atts.get('vul_functions_in_exposure', {}).values())
+
 
 class SelectVulnFunction(Job):
 
@@ -435,8 +623,11 @@ class SelectVulnFunction(Job):
     def __init__(self):
         super(SelectVulnFunction, self).__init__()
         self.call_funct = SELECTVULNFUNCTION
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
-    def __call__(self, context, variability_method=None):
+    def __call__(self, context, variability_method=None, seed=None,
+                 realisations=None):
         """
         Specifies what vulnerability sets to use.
         Links vulnerability curves to assets.
@@ -457,6 +648,13 @@ class SelectVulnFunction(Job):
             e.g. {'EQ_contents': 'mean', 'EQ_building': 'mean'}
             Limitation: A vulnerability set can only be used once, since
             it needs a unique name.
+            The 'random' method samples the loss from the probabilistic
+            distribution of the vulnerability function.
+        :param seed: The random seed used by the 'random' method. The
+            samples of a site only depend on the seed and the site's row
+            in the exposure file.
+        :param realisations: The number of loss samples per asset drawn
+            by the 'random' method.  If None, one sample is drawn.
 
         Content return:
            exposure_vuln_curves: A dictionary of realised
@@ -466,6 +664,11 @@ class SelectVulnFunction(Job):
            value - realised vulnerability curve instance per asset
         """
         exposure_vuln_curves = {}
+        asset_ids = None
+        if misc.INTID in context.exposure_att:
+            # The random numbers of a site come from its row in the
+            # exposure file, so they are the same for any block size
+            asset_ids = np.asarray(context.exposure_att[misc.INTID])
 
         for vuln_set_key in variability_method:
 
@@ -473,11 +676,13 @@ class SelectVulnFunction(Job):
             vuln_set = context.vulnerability_sets[vuln_set_key]
             # Get the column of function ID's
             exposure_title = context.vul_function_titles[vuln_set_key]
+            context.materialize_exposure_const([exposure_title])
             vuln_function_ids = context.exposure_att[exposure_title]
             # sample from the function to get the curve
             realised_vuln_curves = vuln_set.build_realised_vuln_curves(
                 vuln_function_ids,
-                variability_method=variability_method[vuln_set_key])
+                variability_method=variability_method[vuln_set_key],
+                seed=seed, realisations=realisations, asset_ids=asset_ids)
             # Build a dictionary of realised vulnerability curves
             exposure_vuln_curves[vuln_set_key] = realised_vuln_curves
 
@@ -494,13 +699,31 @@ class LookUp(Job):
     def __init__(self):
         super(LookUp, self).__init__()
         self.call_funct = LOOKUP
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
-    def __call__(self, context):
+    def __call__(self, context, lookup_resolution=None, lookup_range=None,
+                 keep_realisations=True):
         """
         Does a look up on all the vulnerability curves, returning the
         associated loss.
 
+        If the curves were sampled with several realisations per asset,
+        the loss of each realisation is saved as the loss category with
+        the realisation number as a suffix, e.g. 'loss_000002'. These
+        give the portfolio loss of each realisation when aggregated.
+        The loss category is the mean of the realisations, and the
+        standard deviation is saved with a '_sd' suffix.
+
         :param context: The context instance, used to move data around.
+        :param lookup_resolution: Optional. If given, the curves are
+            tabulated on an intensity grid with this spacing and the
+            loss is looked up in the table, rather than interpolated.
+            See RealisedVulnerabilityCurves.tabulate for the error.
+        :param lookup_range: Optional. The (minimum, maximum) intensity
+            of the lookup table.
+        :param keep_realisations: If False, only the mean and standard
+            deviation of the realisations are saved.
 
         Content return:
            exposure_vuln_curves: A dictionary of realised
@@ -509,10 +732,13 @@ class LookUp(Job):
                 key - intensity measure
                 value - realised vulnerability curve instance per asset
         """
+        # The loss columns are added together, at the end
+        columns = {}
         for intensity_key in context.exposure_vuln_curves:
             vuln_curve = context.exposure_vuln_curves[intensity_key]
             int_measure = vuln_curve.intensity_measure_type
             loss_category_type = vuln_curve.loss_category_type
+            context.materialize_exposure_const([int_measure])
             try:
                 intensities = context.exposure_att[int_measure]
             except KeyError:
@@ -521,8 +747,22 @@ class LookUp(Job):
                 msg += 'vulnerability_set_id is %s. \n' % vulnerability_set_id
                 raise RuntimeError(msg)
 
+            if lookup_resolution is not None:
+                error = vuln_curve.tabulate(lookup_resolution,
+                                            intensity_range=lookup_range)
+                LOGGER.info('Maximum %s lookup table error is %g',
+                            loss_category_type, error)
             losses = vuln_curve.look_up(intensities)
-            context.exposure_att[loss_category_type] = losses
+            if vuln_curve.realisations is not None:
+                if keep_realisations:
+                    for n in range(losses.shape[-1]):
+                        realisation = loss_category_type + "_{0:06d}".format(n)
+                        columns[realisation] = losses[..., n]
+                columns[loss_category_type + '_sd'] = np.std(losses, axis=-1)
+                losses = np.mean(losses, axis=-1)
+            columns[loss_category_type] = losses
+        context.exposure_att = misc.insert_columns(context.exposure_att,
+                                                   columns)
 
 
 class PermutateExposure(Job):
@@ -535,7 +775,8 @@ class PermutateExposure(Job):
         super(PermutateExposure, self).__init__()
         self.call_funct = PERMUTATE_EXPOSURE
 
-    def __call__(self, context, groupby=None, iterations=1000):
+    def __call__(self, context, groupby=None, iterations=1000,
+                 keep_realisations=True):
         """
         Calculates the loss for the given vulnerability set, randomly 
         permutating the exposure attributes to arrive at a 
@@ -546,6 +787,11 @@ class PermutateExposure(Job):
                         exposure assets by before randomly permutating
                         the corresponding vulnerability curves.
         :param iterations: Number of iterations to perform
+        :param keep_realisations: If the curves were sampled with several
+            realisations per asset, each iteration uses the next
+            realisation, so the iterations sample the loss as well as the
+            permutations. If False, each iteration uses the mean of the
+            realisations.
 
         Content return:
            exposure_vuln_curves: A :class:`pandas.DataFrame` of realised
@@ -557,16 +803,21 @@ class PermutateExposure(Job):
         vulnerability_set_id = list(context.exposure_vuln_curves)[0]
         field = context.vul_function_titles[vulnerability_set_id]
 
+        # The curves are realised once. Each permutation just reassigns
+        # the table of curves to the assets.
+        realised_vuln_curves = dict(context.exposure_vuln_curves)
+
         losses = np.zeros((iterations, len(context.exposure_att)))
         for n in range(iterations):
             context.exposure_att = \
                 misc.permutate_att_values(context.exposure_att,
                                           field, groupby=groupby)
 
-            for intensity_key in context.exposure_vuln_curves:
-                SelectVulnFunction().__call__(context, variability_method={
-                    intensity_key: 'mean'})
-                vuln_curve = context.exposure_vuln_curves[intensity_key]
+            for intensity_key in realised_vuln_curves:
+                exposure_title = context.vul_function_titles[intensity_key]
+                vuln_curve = realised_vuln_curves[intensity_key].reindex(
+                    context.exposure_att[exposure_title])
+                context.exposure_vuln_curves[intensity_key] = vuln_curve
                 int_measure = vuln_curve.intensity_measure_type
                 loss_category_type = vuln_curve.loss_category_type
                 try:
@@ -577,7 +828,15 @@ class PermutateExposure(Job):
                     msg += 'vulnerability_set_id is %s. \n' % vulnerability_set_id
                     raise RuntimeError(msg)
 
-                losses[n, :] = vuln_curve.look_up(intensities)
+                iteration_losses = vuln_curve.look_up(intensities)
+                realisations = vuln_curve.realisations
+                if realisations is not None and keep_realisations:
+                    # Each iteration samples the next realisation
+                    iteration_losses = iteration_losses[
+                        ..., n % realisations]
+                elif realisations is not None:
+                    iteration_losses = np.mean(iteration_losses, axis=-1)
+                losses[n, :] = iteration_losses
                 # By adding in a new attribute for each iteration, we can
                 # capture all the possible permutations of loss outcomes.
                 # This leads to a rather substantial output data volume,
@@ -595,6 +854,12 @@ class PermutateExposure(Job):
             context.exposure_att[loss_category_type] = mean_loss
             context.exposure_att[loss_category_type_sd] = loss_sd
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The groupby column.
+        """
+        return _column_list(atts.get('groupby'))
+
 
 class LoadRaster(Job):
 
@@ -608,6 +873,8 @@ class LoadRaster(Job):
     def __init__(self):
         super(LoadRaster, self).__init__()
         self.call_funct = LOADRASTER
+        self.broadcasts_const = True
+        self.block_mode = EACH_BLOCK
 
     # R0913:326: Too many arguments (9/6)
     # pylint: disable=R0913
@@ -615,7 +882,11 @@ class LoadRaster(Job):
                  clip_exposure2all_hazards=False,
                  file_list=None, file_format=None, variable=None,
                  raster=None, upper_left_x=None, upper_left_y=None,
-                 cell_size=None, no_data_value=None):
+                 cell_size=None, no_data_value=None, read_mode='auto',
+                 block_cache_bytes=raster_module.BLOCK_CACHE_BYTES,
+                 workers=1, pixel_cache='memory', bands=None,
+                 reduction=None, threshold=None, time_step=1.,
+                 clip_extent='union'):
         """
         Load one or more files and get the value for all the
         exposure points. All files have to be of the same attribute.
@@ -627,6 +898,31 @@ class LoadRaster(Job):
             clippped to the hazard data, so no hazard values are ignored.
 
         :param file_list: A list of files or a single file to be loaded.
+        :param clip_extent: The extent the exposure is clipped to, for
+            clip_exposure2all_hazards. 'union' is the area covered by any
+            of the files and 'intersection' the area covered by all of
+            them. Only the file headers are read to clip the exposure.
+        :param read_mode: How much of each file is read. 'full' reads
+            the whole raster, 'window' only reads the pixels covering the
+            exposure points and 'block' only reads the GDAL blocks the
+            exposure points are in. 'auto' uses 'block' for tiled rasters
+            and 'full' otherwise.
+        :param block_cache_bytes: The memory limit of the block cache
+            used by the 'block' read mode.
+        :param workers: The number of files read at the same time.
+        :param pixel_cache: Where the pixels of the exposure points are
+            cached, so files on the same grid only find them once. None,
+            'memory' or 'disk', which keeps them between runs.
+        :param bands: The bands loaded from each file. None loads the
+            first band. 'all', or a list of band numbers (starting at 1),
+            loads the bands as a 2D array, (assets, bands).
+        :param reduction: Reduce the bands of each file, e.g. the time
+            steps of a NetCDF variable, to one value per asset. One of
+            'max', 'mean', 'sum' or 'time_above'. The bands are read one
+            at a time.
+        :param threshold: The threshold of the 'time_above' reduction.
+        :param time_step: The time between bands, for the 'sum' and
+            'time_above' reductions.
         OR
         :param raster: A 2D numeric array of the raster values, North is up.
         :param upper_left_x: The longitude at the upper left corner.
@@ -661,43 +957,99 @@ class LoadRaster(Job):
                 extent = a_raster.extent()
                 context.clip_exposure(*extent)
 
+            # The no data values are NAN in the sampled data
             file_data = a_raster.raster_data_at_points(
                 context.exposure_long,
                 context.exposure_lat)
-            file_data = np.where(file_data == no_data_value, np.NAN,
-                                 file_data)
             context.exposure_att[attribute_label] = file_data
         else:
             if isinstance(file_list, str):
                 file_list = [file_list]
 
-            for f in file_list:
-                f = misc.download_file_from_s3_if_needed(f)
-                dt = misc.get_file_mtime(f)
-                atts = {"dcterms:title": "Source hazard data",
-                        "prov:type": "prov:Dataset",
-                        "prov:atLocation": os.path.basename(f),
-                        "prov:format": os.path.splitext(f)[1].replace('.', ''),
-                        "prov:generatedAtTime": dt, }
-                if file_format == 'nc' and variable:
-                    atts['prov:variable'] = variable
-                hazent = context.prov.entity(":Hazard data", atts)
-                context.prov.used(context.provlabel, hazent)
+            if context.exposure_block is None:
+                _hazard_prov(context, file_list, file_format, variable)
+            else:
+                # The hazard files are the same for every block of sites,
+                # so their provenance is added on the first block
+                block_sites = context.get_block_result(
+                    (LOADRASTER, attribute_label),
+                    lambda: _start_hazard_blocks(context, file_list,
+                                                 file_format, variable))
 
             if file_format == 'nc' and variable:
                 file_list = misc.mod_file_list(file_list, variable)
 
-            file_data, extent = raster_module.files_raster_data_at_points(
+            if clip_exposure2all_hazards:
+                # Reduce the context to the hazard area before any
+                # hazard data is read, using the file headers.
+                extent = raster_module.files_extent(file_list, clip_extent)
+                context.clip_exposure(*extent)
+                msg = ('No exposure points are in the %s of the hazard '
+                       'extents, %s. Check the hazard files and the '
+                       'exposure have the same projection.' %
+                       (clip_extent, str(extent)))
+                if context.exposure_block is not None:
+                    # A block of sites can be outside the hazard area.
+                    # The block is skipped, and the run only stops if
+                    # no block has sites in the hazard area.
+                    block_sites['sites'] += context.exposure_lat.size
+                    block_sites['msg'] = msg
+                    if context.exposure_lat.size == 0:
+                        return
+                elif context.exposure_lat.size == 0:
+                    raise RuntimeError(msg)
+
+            file_data, _ = raster_module.files_raster_data_at_points(
                 context.exposure_long,
-                context.exposure_lat, file_list)
-            file_data = np.where(file_data == no_data_value, np.NAN,
-                                 file_data)
+                context.exposure_lat, file_list, read_mode=read_mode,
+                block_cache_bytes=block_cache_bytes, workers=workers,
+                pixel_cache=pixel_cache, bands=bands, reduction=reduction,
+                threshold=threshold, time_step=time_step)
+            # The no data values of the files are NAN in the sampled
+            # data. Also remove any no data value given here.
+            if no_data_value is not None:
+                file_data[file_data == no_data_value] = np.NAN
             context.exposure_att[attribute_label] = file_data
 
-            if clip_exposure2all_hazards:
-                # Clipping the exposure points after the data has been added.
-                # Not optimised for speed, but easy to implement.
-                context.clip_exposure(*extent)
+
+def _hazard_prov(context, file_list, file_format=None, variable=None):
+    """
+    Add the provenance of the hazard files.
+
+    :param context: The context instance, used to move data around.
+    :param file_list: A list of the hazard files.
+    :param file_format: The format of the files, e.g. 'nc'.
+    :param variable: The NetCDF variable loaded, for 'nc' files.
+    """
+    for f in file_list:
+        f = misc.download_file_from_s3_if_needed(f)
+        dt = misc.get_file_mtime(f)
+        atts = {"dcterms:title": "Source hazard data",
+                "prov:type": "prov:Dataset",
+                "prov:atLocation": os.path.basename(f),
+                "prov:format": os.path.splitext(f)[1].replace('.', ''),
+                "prov:generatedAtTime": dt, }
+        if file_format == 'nc' and variable:
+            atts['prov:variable'] = variable
+        hazent = context.prov.entity(":Hazard data", atts)
+        context.prov.used(context.provlabel, hazent)
+
+
+def _start_hazard_blocks(context, file_list, file_format=None,
+                         variable=None):
+    """
+    Start loading hazard files a block of sites at a time.
+
+    :returns: The (block_sites, finish) of the blocks. block_sites
+        counts the sites in the hazard area, and finish raises an
+        error if no block has any. See Context.get_block_result.
+    """
+    _hazard_prov(context, file_list, file_format, variable)
+
+    def finish(block_sites):
+        if block_sites['msg'] is not None and block_sites['sites'] == 0:
+            raise RuntimeError(block_sites['msg'])
+    return {'sites': 0, 'msg': None}, finish
 
 
 class AggregateLoss(Job):
@@ -709,6 +1061,7 @@ class AggregateLoss(Job):
     def __init__(self):
         super(AggregateLoss, self).__init__()
         self.call_funct = AGGREGATE_LOSS
+        self.block_mode = ALL_BLOCKS
 
     def __call__(self, context, groupby=None, kwargs=None):
         """
@@ -721,6 +1074,13 @@ class AggregateLoss(Job):
         """
         context.aggregate_loss(groupby, kwargs)
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The groupby columns and the columns aggregated.
+        """
+        return (_column_list(atts.get('groupby')) +
+                list(atts.get('kwargs') or {}))
+
 
 class SaveExposure(Job):
 
@@ -731,15 +1091,30 @@ class SaveExposure(Job):
     def __init__(self):
         super(SaveExposure, self).__init__()
         self.call_funct = SAVEALL
+        self.broadcasts_const = True
+        self.block_mode = ALL_BLOCKS
 
-    def __call__(self, context, file_name=None, use_parallel=True):
+    def __call__(self, context, file_name=None, use_parallel=True,
+                 compression=None, columns=None):
         """
         Save all of the exposure information in the context.
 
         :param context: The context instance, used to move data around.
         :params file_name: The file where the expsoure data will go.
+        :param compression: Optional. The compression of a parquet or
+            feather file, e.g. 'zstd'.
+        :param columns: Optional. A list of the columns saved, as well
+            as the latitude and longitude. All columns are saved if
+            this is None.
         """
-        context.save_exposure_atts(file_name, use_parallel=use_parallel)
+        context.save_exposure_atts(file_name, use_parallel=use_parallel,
+                                   compression=compression, columns=columns)
+
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The columns saved.
+        """
+        return _column_list(atts.get('columns'))
 
 
 class SaveAggregation(Job):
@@ -747,16 +1122,21 @@ class SaveAggregation(Job):
     def __init__(self):
         super(SaveAggregation, self).__init__()
         self.call_funct = SAVEAGG
+        self.block_mode = AFTER_BLOCKS
 
-    def __call__(self, context, file_name=None,  use_parallel=True):
+    def __call__(self, context, file_name=None,  use_parallel=True,
+                 compression=None):
         """
         Save all of the aggregated exposure information in the context.
 
         :param context: The context instance, used to move data around.
         :params file_name: The file where the expsoure data will go.
+        :param compression: Optional. The compression of a parquet or
+            feather file, e.g. 'zstd'.
         """
         context.save_exposure_aggregation(file_name,
-                                          use_parallel=use_parallel)
+                                          use_parallel=use_parallel,
+                                          compression=compression)
 
 
 class Aggregate(Job):
@@ -764,6 +1144,7 @@ class Aggregate(Job):
     def __init__(self):
         super(Aggregate, self).__init__()
         self.call_funct = AGGREGATE
+        self.block_mode = ALL_BLOCKS
 
     def __call__(self, context, file_name=None, boundaries=None,
                  impactcode=None, boundarycode=None, use_parallel=True):
@@ -773,23 +1154,42 @@ class Aggregate(Job):
                                  boundarycode,
                                  use_parallel=use_parallel)
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The impact code column and the columns aggregated.
+        """
+        return (_column_list(atts.get('impactcode')) +
+                list(misc.CHOROPLETH_REPORT))
+
 
 class Tabulate(Job):
 
     def __init__(self):
         super(Tabulate, self).__init__()
         self.call_funct = TABULATE
+        self.block_mode = ALL_BLOCKS
 
     def __call__(self, context, file_name=None, index=None,
                  columns=None, aggfunc=None, use_parallel=True):
         context.tabulate(file_name, index, columns, aggfunc)
 
+    def get_exposure_columns(self, atts):
+        """
+        :returns: The index, columns and aggregated columns of the table.
+        """
+        columns = (_column_list(atts.get('index')) +
+                   _column_list(atts.get('columns')))
+        if isinstance(atts.get('aggfunc'), dict):
+            columns += list(atts['aggfunc'])
+        return columns
+
 
 class Categorise(Job):
 
     def __init__(self):
         super(Categorise, self).__init__()
         self.call_funct = CATEGORISE
+        self.block_mode = EACH_BLOCK
 
     def __call__(self, context, bins=None, labels=None, field_name=None):
         context.categorise(bins, labels, field_name)
@@ -800,6 +1200,8 @@ class SaveProvenance(Job):
     def __init__(self):
         super(SaveProvenance, self).__init__()
         self.call_funct = SAVEPROVENANCE
+        self.broadcasts_const = True
+        self.block_mode = AFTER_BLOCKS
 
 
     def __call__(self, context, file_name=None):
@@ -33,6 +33,7 @@ import unittest
 import tempfile
 import os
 import numpy
+import pandas
 
 from scipy import allclose, asarray, isnan, array, rollaxis
 
@@ -52,6 +53,13 @@ class Dummy(object):
     Dummy class for testing
     """
 
+    # The exposure data methods of the context
+    get_exposure_column = context.Context.get_exposure_column
+    is_exposure_const = context.Context.is_exposure_const
+    set_exposure_const = context.Context.set_exposure_const
+    set_exposure_column = context.Context.set_exposure_column
+    materialize_exposure_const = context.Context.materialize_exposure_const
+
     def __init__(self, site_shape=None):
         # For test_SimpleLinker
         self.vul_function_titles = {}
@@ -59,6 +67,7 @@ class Dummy(object):
         # For test_SelectVulnFunction
         self.vulnerability_sets = {}
         self.exposure_att = {}
+        self.exposure_const = {}
         self.site_shape = site_shape
 
     def get_site_shape(self):
@@ -77,7 +86,8 @@ class DummyVulnSet(object):
         self.vuln_set = vuln_set
 
     def build_realised_vuln_curves(self, vuln_function_ids,
-                                   variability_method):
+                                   variability_method, seed=None,
+                                   realisations=None, asset_ids=None):
         """For test_SimpleLinker
         """
 
@@ -106,7 +116,10 @@ class TestJobs(unittest.TestCase):
         con_in.exposure_att = {'a_test': 5, 'b_test': 20}
         test_kwargs = {'var': 'c_test', 'value': 25}
         inst(con_in, **test_kwargs)
-        self.assertEqual(con_in.exposure_att['c_test'], 25)
+        self.assertEqual(con_in.get_exposure_column('c_test'), 25)
+        # The constant is not expanded to the sites
+        self.assertTrue(con_in.is_exposure_const('c_test'))
+        self.assertNotIn('c_test', con_in.exposure_att)
 
     def test_const2(self):
         inst = JOBS[CONSTANT]
@@ -114,7 +127,7 @@ class TestJobs(unittest.TestCase):
         con_in.exposure_att = {'a_test': 5, 'b_test': 20}
         test_kwargs = {'var': 'c_test', 'value': 'yeah'}
         inst(con_in, **test_kwargs)
-        self.assertEqual(con_in.exposure_att['c_test'], 'yeah')
+        self.assertEqual(con_in.get_exposure_column('c_test'), 'yeah')
 
     def test_const3(self):
         inst = JOBS[CONSTANT]
@@ -123,8 +136,12 @@ class TestJobs(unittest.TestCase):
                                'b_test': numpy.array([2, 40])}
         test_kwargs = {'var': 'c_test', 'value': 35}
         inst(con_in, **test_kwargs)
+        self.assertTrue(allclose(con_in.get_exposure_column('c_test'),
+                                 asarray([35, 35])))
+        con_in.materialize_exposure_const()
         self.assertTrue(allclose(con_in.exposure_att['c_test'],
                                  asarray([35, 35])))
+        self.assertEqual(con_in.exposure_const, {})
 
     def test_const4(self):
         # Just make sure it does the adding right.
@@ -134,6 +151,7 @@ class TestJobs(unittest.TestCase):
                                'b_test': numpy.array([2, 40])}
         test_kwargs = {'var': 'c_test', 'value': 'yeah'}
         inst(con_in, **test_kwargs)
+        con_in.materialize_exposure_const()
         # print "con_in.exposure_att['c_test']", con_in.exposure_att['c_test']
         # This fails
         self.assertEqual(con_in.exposure_att['c_test'].tolist(),
@@ -239,6 +257,22 @@ class TestJobs(unittest.TestCase):
         self.assertTrue(allclose(con_in.exposure_att['c_test'],
                                  asarray([40, 800])))
 
+    def test_Mult_const(self):
+        inst_const = JOBS[CONSTANT]
+        inst_mult = JOBS[MULT]
+        con_in = Dummy(site_shape=(2,))
+        con_in.exposure_att = {'b_test': numpy.array([2, 40])}
+        inst_const(con_in, var='a_test', value=20)
+        inst_const(con_in, var='c_test', value=3)
+        inst_mult(con_in, var1='a_test', var2='c_test', var_out='d_test')
+        # Constants multiply to a constant
+        self.assertTrue(con_in.is_exposure_const('d_test'))
+        self.assertEqual(con_in.get_exposure_column('d_test'), 60)
+        inst_mult(con_in, var1='d_test', var2='b_test', var_out='e_test')
+        self.assertFalse(con_in.is_exposure_const('e_test'))
+        self.assertTrue(allclose(con_in.exposure_att['e_test'],
+                                 asarray([120, 2400])))
+
     def test_MultII(self):
         inst_add = JOBS[MULT]
         con_in = Dummy(site_shape=(2,))
@@ -328,6 +362,45 @@ class TestJobs(unittest.TestCase):
                                          asarray([6.0])))
         os.remove(f.name)
 
+    def test_load_csv_exposure_usecols(self):
+        f = tempfile.NamedTemporaryFile(
+            suffix='.txt',
+            prefix='HAZIMPtest_jobs',
+            delete=False,
+            mode='w+t')
+        f.write('LAT, LONG, Z, A, B\n')
+        f.write('1., 2., 3., a, 10\n')
+        f.write('4., 5., 6., b, 20\n')
+        f.close()
+
+        inst = JOBS[LOADCSVEXPOSURE]
+        con_in = context.Context()
+        con_in.set_prov_label('test label')
+        # The latitude and longitude are always loaded,
+        # and missing columns are ignored.
+        inst(con_in, file_name=f.name, exposure_latitude='LAT',
+             exposure_longitude='LONG', usecols=['Z', 'B', 'missing'],
+             use_parallel=False)
+        os.remove(f.name)
+        self.assertEqual(sorted(con_in.exposure_att),
+                         ['B', 'Z', misc.INTID])
+        self.assertTrue(allclose(con_in.exposure_lat, [1., 4.]))
+        self.assertTrue(allclose(con_in.exposure_att['B'], [10, 20]))
+
+        f = tempfile.NamedTemporaryFile(suffix='.csv',
+                                        prefix='HAZIMPtest_jobs',
+                                        delete=False)
+        f.close()
+        JOBS[SAVEALL](con_in, file_name=f.name, use_parallel=False,
+                      columns=['B'])
+        exp_dict = misc.csv2dict(f.name)
+        os.remove(f.name)
+        self.assertEqual(sorted(exp_dict),
+                         ['B', context.EX_LAT, context.EX_LONG])
+        self.assertRaises(RuntimeError, JOBS[SAVEALL], con_in,
+                          file_name=f.name, use_parallel=False,
+                          columns=['missing'])
+
     def test_load_vuln_set(self):
         # Write a file to test
         filename = build_example()
@@ -524,7 +597,9 @@ class TestJobs(unittest.TestCase):
         inst = JOBS[LOADRASTER]
         test_kwargs = {'file_list': [f.name], 'attribute_label': haz_v,
                        'clip_exposure2all_hazards': True}
-        inst(con_in, **test_kwargs)
+        # No exposure points are in the hazard area, so it stops before
+        # the hazard data is read
+        self.assertRaises(RuntimeError, inst, con_in, **test_kwargs)
 
         # There should be only no exposure points
         expected = 0
@@ -532,6 +607,7 @@ class TestJobs(unittest.TestCase):
         msg += str(len(con_in.exposure_att['ID']))
         msg += "\n Expected " + str(expected)
         self.assertTrue(len(con_in.exposure_att['ID']) == expected, msg)
+        self.assertFalse(haz_v in con_in.exposure_att)
         os.remove(f.name)
 
     def test_load_raster_clippingIII(self):
@@ -578,8 +654,127 @@ class TestJobs(unittest.TestCase):
         self.assertTrue(len(con_in.exposure_att['ID']) == expected, msg)
 
     def test_look_up(self):
-        pass
-        # FIXME Needs test.
+        filename = build_example()
+        vuln_sets = jobs.vuln_sets_from_xml_file(filename)
+        os.remove(filename)
+
+        con_in = Dummy()
+        con_in.vulnerability_sets = vuln_sets
+        con_in.vul_function_titles = {'PAGER': 'ID'}
+        con_in.exposure_att = pandas.DataFrame(
+            {'ID': ['IR', 'PK', 'IR'],
+             'MMI': [7.0, 8.5, numpy.NAN]})
+        inst = JOBS[jobs.SELECTVULNFUNCTION]
+        inst(con_in, variability_method={'PAGER': 'mean'})
+        inst = JOBS[jobs.LOOKUP]
+        inst(con_in)
+        self.assertTrue(allclose(con_in.exposure_att['feathers'],
+                                 [0.01, 0.19, 0.]))
+
+        # Sampling several realisations gives the mean and sd per asset
+        inst = JOBS[jobs.SELECTVULNFUNCTION]
+        inst(con_in, variability_method={'PAGER': 'random'}, seed=1,
+             realisations=10000)
+        inst = JOBS[jobs.LOOKUP]
+        inst(con_in, keep_realisations=False)
+        self.assertTrue(allclose(con_in.exposure_att['feathers'],
+                                 [0.01, 0.19, 0.], rtol=0.02))
+        self.assertTrue(allclose(con_in.exposure_att['feathers_sd'],
+                                 [0.003, 0.076, 0.], rtol=0.05))
+        self.assertNotIn('feathers_000000', con_in.exposure_att)
+
+        # The loss of each realisation is kept
+        inst = JOBS[jobs.SELECTVULNFUNCTION]
+        inst(con_in, variability_method={'PAGER': 'random'}, seed=1,
+             realisations=20)
+        inst = JOBS[jobs.LOOKUP]
+        inst(con_in)
+        realisations = ['feathers_{0:06d}'.format(n) for n in range(20)]
+        self.assertNotIn('feathers_000020', con_in.exposure_att)
+        losses = con_in.exposure_att[realisations].values
+        self.assertTrue(allclose(losses.mean(axis=1),
+                                 con_in.exposure_att['feathers']))
+        self.assertTrue(allclose(losses.std(axis=1),
+                                 con_in.exposure_att['feathers_sd']))
+        self.assertTrue(losses[:2].std(axis=1).min() > 0.)
+
+    def test_look_up_blocks_seed(self):
+        filename = build_example()
+        vuln_sets = jobs.vuln_sets_from_xml_file(filename)
+        os.remove(filename)
+
+        exposure = pandas.DataFrame(
+            {'ID': ['IR', 'PK', 'IR', 'PK', 'PK'],
+             'MMI': [7.0, 8.5, 9.0, 6.5, 8.0],
+             misc.INTID: numpy.arange(5)})
+        losses = []
+        for blocks in [[slice(0, 5)], [slice(0, 2), slice(2, 4),
+                                       slice(4, 5)]]:
+            loss = []
+            for block in blocks:
+                con_in = Dummy()
+                con_in.vulnerability_sets = vuln_sets
+                con_in.vul_function_titles = {'PAGER': 'ID'}
+                con_in.exposure_att = exposure[block].copy()
+                inst = JOBS[jobs.SELECTVULNFUNCTION]
+                inst(con_in, variability_method={'PAGER': 'random'}, seed=7,
+                     realisations=3)
+                inst = JOBS[jobs.LOOKUP]
+                inst(con_in)
+                loss.extend(con_in.exposure_att['feathers'])
+            losses.append(loss)
+
+        # The seeded losses do not depend on the blocks of sites
+        numpy.testing.assert_array_equal(losses[0], losses[1])
+
+    def test_PermutateExposure(self):
+        filename = build_example()
+        vuln_sets = jobs.vuln_sets_from_xml_file(filename)
+        os.remove(filename)
+
+        con_in = Dummy()
+        con_in.vulnerability_sets = vuln_sets
+        con_in.vul_function_titles = {'PAGER': 'ID'}
+        con_in.exposure_att = pandas.DataFrame(
+            {'ID': ['IR', 'PK', 'IR', 'PK'],
+             'region': ['A', 'B', 'A', 'B'],
+             'MMI': [6.0, 6.0, 8.5, 8.5]})
+        inst = JOBS[jobs.SELECTVULNFUNCTION]
+        inst(con_in, variability_method={'PAGER': 'mean'})
+
+        # Each region only has one vulnerability function,
+        # so permutating within regions does not change the loss.
+        inst = JOBS[jobs.PERMUTATE_EXPOSURE]
+        inst(con_in, groupby='region', iterations=3)
+        actual = asarray([0.005, 0.01, 0.185, 0.19])
+        self.assertTrue(allclose(con_in.exposure_att['feathers'], actual))
+        self.assertTrue(allclose(con_in.exposure_att['feathers_sd'], 0.))
+        self.assertTrue(allclose(con_in.exposure_att['feathers_000002'],
+                                 actual))
+        self.assertEqual(list(con_in.exposure_att['ID_000002']),
+                         ['IR', 'PK', 'IR', 'PK'])
+
+        # Several realisations per asset can be averaged
+        inst = JOBS[jobs.SELECTVULNFUNCTION]
+        inst(con_in, variability_method={'PAGER': 'random'}, seed=1,
+             realisations=10000)
+        inst = JOBS[jobs.PERMUTATE_EXPOSURE]
+        inst(con_in, groupby='region', iterations=2, keep_realisations=False)
+        self.assertTrue(allclose(con_in.exposure_att['feathers'], actual,
+                                 rtol=0.05))
+        self.assertTrue(allclose(con_in.exposure_att['feathers_sd'], 0.))
+
+        # Or each iteration samples a realisation
+        inst = JOBS[jobs.SELECTVULNFUNCTION]
+        inst(con_in, variability_method={'PAGER': 'random'}, seed=1,
+             realisations=300)
+        inst = JOBS[jobs.PERMUTATE_EXPOSURE]
+        inst(con_in, groupby='region', iterations=300)
+        self.assertTrue(allclose(con_in.exposure_att['feathers'], actual,
+                                 rtol=0.1))
+        # cv of IR is 0.3 and PK is 0.4
+        self.assertTrue(allclose(con_in.exposure_att['feathers_sd'],
+                                 actual * [0.3, 0.4, 0.3, 0.4], rtol=0.2))
 
     def test_LoadCsvExposure(self):
         # Write a file to test
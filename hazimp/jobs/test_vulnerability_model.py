@@ -26,10 +26,12 @@ import unittest
 import tempfile
 import os
 import numpy
-from scipy import asarray, allclose
+import pandas
+from scipy import asarray, allclose, interp
 
 from hazimp.jobs.vulnerability_model import vuln_sets_from_xml_file, \
-    RealisedVulnerabilityCurves
+    RealisedVulnerabilityCurves, interp_per_asset, \
+    lazy_vuln_sets_from_xml_file, sample_loss_ratios, asset_standard_normal
 
 
 def build_example():
@@ -205,6 +207,263 @@ class TestVulnerabilityFunction(unittest.TestCase):
         self.assertTrue(allclose(loss,
                                  asarray([0.5, 10.0])), 'got ' + str(loss))
 
+    def test_build_realised_vuln_curves(self):
+        filename = build_example()
+        vuln_sets = vuln_sets_from_xml_file(filename)
+        os.remove(filename)
+
+        vuln_set = vuln_sets["PAGER"]
+        ids = ['PK', 'IR', 'PK', 'PK', 'IR']
+        rvc = vuln_set.build_realised_vuln_curves(ids)
+
+        # One curve per vulnerability function, not per asset
+        self.assertEqual(rvc.loss_curves.shape, (2, 3))
+        self.assertEqual(rvc.curve_index.dtype, numpy.uint8)
+        self.assertEqual(rvc.get_asset_count(), 5)
+        actual = asarray([vuln_set.vulnerability_functions[key].mean_loss
+                          for key in ids])
+        self.assertTrue(allclose(rvc.loss_per_asset, actual))
+
+        intensities = asarray([6.0, 6.0, 8.5, numpy.NAN, 12.0])
+        loss = rvc.look_up(intensities)
+        self.assertTrue(allclose(loss, asarray([0.01, 0.005, 0.19, 0.,
+                                                0.36])), 'got ' + str(loss))
+
+        # Reassign the curves to the assets
+        rvc2 = rvc.reindex(['IR', 'IR', 'PK', 'IR', 'PK'])
+        self.assertIs(rvc2.loss_curves, rvc.loss_curves)
+        loss = rvc2.look_up(intensities)
+        self.assertTrue(allclose(loss, asarray([0.005, 0.005, 0.19, 0.,
+                                                0.36])), 'got ' + str(loss))
+
+        # Categorical IDs are linked using their codes. The categories
+        # that are not used don't need a vulnerability function.
+        cat_ids = pandas.Series(ids, dtype=pandas.CategoricalDtype(
+            ['XX', 'PK', 'IR']))
+        rvc3 = vuln_set.build_realised_vuln_curves(cat_ids)
+        self.assertEqual(list(rvc3.function_ids), ['PK', 'IR'])
+        self.assertTrue(allclose(rvc3.loss_per_asset, actual))
+        rvc4 = rvc.reindex(pandas.Categorical(['IR', 'IR', 'PK', 'IR', 'PK']))
+        self.assertTrue(allclose(rvc4.look_up(intensities),
+                                 rvc2.look_up(intensities)))
+
+        self.assertRaises(NotImplementedError, rvc.reindex, ['IR', 'XX'])
+        self.assertRaises(NotImplementedError,
+                          vuln_set.build_realised_vuln_curves, ['IR', 'XX'])
+        self.assertRaises(NotImplementedError,
+                          vuln_set.build_realised_vuln_curves,
+                          ['IR', numpy.NAN])
+
+    def test_interp_per_asset(self):
+        # Compare against interpolating one asset at a time
+        intensity_measure_level = asarray([17.0, 20.0, 30.0, 45.0, 60.0])
+        rng = numpy.random.RandomState(42)
+        loss_per_asset = numpy.sort(rng.uniform(size=(50, 5)), axis=1)
+
+        intensities = rng.uniform(0., 80., size=(50, 3))
+        intensities[::7, 1] = numpy.NAN
+        intensities[3, 0] = 30.0
+        intensities[4, 0] = 60.0
+        intensities[5, 0] = 17.0
+
+        for intensity in [intensities, intensities[:, 0]]:
+            loss = interp_per_asset(intensity, intensity_measure_level,
+                                    loss_per_asset)
+            self.assertEqual(loss.shape, intensity.shape)
+            for asset in range(loss_per_asset.shape[0]):
+                actual = interp(intensity[asset], intensity_measure_level,
+                                loss_per_asset[asset])
+                numpy.testing.assert_array_equal(loss[asset], actual)
+
+    def test_lazy_vuln_sets(self):
+        filename = build_example()
+        vuln_sets = lazy_vuln_sets_from_xml_file(filename, use_cache=False)
+        self.assertEqual(sorted(vuln_sets), ['NPAGER', 'PAGER'])
+        self.assertEqual(vuln_sets['PAGER'].function_ids, ['IR', 'PK'])
+
+        # Only the functions used are loaded
+        loaded = []
+
+        def load_funct(**kwargs):
+            loaded.append(kwargs)
+            return vuln_sets_from_xml_file(filename, **kwargs)
+        vuln_set = vuln_sets['PAGER']
+        vuln_set._load_funct = load_funct
+        curves = vuln_set.build_realised_vuln_curves(['PK', 'PK'])
+        self.assertEqual(loaded, [{'set_ids': ['PAGER'],
+                                   'function_ids': ['PK']}])
+        self.assertTrue(allclose(curves.look_up(asarray([7.0, 10.0])),
+                                 [0.02, 0.36]))
+        self.assertRaises(NotImplementedError,
+                          vuln_set.build_realised_vuln_curves, ['PK', 'XX'])
+
+        # The functions loaded are kept, and only new ones are loaded
+        vuln_set.build_realised_vuln_curves(['PK'])
+        self.assertEqual(len(loaded), 1)
+        curves = vuln_set.build_realised_vuln_curves(['IR', 'PK'])
+        self.assertEqual(loaded[-1], {'set_ids': ['PAGER'],
+                                      'function_ids': ['IR']})
+        self.assertTrue(allclose(curves.look_up(asarray([7.0, 10.0])),
+                                 [0.01, 0.36]))
+        vuln_set.build_realised_vuln_curves(['PK', 'IR'])
+        self.assertEqual(len(loaded), 2)
+
+        # Using the set in any other way loads all of it
+        self.assertEqual(vuln_set.intensity_measure_type, 'MMI')
+        self.assertEqual(sorted(vuln_set.vulnerability_functions),
+                         ['IR', 'PK'])
+        self.assertEqual(loaded[-1], {'set_ids': ['PAGER'],
+                                      'function_ids': None})
+        os.remove(filename)
+
+    def test_vuln_sets_from_xml_file_filter(self):
+        filename = build_example()
+        vuln_sets = vuln_sets_from_xml_file(filename, set_ids=['NPAGER'],
+                                            function_ids=['BB'])
+        os.remove(filename)
+        self.assertEqual(list(vuln_sets), ['NPAGER'])
+        self.assertEqual(list(vuln_sets['NPAGER'].vulnerability_functions),
+                         ['BB'])
+        self.assertTrue(allclose(vuln_sets['NPAGER'].intensity_measure_level,
+                                 [6.0, 8.0, 11.0]))
+
+    def test_sample_loss_ratios(self):
+        mean_loss = asarray([0.2, 0.2, 0.0, numpy.NAN])
+        cv = asarray([0.1, 0.1, 0.5, 0.5])
+        distribution = asarray(['N', 'LN', 'LN', 'N'])
+        samples = sample_loss_ratios(mean_loss, cv, distribution,
+                                     realisations=20000, seed=42)
+        self.assertEqual(samples.shape, (4, 20000))
+        self.assertTrue(allclose(samples[:2].mean(axis=1), 0.2, rtol=0.01))
+        self.assertTrue(allclose(samples[:2].std(axis=1), 0.02, rtol=0.05))
+        self.assertTrue((samples[2] == 0.).all())
+        self.assertTrue(numpy.isnan(samples[3]).all())
+
+        # The seed gives the same samples, whatever the chunk size
+        actual = sample_loss_ratios(mean_loss, cv, distribution,
+                                    realisations=20000, seed=42,
+                                    chunk_size=3)
+        numpy.testing.assert_array_equal(actual, samples)
+
+        # With asset ids the samples of an asset only depend on its id
+        samples = sample_loss_ratios(mean_loss, cv, distribution,
+                                     realisations=20000, seed=42,
+                                     asset_ids=asarray([5, 6, 7, 8]))
+        self.assertTrue(allclose(samples[:2].mean(axis=1), 0.2, rtol=0.01))
+        self.assertTrue(allclose(samples[:2].std(axis=1), 0.02, rtol=0.05))
+        actual = sample_loss_ratios(mean_loss[1:3], cv[1:3],
+                                    distribution[1:3], realisations=20000,
+                                    seed=42, asset_ids=asarray([6, 7]),
+                                    chunk_size=1)
+        numpy.testing.assert_array_equal(actual, samples[1:3])
+        actual = sample_loss_ratios(mean_loss, cv, distribution,
+                                    realisations=20000, seed=43,
+                                    asset_ids=asarray([5, 6, 7, 8]))
+        self.assertFalse((actual[:2] == samples[:2]).any())
+
+        # The samples are clipped to the ratio bounds
+        samples = sample_loss_ratios(asarray([0.9, 0.1]), 1.0, 'N',
+                                     realisations=1000, seed=1)
+        self.assertTrue((samples >= 0.).all())
+        self.assertTrue((samples <= 1.).all())
+        self.assertTrue((samples == 1.).any())
+        self.assertTrue((samples == 0.).any())
+
+        # No realisations dimension
+        samples = sample_loss_ratios(asarray([[0.1, 0.2]]), 0.1, 'LN')
+        self.assertEqual(samples.shape, (1, 2))
+
+        self.assertRaises(RuntimeError, sample_loss_ratios,
+                          mean_loss, cv, 'WEIBULL')
+
+    def test_asset_standard_normal(self):
+        normal = asset_standard_normal(1, asarray([0, 1, 2]), (3, 2, 50000))
+        self.assertEqual(normal.shape, (3, 2, 50000))
+        self.assertTrue(allclose(normal.mean(axis=-1), 0., atol=0.02))
+        self.assertTrue(allclose(normal.std(axis=-1), 1., atol=0.02))
+        # The numbers of an asset do not depend on the other assets
+        numpy.testing.assert_array_equal(
+            asset_standard_normal(1, asarray([2]), (1, 2, 50000)),
+            normal[2:])
+        self.assertFalse((normal[0] == normal[1]).any())
+
+    def test_build_realised_vuln_curves_random(self):
+        filename = build_example()
+        vuln_set = vuln_sets_from_xml_file(filename)['PAGER']
+        os.remove(filename)
+
+        intensity = asarray([7.0, 8.5, numpy.NAN])
+        mean_curves = vuln_set.build_realised_vuln_curves(
+            ['IR', 'PK', 'PK'], variability_method='mean')
+        curves = vuln_set.build_realised_vuln_curves(
+            ['IR', 'PK', 'PK'], variability_method='random', seed=3,
+            realisations=10000)
+        loss = curves.look_up(intensity)
+        self.assertEqual(loss.shape, (3, 10000))
+        mean_loss = mean_curves.look_up(intensity)
+        self.assertTrue(allclose(loss[:2].mean(axis=1), mean_loss[:2],
+                                 rtol=0.02))
+        # cv of IR is 0.3 and PK is 0.4
+        self.assertTrue(allclose(loss[:2].std(axis=1),
+                                 mean_loss[:2] * [0.3, 0.4], rtol=0.05))
+        self.assertTrue((loss[2] == vuln_set.default_loss).all())
+
+        # The sampling settings are kept when the curves are reassigned
+        numpy.testing.assert_array_equal(
+            curves.reindex(['IR', 'PK', 'PK']).look_up(intensity), loss)
+
+        # One realisation per asset
+        curves = vuln_set.build_realised_vuln_curves(
+            ['IR', 'PK'], variability_method='random', seed=3)
+        self.assertEqual(curves.look_up(asarray([7.0, 8.5])).shape, (2,))
+
+    def test_calc_mean_and_sample(self):
+        filename = build_example()
+        vuln_set = vuln_sets_from_xml_file(filename)['PAGER']
+        os.remove(filename)
+
+        mean_loss, sigma = vuln_set.calc_mean('PK', asarray([7.0, 8.5]))
+        self.assertTrue(allclose(mean_loss, [0.02, 0.19]))
+        self.assertTrue(allclose(sigma, [0.008, 0.076]))
+        samples = vuln_set.sample('PK', mean_loss, sigma,
+                                  realisations=20000, seed=0)
+        self.assertEqual(samples.shape, (2, 20000))
+        self.assertTrue(allclose(samples.mean(axis=1), mean_loss,
+                                 rtol=0.02))
+
+    def test_tabulate(self):
+        filename = build_example()
+        vuln_set = vuln_sets_from_xml_file(filename)['PAGER']
+        os.remove(filename)
+        rng = numpy.random.RandomState(7)
+        function_ids = rng.choice(['IR', 'PK'], size=200)
+        intensity = rng.uniform(4.0, 11.0, size=(200, 30))
+        intensity[::9, 3] = numpy.NAN
+        curves = vuln_set.build_realised_vuln_curves(function_ids)
+        expected = curves.look_up(intensity)
+
+        # The error is within the documented bound
+        error = curves.tabulate(0.01)
+        self.assertAlmostEqual(error, 0.5 * 0.01 * 0.35 / 3.0)
+        actual = curves.look_up(intensity)
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertTrue(numpy.isnan(actual).sum() == 0)
+        self.assertTrue(numpy.abs(actual - expected).max() <= error + 1e-12)
+        self.assertTrue(numpy.abs(actual - expected).max() > 0.)
+
+        # The table is kept by reindex
+        reindexed = curves.reindex(function_ids)
+        numpy.testing.assert_array_equal(reindexed.look_up(intensity),
+                                         actual)
+
+        # Intensities outside of the table range are interpolated
+        curves.tabulate(0.5, intensity_range=(6.0, 8.0))
+        actual = curves.look_up(intensity)
+        outside = (intensity < 5.75) | (intensity >= 8.25)
+        numpy.testing.assert_array_equal(actual[outside], expected[outside])
+        self.assertTrue(numpy.abs(actual - expected).max() <=
+                        curves.lookup_error + 1e-12)
+
 
 # -----------------------------------------------------------
 if __name__ == "__main__":
@@ -25,22 +25,49 @@
 """
 
 import os
+import copy
+import json
+import logging
+import functools
+from xml.etree import ElementTree
+
 import numpy
+import pandas
+
+from scipy import asarray, interp, where
+from scipy.special import ndtri
 
-from scipy import asarray, interp, where, zeros
+from hazimp import cache
 
-from hazimp.xml_interface import XmlLayer
+LOGGER = logging.getLogger(__name__)
 
 DEFAULTLOSS = 0
 
+# The probabilistic distributions of the vulnerability functions
+DISTRIBUTIONS = {'N': 'normal', 'LN': 'lognormal'}
+
+# The number of assets sampled at a time
+SAMPLE_CHUNK_SIZE = 10000
+
+# Increase this when a change to the parser changes the loaded curves,
+# so files compiled by an older parser are not used.
+PARSER_VERSION = 1
+
 
-def vuln_sets_from_xml_file(filename):
+def vuln_sets_from_xml_file(filename, set_ids=None, function_ids=None):
     """
     Load a GEM NRML vulnerability file in the format described in
     resources/nrml/schema/risk/vulnerability.xsd
 
+    The file is parsed incrementally, so only one vulnerability
+    function is held as xml at a time.
+
     Args:
     :param filename: The file name of the xml file.
+    :param set_ids: Optional. Only load the vulnerability sets with
+        these ID's.
+    :param function_ids: Optional. Only load the vulnerability functions
+        with these ID's.
 
     :returns: A dictionary of Vulnerability Sets.
     """
@@ -52,8 +79,262 @@ def vuln_sets_from_xml_file(filename):
     if not os.path.exists(filename):
         raise RuntimeError("No vulnerability XML was loaded." +
                            " Check file name " + filename)
-    xml_node = XmlLayer(filename=filename)
-    return vuln_sets_from_xml_node(xml_node)
+    if set_ids is not None:
+        set_ids = set(set_ids)
+    if function_ids is not None:
+        function_ids = set(function_ids)
+
+    vuln_sets = {}
+    vulnerability_functions = {}
+    iml = None
+    skip_set = False
+    for event, elem in ElementTree.iterparse(filename,
+                                             events=('start', 'end')):
+        tag = _local_name(elem.tag)
+        if event == 'start':
+            if tag == 'discreteVulnerabilitySet':
+                skip_set = (set_ids is not None and
+                            elem.attrib['vulnerabilitySetID'] not in set_ids)
+        elif tag == 'IML':
+            iml = elem
+        elif tag == 'discreteVulnerability':
+            func_id = elem.attrib['vulnerabilityFunctionID']
+            if not skip_set and (function_ids is None or
+                                 func_id in function_ids):
+                vuln_funct = VulnerabilityFunction.from_xml_element(elem)
+                vulnerability_functions[func_id] = vuln_funct
+            elem.clear()
+        elif tag == 'discreteVulnerabilitySet':
+            vuln_set_id = elem.attrib['vulnerabilitySetID']
+            if not skip_set:
+                vuln_sets[vuln_set_id] = VulnerabilitySet(
+                    _text_to_array(iml.text),
+                    iml.attrib['IMT'],
+                    vuln_set_id,
+                    elem.attrib['assetCategory'],
+                    elem.attrib['lossCategory'],
+                    vulnerability_functions,
+                    elem.attrib.get('defaultLoss', DEFAULTLOSS))
+            vulnerability_functions = {}
+            iml = None
+            elem.clear()
+    return vuln_sets
+
+
+def index_vuln_xml_file(filename):
+    """
+    Find the vulnerability sets and function ID's in a vulnerability
+    file, without loading the curves.
+
+    :param filename: The file name of the xml file.
+
+    :returns: A dictionary. The key is the vulnerability set ID, the
+        value is a list of the function ID's in the set.
+    """
+    if not os.path.exists(filename):
+        raise RuntimeError("No vulnerability XML was loaded." +
+                           " Check file name " + filename)
+    index = {}
+    function_ids = []
+    for event, elem in ElementTree.iterparse(filename,
+                                             events=('start', 'end')):
+        tag = _local_name(elem.tag)
+        if event == 'start':
+            if tag == 'discreteVulnerabilitySet':
+                function_ids = []
+                index[elem.attrib['vulnerabilitySetID']] = function_ids
+            elif tag == 'discreteVulnerability':
+                function_ids.append(elem.attrib['vulnerabilityFunctionID'])
+        elif tag in ('discreteVulnerability', 'discreteVulnerabilitySet'):
+            elem.clear()
+    return index
+
+
+def lazy_vuln_sets_from_xml_file(filename, use_cache=False):
+    """
+    Index a GEM NRML vulnerability file, returning vulnerability sets
+    that are only loaded when they are used.  Only the functions
+    an exposure uses are loaded by build_realised_vuln_curves.
+
+    :param filename: The file name of the xml file.
+    :param use_cache: If True, the curves are loaded from the compiled
+        version of the file in the hazimp cache.
+
+    :returns: A dictionary of LazyVulnerabilitySet instances.
+    """
+    index = None
+    if use_cache:
+        path = compile_vuln_file(filename)
+        if path is not None:
+            try:
+                index = index_vuln_sets(path)
+                load_funct = functools.partial(load_vuln_sets, path)
+            except (OSError, ValueError, KeyError) as err:
+                LOGGER.warning('Could not read cached %s: %s', path, err)
+    if index is None:
+        index = index_vuln_xml_file(filename)
+        load_funct = functools.partial(vuln_sets_from_xml_file, filename)
+
+    return {set_id: LazyVulnerabilitySet(set_id, function_ids, load_funct)
+            for set_id, function_ids in index.items()}
+
+
+def compile_vuln_file(filename):
+    """
+    Compile a GEM NRML vulnerability file into the hazimp cache, if it
+    has not already been compiled.
+
+    The cache name is based on the file content and the parser version,
+    so a changed file is compiled again.
+
+    :param filename: The file name of the xml file.
+
+    :returns: The path of the compiled file, or None if it could not
+        be written.
+    """
+    if not os.path.exists(filename):
+        raise RuntimeError("No vulnerability XML was loaded." +
+                           " Check file name " + filename)
+    name = 'vuln_%s_v%i.npz' % (cache.file_hash(filename), PARSER_VERSION)
+    path = cache.cache_path(name)
+    if not os.path.exists(path):
+        vuln_sets = vuln_sets_from_xml_file(filename)
+        try:
+            cache.write_cache_file(
+                name,
+                lambda file_handle: save_vuln_sets(vuln_sets, file_handle))
+        except (OSError, ValueError) as err:
+            # The cache is only an optimisation
+            LOGGER.warning('Could not cache %s: %s', filename, err)
+            return None
+    return path
+
+
+def cached_vuln_sets_from_xml_file(filename):
+    """
+    Load a GEM NRML vulnerability file, using the compiled version in
+    the hazimp cache.  The file is compiled into the cache the first
+    time it is loaded.
+
+    :param filename: The file name of the xml file.
+
+    :returns: A dictionary of Vulnerability Sets.
+    """
+    path = compile_vuln_file(filename)
+    if path is not None:
+        try:
+            return load_vuln_sets(path)
+        except (OSError, ValueError, KeyError) as err:
+            LOGGER.warning('Could not read cached %s: %s', path, err)
+    return vuln_sets_from_xml_file(filename)
+
+
+def save_vuln_sets(vuln_sets, file_name):
+    """
+    Save vulnerability sets as a npz file. The curves of each set are
+    stacked into arrays, dimensions (function, intensity measure level).
+
+    :param vuln_sets: A dictionary of Vulnerability Sets.
+    :param file_name: The npz file name or an open file.
+    """
+    metadata = []
+    arrays = {}
+    for i, vuln_set in enumerate(vuln_sets.values()):
+        funcs = list(vuln_set.vulnerability_functions.values())
+        metadata.append({
+            'vulnerability_set_id': vuln_set.vulnerability_set_id,
+            'intensity_measure_type': vuln_set.intensity_measure_type,
+            'asset_category': vuln_set.asset_category,
+            'loss_category': vuln_set.loss_category,
+            'default_loss': vuln_set.default_loss,
+            'function_ids': [func.function_id for func in funcs],
+            'distributions': [str(func.distribution) for func in funcs]})
+        size = vuln_set.intensity_measure_level.size
+        arrays['iml_%i' % i] = vuln_set.intensity_measure_level
+        # Raises ValueError if the curves can not be stacked
+        arrays['mean_loss_%i' % i] = numpy.array(
+            [func.mean_loss for func in funcs], dtype=float).reshape(
+                (-1, size))
+        arrays['cv_%i' % i] = numpy.array(
+            [func.coefficient_of_variation for func in funcs],
+            dtype=float).reshape((-1, size))
+    arrays['metadata'] = numpy.array(json.dumps(metadata))
+    numpy.savez(file_name, **arrays)
+
+
+def load_vuln_sets(file_name, set_ids=None, function_ids=None):
+    """
+    Load vulnerability sets saved by save_vuln_sets.
+
+    :param file_name: The npz file name.
+    :param set_ids: Optional. Only load the vulnerability sets with
+        these ID's.
+    :param function_ids: Optional. Only load the vulnerability functions
+        with these ID's.
+
+    :returns: A dictionary of Vulnerability Sets.
+    """
+    if function_ids is not None:
+        function_ids = set(function_ids)
+    vuln_sets = {}
+    with numpy.load(file_name) as npz:
+        metadata = json.loads(str(npz['metadata']))
+        for i, meta in enumerate(metadata):
+            set_id = meta['vulnerability_set_id']
+            if set_ids is not None and set_id not in set_ids:
+                continue
+            mean_loss = npz['mean_loss_%i' % i]
+            cv = npz['cv_%i' % i]
+            vulnerability_functions = {}
+            for j, func_id in enumerate(meta['function_ids']):
+                if function_ids is not None and func_id not in function_ids:
+                    continue
+                vulnerability_functions[func_id] = VulnerabilityFunction(
+                    func_id,
+                    mean_loss[j],
+                    cv[j],
+                    meta['distributions'][j])
+            vuln_sets[set_id] = VulnerabilitySet(
+                npz['iml_%i' % i],
+                meta['intensity_measure_type'],
+                set_id,
+                meta['asset_category'],
+                meta['loss_category'],
+                vulnerability_functions,
+                meta['default_loss'])
+    return vuln_sets
+
+
+def index_vuln_sets(file_name):
+    """
+    Find the vulnerability sets and function ID's in a file saved by
+    save_vuln_sets, without loading the curves.
+
+    :param file_name: The npz file name.
+
+    :returns: A dictionary. The key is the vulnerability set ID, the
+        value is a list of the function ID's in the set.
+    """
+    with numpy.load(file_name) as npz:
+        metadata = json.loads(str(npz['metadata']))
+    return {meta['vulnerability_set_id']: meta['function_ids']
+            for meta in metadata}
+
+
+def _local_name(tag):
+    """
+    Remove the namespace from an ElementTree tag.
+    e.g. '{http://openquake.org/xmlns/nrml/0.4}IML' becomes 'IML'.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def _text_to_array(text):
+    """
+    Convert the white space separated numbers of an xml element into a
+    float array.
+    """
+    return numpy.array(text.split(), dtype=float)
 
 
 def vuln_sets_from_xml_node(xml_node):
@@ -162,41 +443,85 @@ class VulnerabilitySet(object):
                    str(list(self.vulnerability_functions.keys()))))
 
     def build_realised_vuln_curves(self, vulnerability_function_ids,
-                                   variability_method=None):
+                                   variability_method=None,
+                                   seed=None, realisations=None,
+                                   asset_ids=None):
         """
         Given a list of vulnerability_function_IDs return the
         actual vulnerability curves, as a realised vulnerabitly
         curves instance.
 
-        Currently this just returns a mean curve.
+        With the 'mean' variability method the loss is the mean curve.
+        With the 'random' variability method the loss is sampled from
+        the distribution of each vulnerability function when the curves
+        are looked up.
+
+        Each distinct vulnerability function is only realised once. The
+        assets index into this table of curves, so the memory used grows
+        with the number of curves, not the number of assets.
 
         :parmas vulnerability_function_IDs: A list of the vuln. funct.'s.
             The list dimension is asset.
         :parmas variability_method: How the vulnerability function is sampled.
+        :param seed: The random seed used by the 'random' method.
+        :param realisations: The number of samples per asset drawn by the
+            'random' method. If None one sample is drawn and there is no
+            realisation dimension.
+        :param asset_ids: Optional. The integer id of each asset. With a
+            seed, the samples of an asset only depend on its id, so they
+            do not change when the assets are split into blocks.
 
         :returns: A realised vulnerabitly curves instance.  Use this to calc
             the loss ratio.
         """
-        loss_per_asset = []  # Build a list up.
-        for key in vulnerability_function_ids:
+        curve_index, function_ids = factorize_ids(vulnerability_function_ids)
+        if (curve_index < 0).any():
+            # factorize does not index missing values
+            self._missing_function(numpy.nan)
+
+        vuln_functs = []
+        for key in function_ids:
             try:
-                vuln_funct = self.vulnerability_functions[key]
+                vuln_functs.append(self.vulnerability_functions[key])
             except KeyError:
-                msg = '[%s] does not have a vulnerability curve.\n The' % key
-                msg += ' vulnerability set is %s' % self.vulnerability_set_id
-                raise NotImplementedError(msg)
-            loss_per_asset.append(vuln_funct.get_loss(variability_method))
-        # To get dimensions (asset, loss)
-        loss_per_asset = asarray(loss_per_asset)
+                self._missing_function(key)
+        # To get dimensions (curve, loss)
+        shape = (-1, self.intensity_measure_level.size)
+        loss_curves = asarray([vuln_funct.get_loss(variability_method)
+                               for vuln_funct in vuln_functs]).reshape(shape)
+        sampling = {}
+        if variability_method == 'random':
+            sampling = dict(
+                coefficient_of_variation=asarray(
+                    [vuln_funct.coefficient_of_variation
+                     for vuln_funct in vuln_functs]).reshape(shape),
+                distributions=asarray(
+                    [str(vuln_funct.distribution)
+                     for vuln_funct in vuln_functs]),
+                seed=seed,
+                realisations=realisations,
+                asset_ids=asset_ids)
         realised_vuln_curves = RealisedVulnerabilityCurves(
             self.intensity_measure_type,
             self.loss_category,
             self.intensity_measure_level,
-            loss_per_asset,
+            loss_curves,
             self.vulnerability_set_id,
-            self.default_loss)
+            self.default_loss,
+            curve_index=curve_index,
+            function_ids=function_ids,
+            **sampling)
         return realised_vuln_curves
 
+    def _missing_function(self, key):
+        """
+        Raise an error for a vulnerability function ID that is not in the
+        vulnerability set.
+        """
+        msg = '[%s] does not have a vulnerability curve.\n The' % key
+        msg += ' vulnerability set is %s' % self.vulnerability_set_id
+        raise NotImplementedError(msg)
+
     def calc_mean(self, func_id, intensity):
         """
         A wrapper for VulnerabilityFunction.calc_mean. Lookup the
@@ -210,7 +535,7 @@ class VulnerabilitySet(object):
 
         return func.calc_mean(intensity, self.intensity_measure_level)
 
-    def sample(self, func_id, mean, sigma):
+    def sample(self, func_id, mean, sigma, realisations=None, seed=None):
         """
         A wrapper for VulnerabilityFunction.sample. Lookup the
         specified vulnerability function in the set and run sample for
@@ -221,7 +546,184 @@ class VulnerabilitySet(object):
             raise NotImplementedError(
                 '%s does not have a configured vulnerability curve' % func_id)
 
-        return func.sample(mean, sigma)
+        return func.sample(mean, sigma, realisations=realisations, seed=seed)
+
+
+class LazyVulnerabilitySet(object):
+
+    """
+    A vulnerability set that is loaded when it is first used.
+
+    build_realised_vuln_curves only loads the vulnerability functions
+    used by the exposure, and keeps them, so later calls only load the
+    functions that have not been loaded.  Any other use of the set loads
+    all of it, after which it behaves as a VulnerabilitySet.
+    """
+
+    def __init__(self, vulnerability_set_id, function_ids, load_funct):
+        """
+        :param vulnerability_set_id: The ID of the vulnerability set.
+        :param function_ids: The ID's of the functions in the set.
+        :param load_funct: A function that loads the set, called as
+            load_funct(set_ids=..., function_ids=...) and returning a
+            dictionary of Vulnerability Sets.
+        """
+        self.vulnerability_set_id = vulnerability_set_id
+        self.function_ids = function_ids
+        self._load_funct = load_funct
+        self._vuln_set = None
+        # The set of the functions loaded so far, if not all of them
+        self._partial_set = None
+
+    def __repr__(self):
+        if self._vuln_set is not None:
+            return repr(self._vuln_set)
+        return ('Lazy Discrete Vulnerability Set: %s\n'
+                'discrete vulnerability functions: %s\n'
+                % (self.vulnerability_set_id, str(self.function_ids)))
+
+    def __getattr__(self, name):
+        # Only called for attributes a VulnerabilitySet has
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def load(self, function_ids=None):
+        """
+        Load the vulnerability set.
+
+        :param function_ids: Optional. Only load these functions, as
+            well as the functions already loaded. If None all of the set
+            is loaded.
+
+        :returns: A VulnerabilitySet.
+        """
+        if self._vuln_set is not None:
+            return self._vuln_set
+        if function_ids is None:
+            self._vuln_set = self._load_funct(
+                set_ids=[self.vulnerability_set_id],
+                function_ids=None)[self.vulnerability_set_id]
+            self._partial_set = None
+            return self._vuln_set
+
+        partial_set = self._partial_set
+        if partial_set is None:
+            missing = list(function_ids)
+        else:
+            missing = [func_id for func_id in function_ids
+                       if func_id not in partial_set.vulnerability_functions]
+        if partial_set is None or missing:
+            vuln_set = self._load_funct(
+                set_ids=[self.vulnerability_set_id],
+                function_ids=missing)[self.vulnerability_set_id]
+            if partial_set is None:
+                partial_set = copy.copy(vuln_set)
+                partial_set.vulnerability_functions = {}
+                self._partial_set = partial_set
+            partial_set.vulnerability_functions.update(
+                vuln_set.vulnerability_functions)
+        return partial_set
+
+    def build_realised_vuln_curves(self, vulnerability_function_ids,
+                                   variability_method=None, **kwargs):
+        """
+        Load the vulnerability functions used and build the realised
+        vulnerability curves. See VulnerabilitySet.
+
+        :parmas vulnerability_function_IDs: A list of the vuln. funct.'s.
+            The list dimension is asset.
+        :parmas variability_method: How the vulnerability function is sampled.
+
+        :returns: A realised vulnerabitly curves instance.
+        """
+        known_ids = set(self.function_ids)
+        used_ids = factorize_ids(vulnerability_function_ids)[1]
+        vuln_set = self.load(function_ids=[
+            func_id for func_id in used_ids if func_id in known_ids])
+        return vuln_set.build_realised_vuln_curves(
+            vulnerability_function_ids, variability_method=variability_method,
+            **kwargs)
+
+
+def factorize_ids(ids):
+    """
+    Find the distinct vulnerability function IDs of the assets.
+
+    Categorical IDs are factorized from their integer codes, without
+    comparing the strings.
+
+    :param ids: The vulnerability function ID of each asset. A 1D array,
+        list or pandas Series.
+    :returns: codes, uniques
+      codes: A 1D integer array, the index into uniques of each asset.
+          Missing IDs are -1.
+      uniques: A 1D object array of the IDs used, in order of appearance
+          for IDs that are not categorical.
+    """
+    categorical = getattr(ids, 'cat', None)
+    if categorical is None and isinstance(ids, pandas.Categorical):
+        categorical = ids
+    if categorical is None:
+        return pandas.factorize(asarray(ids, dtype=object))
+
+    codes = asarray(categorical.codes)
+    present = codes >= 0
+    # Only the categories that are used
+    used = numpy.flatnonzero(numpy.bincount(
+        codes[present], minlength=len(categorical.categories)))
+    new_code = numpy.full(len(categorical.categories), -1)
+    new_code[used] = numpy.arange(used.size)
+    curve_index = numpy.full(codes.size, -1)
+    curve_index[present] = new_code[codes[present]]
+    uniques = asarray(categorical.categories, dtype=object)[used]
+    return curve_index, uniques
+
+
+def interp_per_asset(intensity, intensity_measure_level, loss_per_asset,
+                     curve_index=None):
+    """
+    Interpolate the intensity of every asset on that asset's loss curve.
+
+    All of the curves share the same intensity measure level, so the
+    position of each intensity on the x axis is found with one
+    searchsorted call, rather than calling interp once per asset.
+    The result is the same as numpy.interp, including the clamping to
+    the first and last loss values outside the intensity measure level.
+
+    :param intensity: An array of intensity measures. Dimensions (asset, ...)
+    :param intensity_measure_level: The x axis values, common to all curves.
+    :param loss_per_asset: 2D array of loss ratios. Dimensions (asset, loss).
+        If curve_index is given the dimensions are (curve, loss).
+    :param curve_index: Optional 1D array, the row of loss_per_asset used
+        by each asset.
+    :returns: The loss, with the same shape as intensity. NaN intensities
+        give NaN losses.
+    """
+    intensity = asarray(intensity, dtype=float)
+    x_points = asarray(intensity_measure_level, dtype=float)
+    last = x_points.size - 1
+
+    # Index the curve of each asset across any hazard dimensions
+    if curve_index is None:
+        curve_index = numpy.arange(intensity.shape[0])
+    rows = asarray(curve_index).reshape((-1,) + (1,) * (intensity.ndim - 1))
+
+    # side='right', so an intensity equal to a level gets that level's loss
+    left = numpy.searchsorted(x_points, intensity, side='right') - 1
+    left = numpy.clip(left, 0, max(last - 1, 0))
+    right = numpy.minimum(left + 1, last)
+
+    loss_left = loss_per_asset[rows, left]
+    loss_right = loss_per_asset[rows, right]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slope = (loss_right - loss_left) / (x_points[right] - x_points[left])
+        loss = slope * (intensity - x_points[left]) + loss_left
+        loss = where(intensity <= x_points[0], loss_per_asset[rows, 0], loss)
+        loss = where(intensity >= x_points[last], loss_per_asset[rows, last],
+                     loss)
+    loss[numpy.isnan(intensity)] = numpy.nan
+    return loss
 
 
 def ratio_cutoff(ratio):
@@ -238,6 +740,106 @@ def ratio_cutoff(ratio):
     return ratio
 
 
+def asset_standard_normal(seed, asset_ids, shape):
+    """
+    Standard normal random numbers, where the numbers of each asset only
+    depend on the seed and the asset id. So an asset gets the same
+    numbers whichever other assets are sampled with it.
+
+    The numbers are the splitmix64 stream of the seed, at the position
+    of the asset id and sample, transformed to a normal distribution.
+
+    :param seed: The random seed. An integer or list of integers.
+    :param asset_ids: The integer id of each asset. Dimension (asset)
+    :param shape: The shape of the numbers. The first dimension is asset.
+    :returns: The random numbers.  Dimensions shape.
+    """
+    key = numpy.random.SeedSequence(seed).generate_state(1, numpy.uint64)
+    per_asset = int(numpy.prod(shape[1:], dtype=int))
+    position = (asarray(asset_ids).astype(numpy.uint64)[:, numpy.newaxis] *
+                numpy.uint64(per_asset) +
+                numpy.arange(per_asset, dtype=numpy.uint64))
+    bits = key + (position + numpy.uint64(1)) * \
+        numpy.uint64(0x9E3779B97F4A7C15)
+    bits = (bits ^ (bits >> numpy.uint64(30))) * \
+        numpy.uint64(0xBF58476D1CE4E5B9)
+    bits = (bits ^ (bits >> numpy.uint64(27))) * \
+        numpy.uint64(0x94D049BB133111EB)
+    bits = bits ^ (bits >> numpy.uint64(31))
+    # 53 bit uniform numbers, between 0 and 1 exclusive
+    uniform = ((bits >> numpy.uint64(11)).astype(float) + 0.5) * 2. ** -53
+    return ndtri(uniform).reshape(shape)
+
+
+def sample_loss_ratios(mean_loss, coefficient_of_variation, distribution,
+                       realisations=None, seed=None, asset_ids=None,
+                       chunk_size=SAMPLE_CHUNK_SIZE):
+    """
+    Sample loss ratios for all assets at once.
+
+    For the lognormal distribution the mean and coefficient of variation
+    are those of the loss ratio, so
+    sigma_ln = sqrt(ln(1 + cv**2)) and mu_ln = ln(mean) - sigma_ln**2 / 2.
+    The samples are clipped to between 0 and 1 with ratio_cutoff.
+
+    The samples are generated a chunk of assets at a time, which limits
+    the memory used by temporary arrays. The result does not depend on
+    the chunk size.
+
+    :param mean_loss: The mean loss ratio. Dimensions (asset, ...)
+    :param coefficient_of_variation: The coefficient of variation of the
+        loss ratio.  Same dimensions as mean_loss.
+    :param distribution: Either normal ('N') or lognormal ('LN').
+        A string, or an array of strings with dimensions (asset, ...).
+    :param realisations: The number of samples per asset. If None, one
+        sample is drawn and there is no realisation dimension.
+    :param seed: The random seed. None gives a different result each time.
+    :param asset_ids: Optional. The integer id of each asset. If given
+        with a seed, the samples of an asset only depend on the seed and
+        its id, see asset_standard_normal.
+    :param chunk_size: The number of assets sampled at a time.
+    :returns: The sampled loss ratios.  Dimensions (asset, ..., realisation)
+        NaN mean losses give NaN samples.
+    """
+    mean_loss = asarray(mean_loss, dtype=float)
+    coefficient_of_variation = numpy.broadcast_to(
+        asarray(coefficient_of_variation, dtype=float), mean_loss.shape)
+    distribution = numpy.broadcast_to(asarray(distribution), mean_loss.shape)
+    lognormal = distribution == 'LN'
+    unknown = ~(lognormal | (distribution == 'N'))
+    if unknown.any():
+        msg = 'Unknown probabilistic distribution, %s.\n' % \
+            distribution[unknown][0]
+        msg += 'Use one of %s' % str(list(DISTRIBUTIONS))
+        raise RuntimeError(msg)
+
+    if realisations is None:
+        samples = numpy.empty(mean_loss.shape)
+        expand = Ellipsis
+    else:
+        samples = numpy.empty(mean_loss.shape + (realisations,))
+        # Add the realisation dimension to the per asset values
+        expand = (Ellipsis, numpy.newaxis)
+    rng = numpy.random.default_rng(seed)
+    for start in range(0, mean_loss.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        mean = mean_loss[chunk][expand]
+        cv = coefficient_of_variation[chunk][expand]
+        if seed is None or asset_ids is None:
+            normal = rng.standard_normal(samples[chunk].shape)
+        else:
+            normal = asset_standard_normal(seed, asset_ids[chunk],
+                                           samples[chunk].shape)
+
+        sigma_ln = numpy.sqrt(numpy.log1p(cv ** 2))
+        # mean * exp(...) avoids log(0) when the mean is zero
+        sample = where(lognormal[chunk][expand],
+                       mean * numpy.exp(sigma_ln * normal - sigma_ln ** 2 / 2),
+                       mean + cv * mean * normal)
+        samples[chunk] = ratio_cutoff(sample)
+    return samples
+
+
 class VulnerabilityFunction(object):
 
     """
@@ -272,22 +874,20 @@ class VulnerabilityFunction(object):
         """
         Get the actual loss for a curve.
 
-        Currently this just returns a mean curve.
+        This returns the mean curve.  For the 'random' method the mean
+        curve is sampled when the realised curves are looked up, see
+        sample_loss_ratios.
 
         :param variability_method: How the vulnerability function is sampled.
 
         :returns: The loss y-axis values, sampled using the supplied method.
         """
-        if variability_method is None:
-            loss_points = self.mean_loss
-        if variability_method == 'mean':
-            loss_points = self.mean_loss
-        # if variability_method == 'random':
-        # TODO: Fix!
-        #  loss_points = self.mean_loss
-        return loss_points
+        if variability_method not in (None, 'mean', 'random'):
+            msg = 'Unknown variability method, %s.' % variability_method
+            raise RuntimeError(msg)
+        return self.mean_loss
 
-    def calc_mean(self, intensity):
+    def calc_mean(self, intensity, intensity_measure_level):
         """
         Calculate mean loss ratio and sigma based on the specified points on
         the curve:
@@ -309,19 +909,41 @@ class VulnerabilityFunction(object):
         For a given intensity, mean loss and sigma is determined by linearly
         interpolating the points on the curve.
 
-        Note that sigma is calculated as cv * mean loss as cv = mean loss/sigma
+        Note that sigma is calculated as cv * mean loss as cv = sigma/mean loss
+
+        :param intensity: An array of intensity measures.
+        :param intensity_measure_level: The x axis values of the curve.
+        :returns: The mean loss and sigma at the intensities.
         """
         mean_loss = interp(intensity,
-                           self.intensity_measure_level,
+                           intensity_measure_level,
                            self.mean_loss)
         cv = interp(intensity,
-                    self.intensity_measure_level,
+                    intensity_measure_level,
                     self.coefficient_of_variation)
         # cv = sigma / mean
         sigma = cv * mean_loss
 
         return (mean_loss, sigma)
 
+    def sample(self, mean_loss, sigma, realisations=None, seed=None):
+        """
+        Sample loss ratios from the distribution of this function, given
+        the mean loss and sigma, e.g. from calc_mean.
+
+        :param mean_loss: An array of mean loss ratios.
+        :param sigma: An array of standard deviations of the loss ratio.
+        :param realisations: The number of samples per value. If None,
+            one sample is drawn and there is no realisation dimension.
+        :param seed: The random seed.
+        :returns: The sampled loss ratios, between 0 and 1.
+        """
+        mean_loss = numpy.atleast_1d(asarray(mean_loss, dtype=float))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            cv = where(mean_loss > 0, asarray(sigma) / mean_loss, 0.)
+        return sample_loss_ratios(mean_loss, cv, str(self.distribution),
+                                  realisations=realisations, seed=seed)
+
     @classmethod
     def from_xml_node(cls, xml_node):
         """Load in a vulnerability function from an xml node.
@@ -341,6 +963,28 @@ class VulnerabilityFunction(object):
             coeff_of_variation,
             prob_dist)
 
+    @classmethod
+    def from_xml_element(cls, element):
+        """Load in a vulnerability function from an ElementTree element.
+
+        :param element: The discreteVulnerability element.
+
+        :returns: A vulnerability function.
+        """
+        loss = coeff_of_variation = None
+        for child in element:
+            tag = _local_name(child.tag)
+            if tag == 'lossRatio':
+                loss = _text_to_array(child.text)
+            elif tag == 'coefficientsVariation':
+                coeff_of_variation = _text_to_array(child.text)
+
+        return cls(
+            element.attrib['vulnerabilityFunctionID'],
+            loss,
+            coeff_of_variation,
+            element.attrib['probabilisticDistribution'])
+
 
 class RealisedVulnerabilityCurves(object):
 
@@ -348,7 +992,9 @@ class RealisedVulnerabilityCurves(object):
     Respresents a collection of vulnerability curves associated with an
     exposure set.
 
-    There is one vulnerability curve per asset
+    There is one vulnerability curve per asset. The curves can be stored
+    once each in a table of curves, with an index per asset pointing
+    into the table.
     """
     # pylint: disable=R0913
 
@@ -358,7 +1004,14 @@ class RealisedVulnerabilityCurves(object):
                  intensity_measure_level,
                  loss_per_asset,
                  vulnerability_set_id,
-                 default_loss):
+                 default_loss,
+                 curve_index=None,
+                 function_ids=None,
+                 coefficient_of_variation=None,
+                 distributions=None,
+                 seed=None,
+                 realisations=None,
+                 asset_ids=None):
         """
 
         :param intensity_measure_type: type of intensity measure that the
@@ -370,35 +1023,224 @@ class RealisedVulnerabilityCurves(object):
         :param loss_per_asset: 2D array of ratio points per asset.
                 The loss dimension can be regarded as the y axis values.
                 dimensions (asset, loss).
+                If curve_index is given this is the table of curves,
+                dimensions (curve, loss).
+        :param curve_index: Optional 1D integer array. The row of the
+                table of curves used by each asset.
+        :param function_ids: Optional list of the vulnerability function
+                ID of each row in the table of curves.
+        :param coefficient_of_variation: Optional 2D array of the
+                coefficient of variation points, same dimensions as
+                loss_per_asset. If given, the loss is sampled when the
+                curves are looked up.
+        :param distributions: The probabilistic distribution, 'N' or
+                'LN', of each curve.  Required with
+                coefficient_of_variation.
+        :param seed: The random seed used when sampling.
+        :param realisations: The number of samples per asset. If None
+                one sample is drawn and there is no realisation dimension.
+        :param asset_ids: Optional 1D integer array. The id of each
+                asset, so the samples of an asset only depend on the
+                seed and its id.
         """
 
         self.intensity_measure_type = intensity_measure_type
         self.loss_category_type = loss_category_type
-        self.loss_per_asset = loss_per_asset
+        self.loss_curves = asarray(loss_per_asset)
+        if curve_index is not None:
+            # The smallest integer type that can index the table
+            curve_index = asarray(curve_index).astype(
+                numpy.min_scalar_type(max(self.loss_curves.shape[0] - 1, 0)))
+        self.curve_index = curve_index
+        self.function_ids = function_ids
+        if coefficient_of_variation is not None:
+            coefficient_of_variation = asarray(coefficient_of_variation)
+            distributions = asarray(distributions)
+        self.coefficient_of_variation = coefficient_of_variation
+        self.distributions = distributions
+        self.seed = seed
+        self.realisations = realisations
+        if asset_ids is not None:
+            asset_ids = asarray(asset_ids)
+        self.asset_ids = asset_ids
+
+        # Set by tabulate
+        self.lookup_start = None
+        self.lookup_resolution = None
+        self.lookup_loss = None
+        self.lookup_cv = None
+        self.lookup_error = None
 
         self.intensity_measure_level = intensity_measure_level
         self.vulnerability_set_id = vulnerability_set_id
         self.default_loss = default_loss
 
+    @property
+    def loss_per_asset(self):
+        """
+        The vulnerability curve of every asset. Dimensions (asset, loss).
+
+        Note, this expands the table of curves to one curve per asset.
+        """
+        if self.curve_index is None:
+            return self.loss_curves
+        return self.loss_curves[self.curve_index]
+
+    def get_asset_count(self):
+        """
+        :returns: The number of assets the curves are associated with.
+        """
+        if self.curve_index is None:
+            return self.loss_curves.shape[0]
+        return self.curve_index.shape[0]
+
+    def tabulate(self, resolution, intensity_range=None):
+        """
+        Tabulate the curves on a uniform intensity grid, so look_up
+        finds the loss by rounding the intensity to the nearest grid
+        point and indexing the table, instead of interpolating.
+
+        Since the curves are piecewise linear, the maximum difference
+        from interpolating is half the resolution times the steepest
+        slope of the curves, 0.5 * resolution * max(|dloss / dintensity|).
+        This is saved as lookup_error.  Intensities outside the
+        intensity range are interpolated.
+
+        :param resolution: The intensity spacing of the grid.
+        :param intensity_range: The (minimum, maximum) intensity of the
+            grid. Defaults to the intensity measure level range, outside
+            of which the loss is constant.
+        :returns: The maximum loss error of the lookup table.
+        """
+        iml = asarray(self.intensity_measure_level, dtype=float)
+        if intensity_range is None:
+            intensity_range = (iml[0], iml[-1])
+        start, stop = intensity_range
+        if resolution <= 0 or stop < start:
+            raise RuntimeError('Bad lookup table resolution or range.')
+        size = int(numpy.ceil((stop - start) / resolution)) + 1
+        grid = start + resolution * numpy.arange(size)
+        grid = numpy.broadcast_to(grid, (self.loss_curves.shape[0], size))
+
+        self.lookup_start = start
+        self.lookup_resolution = resolution
+        self.lookup_loss = interp_per_asset(grid, iml, self.loss_curves)
+        if self.coefficient_of_variation is not None:
+            self.lookup_cv = interp_per_asset(grid, iml,
+                                              self.coefficient_of_variation)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            slope = numpy.diff(self.loss_curves, axis=1) / numpy.diff(iml)
+        max_slope = numpy.nanmax(numpy.abs(slope)) if slope.size else 0.
+        self.lookup_error = 0.5 * resolution * max_slope
+        return self.lookup_error
+
+    def _interp(self, intensity, curves, table):
+        """
+        Find the value of the curves at the intensity of each asset,
+        using the lookup table if there is one.
+
+        :param intensity: An array intensity measures.  Dimensions(asset, ...)
+        :param curves: The table of curves.  Dimensions (curve, loss)
+        :param table: The curves tabulated by tabulate, or None.
+        :returns: The value of the curves. Same dimensions as intensity.
+        """
+        if table is None:
+            return interp_per_asset(intensity,
+                                    self.intensity_measure_level,
+                                    curves,
+                                    curve_index=self.curve_index)
+
+        curve_index = self.curve_index
+        if curve_index is None:
+            curve_index = numpy.arange(intensity.shape[0])
+        rows = curve_index.reshape((-1,) + (1,) * (intensity.ndim - 1))
+
+        position = numpy.rint((intensity - self.lookup_start) /
+                              self.lookup_resolution)
+        inside = (position >= 0) & (position < table.shape[1])
+        values = table[rows, where(inside, position, 0).astype(numpy.intp)]
+
+        # Interpolate the intensities that are not in the table
+        outside = ~inside & ~numpy.isnan(intensity)
+        if outside.any():
+            assets = numpy.nonzero(outside)[0]
+            values[outside] = interp_per_asset(
+                intensity[outside], self.intensity_measure_level, curves,
+                curve_index=curve_index[assets])
+        values[numpy.isnan(intensity)] = numpy.nan
+        return values
+
+    def reindex(self, vulnerability_function_ids):
+        """
+        Assign the curves to assets using new vulnerability function IDs,
+        without realising the curves again.  The table of curves is
+        shared with this instance.
+
+        :param vulnerability_function_ids: The vulnerability function ID
+            of each asset. All IDs must be in function_ids.
+        :returns: A realised vulnerability curves instance.
+        """
+        # Only the distinct IDs are looked up in the function IDs
+        codes, used_ids = factorize_ids(vulnerability_function_ids)
+        used_index = pandas.Index(self.function_ids).get_indexer(used_ids)
+        curve_index = numpy.full(codes.size, -1)
+        curve_index[codes >= 0] = used_index[codes[codes >= 0]]
+        if (curve_index < 0).any():
+            msg = 'Vulnerability function IDs not in the realised curves.'
+            msg += '\n The vulnerability set is %s' % self.vulnerability_set_id
+            raise NotImplementedError(msg)
+        realised_vuln_curves = RealisedVulnerabilityCurves(
+            self.intensity_measure_type,
+            self.loss_category_type,
+            self.intensity_measure_level,
+            self.loss_curves,
+            self.vulnerability_set_id,
+            self.default_loss,
+            curve_index=curve_index,
+            function_ids=self.function_ids,
+            coefficient_of_variation=self.coefficient_of_variation,
+            distributions=self.distributions,
+            seed=self.seed,
+            realisations=self.realisations,
+            asset_ids=self.asset_ids)
+        # The curves are the same, so the lookup table is too
+        for att in ['lookup_start', 'lookup_resolution', 'lookup_loss',
+                    'lookup_cv', 'lookup_error']:
+            setattr(realised_vuln_curves, att, getattr(self, att))
+        return realised_vuln_curves
+
     def look_up(self, intensity):
         """
         Given an intensity use the curve to determine the loss ratio.
 
+        If the curves have been tabulated the loss is read from the
+        lookup table, see tabulate.
+        If the curves have a coefficient of variation the loss is sampled
+        from the distribution of each curve, see sample_loss_ratios.
+
         :param intensity: An array intensity measures.  Dimensions(asset, ...)
 
         :return: A loss value. loss_category_type describes type of loss.
+            Dimensions (asset, ...), or (asset, ..., realisation) if
+            the number of realisations is set.
         """
         # Note the dimensions after the asset are different in intensity
         # and loss_per_asset.
-
-        loss = zeros(intensity.shape)
-        assert self.loss_per_asset.shape[0] == intensity.shape[0]
-
-        nan = numpy.isnan(intensity)
-        for asset in range(self.loss_per_asset.shape[0]):
-            loss[asset] = interp(
-                intensity[asset],
-                self.intensity_measure_level,
-                self.loss_per_asset[asset])
-        loss[nan] = self.default_loss
+        intensity = asarray(intensity)
+        assert self.get_asset_count() == intensity.shape[0]
+
+        loss = self._interp(intensity, self.loss_curves, self.lookup_loss)
+        if self.coefficient_of_variation is not None:
+            cv = self._interp(intensity, self.coefficient_of_variation,
+                              self.lookup_cv)
+            curve_index = self.curve_index
+            if curve_index is None:
+                curve_index = numpy.arange(self.get_asset_count())
+            distribution = self.distributions[curve_index].reshape(
+                (-1,) + (1,) * (intensity.ndim - 1))
+            loss = sample_loss_ratios(loss, cv, distribution,
+                                      realisations=self.realisations,
+                                      seed=self.seed,
+                                      asset_ids=self.asset_ids)
+        loss[numpy.isnan(intensity)] = self.default_loss
         return loss
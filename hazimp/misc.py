@@ -21,6 +21,8 @@ Functions that haven't found a proper module.
 """
 import os
 import sys
+import json
+import mmap
 import inspect
 from datetime import datetime
 
@@ -56,16 +58,52 @@ DRIVERS = {'shp': 'ESRI Shapefile',
 
 DATEFMT = '%Y-%m-%d %H:%M:%S %Z'
 
+# String columns with at most this fraction of unique values are stored
+# as categoricals, when the string columns are encoded 'auto'matically.
+CATEGORY_RATIO = 0.5
 
-def csv2dict(filename, add_ids=False):
+# The aggregation of the columns of a choropleth
+# TODO: Change to a function argument and configuration option
+CHOROPLETH_REPORT = {'REPLACEMENT_VALUE': 'sum',
+                     'structural_loss_ratio': 'mean',
+                     '0.2s gust at 10m height m/s': 'max'}
+
+# The columnar file formats, by file extension
+COLUMNAR_FORMATS = {'.parquet': 'parquet',
+                    '.pq': 'parquet',
+                    '.feather': 'feather',
+                    '.arrow': 'feather'}
+
+# The columnar file metadata key of the shapes of multi-dimensional columns
+SHAPES_KEY = b'hazimp_shapes'
+
+
+def csv2dict(filename, add_ids=False, dtype=None, categorical=None,
+             usecols=None):
     """
     Read a csv file in and return the information as a dictionary
     where the key is the column names and the values are column arrays.
 
+    Parquet and feather files are read too, based on the file extension.
+    See COLUMNAR_FORMATS.
+
     :param add_ids: If True add a key, value of ids, from 0 to n
     :param filename: The csv file path string.
+    :param dtype: Optional. A dictionary of the dtype of columns.
+    :param categorical: The string columns stored as categoricals.
+        See encode_string_columns.
+    :param usecols: Optional. A list of the columns to read. Columns
+        that are not in the file are ignored. All columns are read if
+        this is None.
     """
-    plain_dic = pd.read_csv(filename, skipinitialspace=True, index_col=False)
+    if columnar_format(filename) is None:
+        plain_dic = pd.read_csv(filename, skipinitialspace=True,
+                                index_col=False, dtype=dtype,
+                                usecols=_usecols_funct(usecols))
+    else:
+        plain_dic = _exposure_frame(read_columnar(filename, columns=usecols),
+                                    filename, dtype)
+    plain_dic = encode_string_columns(plain_dic, categorical)
 
     if add_ids:
         # Add internal id info
@@ -74,6 +112,472 @@ def csv2dict(filename, add_ids=False):
     return plain_dic
 
 
+def csv2dict_blocks(filename, chunk_size, add_ids=False, dtype=None,
+                    categorical=None, usecols=None):
+    """
+    Read a csv file a block of rows at a time, so the whole file is
+    never in memory. The blocks have the values of the rows of the
+    dataframe csv2dict returns, and every block has the dtypes of the
+    first block. Integer columns are read as floats, unless their dtype
+    is given, since a later block can have missing values.
+
+    Parquet and feather files are read too, based on the file extension.
+
+    :param filename: The csv file path string.
+    :param chunk_size: The number of rows in each block.
+    :param add_ids: If True add a key, value of ids, from 0 to n. The
+        ids are numbered across the blocks.
+    :param dtype: Optional. A dictionary of the dtype of columns.
+    :param categorical: The string columns stored as categoricals.
+        'auto' is the string columns with few unique values in the
+        first block, so every block has the same categorical columns.
+    :param usecols: Optional. A list of the columns to read. Columns
+        that are not in the file are ignored. All columns are read if
+        this is None.
+    :returns: A generator of dataframes.
+    """
+    if columnar_format(filename) is None:
+        blocks = pd.read_csv(filename, skipinitialspace=True,
+                             index_col=False, dtype=dtype,
+                             usecols=_usecols_funct(usecols),
+                             chunksize=chunk_size)
+    else:
+        blocks = (_exposure_frame(columns, filename, dtype) for columns in
+                  read_columnar_blocks(filename, chunk_size,
+                                       columns=usecols))
+    start = 0
+    dtypes = None
+    for block in blocks:
+        if dtypes is None:
+            dtypes = dict((column, _block_dtype(block[column], column in
+                                                (dtype or {})))
+                          for column in block.columns)
+        block = _fix_block_dtypes(block, dtypes, filename)
+        if isinstance(categorical, str):
+            categorical = categorical_columns(block, categorical)
+        block = encode_string_columns(block, categorical)
+        if add_ids:
+            block[INTID] = numpy.arange(start, start + len(block))
+        start += len(block)
+        yield block
+
+
+def _block_dtype(values, given=False):
+    """
+    :param values: A column of the first block of rows.
+    :param given: True if the column dtype is given.
+    :returns: The dtype of the column in every block.
+    """
+    if values.dtype.kind in 'iu' and not given:
+        return numpy.dtype(numpy.float64)
+    if values.dtype.name == 'category':
+        # The blocks can have different categories
+        return 'category'
+    return values.dtype
+
+
+def _fix_block_dtypes(block, dtypes, filename):
+    """
+    Change the dtypes of the columns of a block of rows.
+
+    :param block: A dataframe of a block of rows.
+    :param dtypes: A dictionary of the dtype of the columns.
+    :param filename: The file the block is from, for errors.
+    :returns: The block, with the dtypes changed.
+    """
+    for column, column_dtype in dtypes.items():
+        values = block[column]
+        if values.dtype == column_dtype:
+            continue
+        try:
+            changed = values.astype(column_dtype)
+        except (TypeError, ValueError):
+            changed = None
+        if changed is None or \
+                changed.isnull().sum() != values.isnull().sum():
+            msg = "Column '%s' of %s has %s values in a later block of " \
+                  "rows, not %s values like the first block. Give the " \
+                  "column dtype." % (column, filename, values.dtype,
+                                     column_dtype)
+            raise RuntimeError(msg)
+        block[column] = changed
+    return block
+
+
+def dataframe_blocks(dframe, chunk_size):
+    """
+    Split a dataframe into blocks of rows. The blocks are views of the
+    dataframe where possible, so memory mapped columns are not read.
+
+    :param dframe: A dataframe.
+    :param chunk_size: The number of rows in each block.
+    :returns: A generator of dataframes.
+    """
+    for start in range(0, len(dframe), chunk_size):
+        yield dframe.iloc[start:start + chunk_size]
+
+
+def _usecols_funct(usecols):
+    """
+    :param usecols: None, or a list of the columns to read.
+    :returns: The usecols argument of pandas.read_csv, that ignores
+        columns that are not in the file.
+    """
+    if usecols is None:
+        return None
+    wanted = set(usecols)
+    return lambda name: name in wanted
+
+
+def _exposure_frame(columns, filename, dtype=None):
+    """
+    :param columns: A dictionary of the column arrays of an exposure file.
+    :param filename: The exposure file name, for errors.
+    :param dtype: Optional. A dictionary of the dtype of columns.
+    :returns: A dataframe of the columns.
+    """
+    for key in columns:
+        if columns[key].ndim > 1:
+            msg = "Column '%s' of %s has more than one value per row." \
+                  % (key, filename)
+            raise RuntimeError(msg)
+    dframe = pd.DataFrame(columns)
+    if dtype is not None:
+        dframe = dframe.astype(dict(
+            (key, dtype[key]) for key in dtype if key in dframe))
+    return dframe
+
+
+def columnar_format(filename):
+    """
+    :param filename: A file name.
+    :returns: 'parquet' or 'feather' if the file extension is a columnar
+        file format, otherwise None.
+    """
+    return COLUMNAR_FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def _import_pyarrow():
+    """
+    :returns: The pyarrow module, with its parquet and feather modules.
+    """
+    try:
+        import pyarrow  # pylint: disable=W0404
+        import pyarrow.parquet  # pylint: disable=W0404,W0611
+        import pyarrow.feather  # pylint: disable=W0404,W0611
+        import pyarrow.ipc  # pylint: disable=W0404,W0611
+    except ImportError:
+        raise RuntimeError('Parquet and feather files need the pyarrow '
+                           'package.')
+    return pyarrow
+
+
+def write_columnar(write_dict, filename, compression=None):
+    """
+    Write a dictionary of arrays to a parquet or feather file, based on
+    the file extension. The columns keep their dtype, and categorical
+    columns are stored dictionary encoded.
+
+    Arrays with more than one dimension are stored as a list of the
+    values of each row. Their shapes are stored in the file metadata,
+    so read_columnar restores them.
+
+    :param write_dict: A dictionary or dataframe of arrays. The first
+        dimension of the arrays is the same length.
+    :param filename: The file to be written.
+    :param compression: Optional. The compression codec, e.g. 'zstd'.
+        For parquet files this can be a dictionary of the codec of each
+        column. The pyarrow default is used if this is None.
+    """
+    pyarrow = _import_pyarrow()
+    table = _columnar_table(pyarrow, write_dict)
+
+    kwargs = {}
+    if compression is not None:
+        kwargs['compression'] = compression
+    if columnar_format(filename) == 'parquet':
+        pyarrow.parquet.write_table(table, filename, **kwargs)
+    else:
+        pyarrow.feather.write_feather(table, filename, **kwargs)
+
+
+def _columnar_table(pyarrow, write_dict):
+    """
+    :param pyarrow: The pyarrow module.
+    :param write_dict: A dictionary or dataframe of arrays.
+    :returns: A pyarrow Table of the arrays. See write_columnar.
+    """
+    names = []
+    arrays = []
+    shapes = {}
+    for key in write_dict.keys():
+        values = write_dict[key]
+        if isinstance(values, pd.Series):
+            values = values.values
+        else:
+            values = numpy.asarray(values)
+        if isinstance(values, numpy.ndarray):
+            values = numpy.ascontiguousarray(values)
+        if values.ndim > 1:
+            shapes[str(key)] = values.shape[1:]
+            rows = values.reshape((values.shape[0], -1))
+            array = pyarrow.FixedSizeListArray.from_arrays(
+                pyarrow.array(rows.ravel()), rows.shape[1])
+        else:
+            array = pyarrow.array(values)
+        names.append(str(key))
+        arrays.append(array)
+    return pyarrow.Table.from_arrays(
+        arrays, names=names, metadata={SHAPES_KEY: json.dumps(shapes)})
+
+
+class ColumnarWriter(object):
+
+    """
+    Write a parquet or feather file a block of rows at a time, based on
+    the file extension. See write_columnar.
+
+    Every block has the columns and dtypes of the first block.
+    Categorical columns are written as strings to feather files, since
+    the blocks can have different categories.
+    """
+
+    def __init__(self, filename, compression=None):
+        """
+        :param filename: The file to be written.
+        :param compression: Optional. The compression codec, e.g. 'zstd'.
+        """
+        self.pyarrow = _import_pyarrow()
+        self.filename = filename
+        self.compression = compression
+        self.schema = None
+        self.writer = None
+
+    def write(self, write_dict):
+        """
+        Write a block of rows.
+
+        :param write_dict: A dictionary or dataframe of arrays.
+        """
+        pyarrow = self.pyarrow
+        table = _columnar_table(pyarrow, write_dict)
+        if self.writer is None:
+            if columnar_format(self.filename) == 'parquet':
+                kwargs = {}
+                if self.compression is not None:
+                    kwargs['compression'] = self.compression
+                self.schema = table.schema
+                self.writer = pyarrow.parquet.ParquetWriter(
+                    self.filename, self.schema, **kwargs)
+            else:
+                self.schema = pyarrow.schema(
+                    [field.with_type(field.type.value_type)
+                     if pyarrow.types.is_dictionary(field.type) else field
+                     for field in table.schema],
+                    metadata=table.schema.metadata)
+                compression = self.compression
+                if compression is None and \
+                        pyarrow.Codec.is_available('lz4_frame'):
+                    # The write_feather default
+                    compression = 'lz4'
+                self.writer = pyarrow.ipc.new_file(
+                    self.filename, self.schema,
+                    options=pyarrow.ipc.IpcWriteOptions(
+                        compression=compression))
+        try:
+            table = table.cast(self.schema)
+        except (ValueError, pyarrow.ArrowException) as err:
+            msg = "The columns of a block of %s don't match the first " \
+                  "block: %s" % (self.filename, err)
+            raise RuntimeError(msg)
+        self.writer.write_table(table)
+
+    def close(self):
+        """
+        Finish writing the file.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def read_columnar(filename, columns=None):
+    """
+    Read a parquet or feather file, based on the file extension.
+
+    :param filename: The file to be read.
+    :param columns: Optional. A list of the columns to read. Columns
+        that are not in the file are ignored. All columns are read if
+        this is None.
+    :returns: A dictionary of the column arrays, keyed by column name.
+        Categorical columns are pandas.Categorical. Multi-dimensional
+        columns written by write_columnar have their shape restored.
+    """
+    pyarrow = _import_pyarrow()
+    if columnar_format(filename) == 'parquet':
+        read_table = pyarrow.parquet.read_table
+        names = pyarrow.parquet.read_schema(filename).names
+    else:
+        read_table = pyarrow.feather.read_table
+        names = pyarrow.ipc.open_file(filename).schema.names
+    if columns is not None:
+        columns = [name for name in names if name in set(columns)]
+    return _table_dict(read_table(filename, columns=columns))
+
+
+def read_columnar_blocks(filename, chunk_size, columns=None):
+    """
+    Read a parquet or feather file a block of rows at a time, based on
+    the file extension.
+
+    :param filename: The file to be read.
+    :param chunk_size: The number of rows in each block.
+    :param columns: Optional. A list of the columns to read. Columns
+        that are not in the file are ignored. All columns are read if
+        this is None.
+    :returns: A generator of dictionaries of the column arrays, like
+        read_columnar returns.
+    """
+    pyarrow = _import_pyarrow()
+    if columnar_format(filename) == 'parquet':
+        parquet_file = pyarrow.parquet.ParquetFile(filename)
+        names = parquet_file.schema_arrow.names
+        if columns is not None:
+            columns = [name for name in names if name in set(columns)]
+        schema = parquet_file.schema_arrow
+        for batch in parquet_file.iter_batches(batch_size=chunk_size,
+                                               columns=columns):
+            yield _table_dict(pyarrow.Table.from_batches(
+                [batch]).replace_schema_metadata(schema.metadata))
+    else:
+        # The file is memory mapped, so only the blocks are read
+        table = pyarrow.ipc.open_file(
+            pyarrow.memory_map(filename)).read_all()
+        if columns is not None:
+            table = table.select([name for name in table.column_names
+                                  if name in set(columns)])
+        for start in range(0, table.num_rows, chunk_size):
+            yield _table_dict(table.slice(start, chunk_size))
+
+
+def _table_dict(table):
+    """
+    :param table: A pyarrow Table written by write_columnar.
+    :returns: A dictionary of the column arrays. See read_columnar.
+    """
+    metadata = table.schema.metadata or {}
+    shapes = json.loads(metadata.get(SHAPES_KEY, b'{}'))
+
+    read_dict = {}
+    for name in table.column_names:
+        column = table.column(name)
+        if name in shapes:
+            values = column.combine_chunks().flatten()
+            read_dict[name] = values.to_numpy(zero_copy_only=False).reshape(
+                [len(column)] + shapes[name])
+        else:
+            read_dict[name] = column.to_pandas().values
+    return read_dict
+
+
+def encode_string_columns(dframe, columns='auto'):
+    """
+    Store string columns of a dataframe as categoricals, so each
+    string is stored once and the rows hold integer codes.
+
+    :param dframe: A dataframe.
+    :param columns: None, for no columns, a list of column names, or
+        'auto' for the string columns with at most CATEGORY_RATIO
+        unique values.
+    :returns: The dataframe, with the columns changed.
+    """
+    if columns is None:
+        return dframe
+    for column in categorical_columns(dframe, columns):
+        dframe[column] = dframe[column].astype('category')
+    return dframe
+
+
+def categorical_columns(dframe, columns='auto'):
+    """
+    :param dframe: A dataframe.
+    :param columns: A list of column names, or 'auto' for the string
+        columns with at most CATEGORY_RATIO unique values.
+    :returns: The list of columns to store as categoricals.
+    """
+    if isinstance(columns, str):
+        if columns != 'auto':
+            raise RuntimeError("Unknown categorical columns, %s. Use 'auto' "
+                               "or a list of columns" % columns)
+        columns = [column for column in dframe.columns
+                   if dframe[column].dtype == object and
+                   dframe[column].nunique() <= CATEGORY_RATIO * len(dframe)]
+    return columns
+
+
+def insert_columns(dframe, columns):
+    """
+    Add several columns to a dataframe at once. Columns that are
+    already in the dataframe are replaced.
+
+    Adding the columns at once, rather than one at a time, keeps the
+    dataframe in one block per dtype.
+
+    :param dframe: A dataframe, or a dictionary of columns.
+    :param columns: A dictionary of the new columns. Key is the column
+        name and value the 1D column values.
+    :returns: The dataframe with the new columns.
+    """
+    if isinstance(dframe, dict):
+        dframe.update(columns)
+        return dframe
+    new = {}
+    for column, values in columns.items():
+        if column in dframe.columns:
+            dframe[column] = values
+        else:
+            new[column] = values
+    if not new:
+        return dframe
+    if any(is_memory_mapped(dframe[column]) for column in dframe.columns):
+        # Concatenating would copy the memory mapped columns into memory
+        data = dict((column, dframe[column]) for column in dframe.columns)
+        data.update(new)
+        return pd.DataFrame(data, index=dframe.index, copy=False)
+    return pd.concat([dframe, pd.DataFrame(new, index=dframe.index)], axis=1)
+
+
+def is_memory_mapped(values):
+    """
+    :param values: An array, or a pandas Series.
+    :returns: True if the values are a view of a memory mapped file.
+    """
+    values = getattr(values, 'values', values)
+    while values is not None:
+        if isinstance(values, (numpy.memmap, mmap.mmap)):
+            return True
+        values = getattr(values, 'base', None)
+    return False
+
+
+def memory_map(values, filename):
+    """
+    Write an array to a .npy file and memory map it, so the operating
+    system page cache holds the values, rather than the process.
+
+    :param values: A numeric array.
+    :param filename: The .npy file to be written.
+    :returns: The memory mapped array.
+    """
+    values = numpy.asarray(values)
+    mapped = numpy.lib.format.open_memmap(filename, mode='w+',
+                                          dtype=values.dtype,
+                                          shape=values.shape)
+    mapped[...] = values
+    mapped.flush()
+    return mapped
+
+
 def instanciate_classes(module):
     """
     Create a dictionary of calc names (key) and the calc instance (value).
@@ -208,8 +712,9 @@ def add(var, var2):
     try:
         result = numpy.asarray(var + var2)
     except TypeError:
-        # Assume numpy array with strings
-        result = numpy.asarray(numpy.core.defchararray.add(var, var2))
+        # Assume numpy array with strings, or categorical string columns
+        result = numpy.asarray(numpy.core.defchararray.add(
+            numpy.asarray(var, dtype=str), numpy.asarray(var2, dtype=str)))
     return result
 
 
@@ -289,6 +794,8 @@ def permutate_att_values(dframe, fields, groupby=None):
         for field in fields:
             newdf[field] = \
                 newdf.groupby(groupby)[field].transform(permutation)
+            # Keep categorical columns categorical
+            newdf[field] = newdf[field].astype(dframe[field].dtype)
     elif groupby and groupby not in dframe.columns:
         LOGGER.error(f"Cannot use {groupby} for permuting exposure attributes")
         LOGGER.error("The input expsoure data does not include that field")
@@ -323,7 +830,8 @@ def aggregate_loss_atts(dframe, groupby=None, kwargs=None):
     :returns: A `pandas.GroupBy` object.
 
     """
-    grouped = dframe.groupby(groupby, as_index=False)
+    # observed only makes groups of the categories in categorical columns
+    grouped = dframe.groupby(groupby, as_index=False, observed=True)
 
     outdf = grouped.agg(kwargs)
     outdf.columns = ['_'.join(col).strip() for col in outdf.columns.values]
@@ -356,18 +864,29 @@ def choropleth(dframe, boundaries, impactcode, bcode, filename):
     :param str filename: Destination filename. Must have a valid extension from
                    `shp`, `json` or `gpkg`.
     """
+    aggregate = dframe.groupby(impactcode,
+                               observed=True).agg(CHOROPLETH_REPORT)
+    save_choropleth(aggregate, boundaries, bcode, filename)
+
+
+def save_choropleth(aggregate, boundaries, bcode, filename):
+    """
+    Save data aggregated to geospatial boundaries.
+
+    :param aggregate: `pandas.DataFrame` of the CHOROPLETH_REPORT
+                      aggregation, indexed by the region code.
+    :param str boundaries: File name of a geospatial dataset that contains
+                  geographical boundaries to serve as aggregation boundaries
+    :param str bcode: The field name of the region code in the geospatial
+                      dataset.
+    :param str filename: Destination filename. Must have a valid extension from
+                   `shp`, `json` or `gpkg`.
+    """
     # List of possible drivers for output:
     # See `import fiona; fiona.supported_drivers` for a complete list of
     # options, but we've only implemented a few to start with.
 
-    left, right = mergefield = impactcode, bcode
-
-    # TODO: Change to a function argument and configuration option
-    report = {'REPLACEMENT_VALUE': 'sum',
-              'structural_loss_ratio': 'mean',
-              '0.2s gust at 10m height m/s': 'max'}
-
-    aggregate = dframe.groupby(left).agg(report)
+    right = bcode
     shapes = gpd.read_file(boundaries)
 
     try:
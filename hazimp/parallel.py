@@ -24,6 +24,7 @@ import socket
 import numpy
 
 from hazimp import misc
+from hazimp import cache
 
 
 class Parallel(object):
@@ -151,7 +152,7 @@ def gather_dict(subdict, indexes):
         pypar.send(subdict, 0)
 
 
-def csv2dict(filename, use_parallel=True):
+def csv2dict(filename, use_parallel=True, use_cache=False, **kwargs):
     """
     Read a csv file in and return the information as a dictionary
     where the key is the column names and the values are column arrays.
@@ -159,15 +160,19 @@ def csv2dict(filename, use_parallel=True):
     This dictionary will be chunked and sent to all processors.
 
     :param filename: The csv file path string.
+    :param use_cache: If True, read the file using the binary copy in
+        the hazimp cache. See cache.cached_csv2dict.
+    :param kwargs: Passed to misc.csv2dict, e.g. dtype.
     :returns: subsection of the array
     """
+    read_funct = cache.cached_csv2dict if use_cache else misc.csv2dict
     if STATE.is_parallel and use_parallel:
         whole = None
         if STATE.rank == 0:
-            whole = misc.csv2dict(filename, add_ids=True)
+            whole = read_funct(filename, add_ids=True, **kwargs)
         (subdict, _) = scatter_dict(whole)
     else:
-        subdict = misc.csv2dict(filename, add_ids=True)
+        subdict = read_funct(filename, add_ids=True, **kwargs)
     return subdict
 # -------------------------------------------------------------
 if __name__ == "__main__":
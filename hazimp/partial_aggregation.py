@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014 Geoscience Australia
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Aggregate grouped data a block of rows at a time.
+"""
+
+import numpy
+import pandas as pd
+
+# The statistics of the values in a group that each aggregation function
+# is calculated from. The statistics of blocks of rows can be combined,
+# so the result is the same as aggregating all of the rows at once.
+FUNCTION_STATS = {'sum': ['sum'],
+                  'count': ['count'],
+                  'size': [],
+                  'min': ['min'],
+                  'max': ['max'],
+                  'mean': ['count', 'sum'],
+                  'var': ['count', 'sum', 'm2'],
+                  'std': ['count', 'sum', 'm2']}
+
+
+class PartialAggregation(object):
+
+    """
+    Aggregate the columns of a dataframe by groups, like
+    dframe.groupby(groupby, observed=True).agg(aggs), adding a block of
+    rows at a time.
+
+    Only the statistics of each group are kept, e.g. the count, sum
+    and sum of squared differences from the mean, so the memory used
+    does not depend on the number of rows.
+    """
+
+    def __init__(self, groupby, aggs):
+        """
+        :param groupby: The column, or a list of the columns, to group by.
+        :param aggs: A dictionary of the aggregation functions. Key is the
+            column name and value is a function name, or a list of
+            function names. See FUNCTION_STATS for the functions.
+        """
+        self.groupby = groupby
+        self.aggs = {}
+        self.stats = {}
+        for column, funcs in (aggs or {}).items():
+            if isinstance(funcs, str):
+                funcs = [funcs]
+            for func in funcs:
+                if func not in FUNCTION_STATS:
+                    msg = "The '%s' aggregation of %s can not be calculated " \
+                          "a block of rows at a time." % (func, column)
+                    raise RuntimeError(msg)
+            self.aggs[column] = list(funcs)
+            stats = set(stat for func in funcs
+                        for stat in FUNCTION_STATS[func])
+            self.stats[column] = [stat for stat in
+                                  ['count', 'sum', 'min', 'max', 'm2']
+                                  if stat in stats]
+        # A list of functions flattens the result columns
+        self.multi_columns = any(not isinstance(funcs, str)
+                                 for funcs in (aggs or {}).values())
+        self.dtypes = {}
+        self.state = None
+        self.sizes = None
+
+    def add(self, dframe):
+        """
+        Add a block of rows to the aggregation.
+
+        :param dframe: A dataframe of the groupby and aggregated columns.
+        """
+        grouped = dframe.groupby(self.groupby, observed=True, sort=False)
+        stats = {}
+        for column, names in self.stats.items():
+            self.dtypes.setdefault(column, dframe[column].dtype)
+            values = grouped[column]
+            count = values.count()
+            stats[(column, 'count')] = count
+            if 'sum' in names:
+                stats[(column, 'sum')] = values.sum()
+            if 'min' in names:
+                stats[(column, 'min')] = values.min()
+            if 'max' in names:
+                stats[(column, 'max')] = values.max()
+            if 'm2' in names:
+                stats[(column, 'm2')] = values.var(ddof=0) * count
+        sizes = grouped.size()
+        state = pd.DataFrame(stats, index=sizes.index)
+        state.index = sizes.index = _plain_index(sizes.index)
+
+        if self.state is None:
+            self.state = state
+            self.sizes = sizes
+        else:
+            self.state = self._combine(self.state, state)
+            self.sizes = self.sizes.add(sizes, fill_value=0).astype(
+                numpy.int64)
+
+    def _combine(self, old, new):
+        """
+        Combine the statistics of two sets of blocks.
+
+        :returns: A dataframe of the statistics of the groups in either.
+        """
+        index = old.index.union(new.index)
+        old = old.reindex(index)
+        new = new.reindex(index)
+        stats = {}
+        for column, names in self.stats.items():
+            old_count = old[(column, 'count')].fillna(0)
+            new_count = new[(column, 'count')].fillna(0)
+            count = old_count + new_count
+            stats[(column, 'count')] = count
+            if 'sum' in names:
+                old_sum = old[(column, 'sum')].fillna(0)
+                new_sum = new[(column, 'sum')].fillna(0)
+                stats[(column, 'sum')] = old_sum + new_sum
+            if 'min' in names:
+                stats[(column, 'min')] = numpy.fmin(old[(column, 'min')],
+                                                    new[(column, 'min')])
+            if 'max' in names:
+                stats[(column, 'max')] = numpy.fmax(old[(column, 'max')],
+                                                    new[(column, 'max')])
+            if 'm2' in names:
+                # Chan et al.'s formula for the variance of two sets
+                delta = new_sum / new_count - old_sum / old_count
+                stats[(column, 'm2')] = (
+                    old[(column, 'm2')].fillna(0) +
+                    new[(column, 'm2')].fillna(0) +
+                    (delta ** 2 * old_count * new_count / count).fillna(0))
+        return pd.DataFrame(stats, index=index)
+
+    def result(self):
+        """
+        :returns: A dataframe of the aggregated columns, indexed by the
+            groupby values.
+        """
+        state = self.state.sort_index()
+        columns = {}
+        for column, funcs in self.aggs.items():
+            for func in funcs:
+                key = (column, func) if self.multi_columns else column
+                columns[key] = self._function(state, column, func)
+        return pd.DataFrame(columns, index=state.index)
+
+    def size(self):
+        """
+        :returns: A series of the number of rows in each group, indexed
+            by the groupby values.
+        """
+        return self.sizes.sort_index()
+
+    def _function(self, state, column, func):
+        """
+        :returns: A series of an aggregation function of a column.
+        """
+        dtype = self.dtypes[column]
+        if func == 'size':
+            return self.sizes.reindex(state.index)
+        count = state[(column, 'count')]
+        if func == 'count':
+            return count.astype(numpy.int64)
+        if func in ('sum', 'min', 'max'):
+            values = state[(column, func)]
+            if dtype.kind in 'biu' and not values.isnull().any():
+                values = values.astype(numpy.int64 if func == 'sum'
+                                       else dtype)
+            return values
+        mean = state[(column, 'sum')] / count
+        if func == 'mean':
+            return mean
+        var = state[(column, 'm2')] / (count - 1)
+        var[count <= 1] = numpy.nan
+        if func == 'var':
+            return var
+        return numpy.sqrt(var)
+
+
+def _plain_index(index):
+    """
+    Change categorical group values to their values, so groups from
+    blocks with different categories can be combined.
+
+    :param index: A pandas index.
+    :returns: The index, with its levels not categorical.
+    """
+    if isinstance(index, pd.MultiIndex):
+        return pd.MultiIndex.from_arrays(
+            [numpy.asarray(index.get_level_values(level))
+             for level in range(index.nlevels)], names=index.names)
+    if isinstance(index, pd.CategoricalIndex):
+        return pd.Index(numpy.asarray(index), name=index.name)
+    return index
@@ -25,6 +25,10 @@ order. The order is determined by the queue of jobs.
 """
 
 import logging
+
+from hazimp.jobs.jobs import (EACH_BLOCK, FIRST_BLOCK, ALL_BLOCKS,
+                              AFTER_BLOCKS)
+
 log = logging.getLogger(__name__)
 
 class PipeLine(object):
@@ -65,8 +69,83 @@ class PipeLine(object):
         Run all the jobs in queue, where each job take input data and
         write the results of calculation in context.
 
+        If a job sets the context exposure_blocks, e.g. the exposure is
+        loaded with a chunk_size, the rest of the jobs are run a block
+        of sites at a time. See run_blocks.
+
+        :param context: Context object holding the i/o data for the pipelines.
+        """
+        for i, job in enumerate(self.jobs):
+            _run_job(job, context)
+            if getattr(context, 'exposure_blocks', None) is not None:
+                self.run_blocks(context, self.jobs[i + 1:])
+                break
+
+    @staticmethod
+    def run_blocks(context, jobs):
+        """
+        Run jobs on each block of sites of the context exposure_blocks,
+        so only one block of sites is in memory at a time.
+
+        The job block_mode is how the job is run on the blocks.
+        EACH_BLOCK jobs are run on every block, and FIRST_BLOCK jobs on
+        the first block that reaches them. ALL_BLOCKS jobs are run on
+        every block, and their results are combined after the last
+        block. AFTER_BLOCKS jobs are run once, after the results are
+        combined.
+
+        If a job leaves a block with no sites, e.g. none of them are in
+        the hazard area, the rest of the jobs are skipped for the block.
+
         :param context: Context object holding the i/o data for the pipelines.
+        :param jobs: The jobs run on the blocks.
         """
-        for job in self.jobs:
-            log.info('Executing ' + type(getattr(job, 'job_instance', job)).__name__)
-            job(context)
+        modes = [getattr(getattr(job, 'job_instance', job), 'block_mode',
+                         None) for job in jobs]
+        bad = [type(getattr(job, 'job_instance', job)).__name__
+               for job, mode in zip(jobs, modes) if mode is None]
+        if bad:
+            msg = 'The %s jobs can not be run a block of sites at a time.' \
+                  % ', '.join(bad)
+            raise RuntimeError(msg)
+
+        blocks = context.exposure_blocks
+        context.exposure_blocks = None
+        first_done = set()
+        for number, (lat, lon, exposure_att) in enumerate(blocks):
+            log.info('Block %i of sites, %i sites', number, len(lat))
+            context.set_exposure_block(number, lat, lon, exposure_att)
+            for index, (job, mode) in enumerate(zip(jobs, modes)):
+                if mode == FIRST_BLOCK:
+                    if index in first_done:
+                        continue
+                    first_done.add(index)
+                elif mode not in (EACH_BLOCK, ALL_BLOCKS):
+                    continue
+                _run_job(job, context)
+                if context.exposure_long.size == 0:
+                    log.info('Block %i has no sites left', number)
+                    break
+        context.finish_exposure_blocks()
+
+        for job, mode in zip(jobs, modes):
+            if mode == AFTER_BLOCKS:
+                _run_job(job, context)
+
+
+def _run_job(job, context):
+    """
+    Run a job.
+
+    :param job: A job, or a ConfigAwareJob.
+    :param context: Context object holding the i/o data for the pipelines.
+    """
+    job_instance = getattr(job, 'job_instance', job)
+    log.info('Executing ' + type(job_instance).__name__)
+    if not getattr(job_instance, 'broadcasts_const', False):
+        # The job uses exposure_att directly
+        context.materialize_exposure_const()
+    job(context)
+    # Move the columns the job added to disk, if the context keeps the
+    # exposure in memory mapped files
+    context.map_exposure_columns()
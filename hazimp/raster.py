@@ -19,10 +19,58 @@
 Manipulate raster data
 """
 
+import os
+import logging
+import hashlib
+import threading
+import collections
+import concurrent.futures
+
 import numpy
 import gdal
 from gdalconst import GA_ReadOnly
 
+from hazimp.cache import cache_path, write_cache_file
+
+LOGGER = logging.getLogger(__name__)
+
+# How much of a raster file is read.
+# 'full' reads the whole raster. 'window' reads the pixels covering the
+# points being sampled. 'block' reads the GDAL blocks the points are in.
+# 'auto' uses 'block' for tiled rasters and 'full' otherwise.
+READ_MODES = ('full', 'window', 'block', 'auto')
+
+# The number of pixels read around the points in 'window' mode
+WINDOW_MARGIN = 1
+
+# The default memory limit of the 'block' mode block cache
+BLOCK_CACHE_BYTES = 256 * 2 ** 20
+
+# Where the pixels of the points sampled on a grid are cached.
+# None does not cache them. 'memory' keeps them for the rest of the
+# process. 'disk' also saves them in the hazimp cache directory.
+PIXEL_CACHE_MODES = (None, 'memory', 'disk')
+
+# The memory limit of the memory pixel cache. An entry holds about 17
+# bytes per point.
+PIXEL_CACHE_BYTES = 256 * 2 ** 20
+
+# How the extents of several raster files are combined
+EXTENT_COMBINES = ('union', 'intersection')
+
+# How the bands (e.g. time steps) of a file are reduced to one value
+# at each point. 'time_above' is the time the values are above a
+# threshold.
+REDUCTIONS = ('max', 'mean', 'sum', 'time_above')
+
+# The pixels of the points sampled on a grid.
+# pixels: A 1D array of the unique flat pixel indices (row * x_size + col)
+#   of the points inside the grid.
+# point_pixel: The index into pixels of each point inside the grid.
+# inside: A 1D boolean array, True for points inside the grid.
+PixelIndices = collections.namedtuple('PixelIndices',
+                                      ['pixels', 'point_pixel', 'inside'])
+
 
 class Raster(object):
 
@@ -39,12 +87,18 @@ class Raster(object):
     # pylint: disable=R0902, R0913
 
     def __init__(self, raster, upper_left_x, upper_left_y,
-                 x_pixel, y_pixel, no_data_value, x_size, y_size):
+                 x_pixel, y_pixel, no_data_value, x_size, y_size,
+                 window=None):
         """
 
         :param raster: A 2D numeric array of the raster values, North is up.
                        The values are listed in 'English reading order' i.e.
                        left-right and top-down.
+                       Or a 3D array, (bands, rows, columns), of several
+                       bands of a file.
+                       The array is kept in its own dtype, with no data
+                       values as they are. They are only changed to NAN
+                       when the raster is sampled.
         :param upper_left_x: The longitude at the upper left corner of the
                              top left pixel.
         :param upper_left_y: The latitude at the upper left corner of the
@@ -56,6 +110,12 @@ class Raster(object):
         :param x_size: Number of columns.
         :param y_size: Number of rows.
         :param no_data_value: Values in the raster that represent no data.
+                       For several bands, this can be an array of shape
+                       (bands, 1), if the bands have different values.
+        :param window: Optional. The (x_offset, y_offset, x_size, y_size)
+                       of the pixels in the raster array, if only a
+                       window of the grid was read. The grid parameters
+                       are those of the whole grid.
         """
         self.raster = raster
         self.ul_x = upper_left_x
@@ -65,40 +125,60 @@ class Raster(object):
         self.no_data_value = no_data_value
         self.x_size = x_size
         self.y_size = y_size
+        if window is None:
+            window = (0, 0, x_size, y_size)
+        self.window = window
 
-        self.raster = numpy.where(self.raster == self.no_data_value, numpy.NAN,
-                               self.raster)
+        # The extent of all of the raster data
+        self.file_extent = self.extent()
 
     @classmethod
-    def from_file(cls, filename):
+    def from_file(cls, filename, lon=None, lat=None, margin=WINDOW_MARGIN,
+                  pixel_cache='memory', bands=None):
         """
         Load a file in a raster file format known to GDAL.
         Note, image must be 'North up'.
 
+        If points are given only the window of pixels covering the
+        points, plus a margin, is read.  The grid is still that of the
+        whole file, so the points are in the same pixels as when the
+        whole file is read.
+
         :param filename: The csv file path string.
+        :param lon: Optional. A 1D array of the longitude of the points.
+        :param lat: Optional. A 1D array of the latitude of the points.
+        :param margin: The number of pixels read around the points.
+        :param pixel_cache: Where the pixels of the points are cached.
+            One of PIXEL_CACHE_MODES.
+        :param bands: The bands read. None reads the first band, as a 2D
+            raster. 'all', or a list of band numbers (starting at 1),
+            reads a 3D raster of the bands.
         :returns: A Raster instance.
         """
 
-        dataset = gdal.Open(filename, GA_ReadOnly)
-        if dataset is None:
-            raise RuntimeError('Invalid file: %s' % filename)
-
-        # get georeference info
-        transform = dataset.GetGeoTransform()
-        assert transform[2] == 0.0  # image is "north up"
-        assert transform[4] == 0.0  # image is "north up"
-        upper_left_x = transform[0]
-        x_pixel = transform[1]
+        dataset, upper_left_x, upper_left_y, x_pixel, y_pixel = \
+            open_dataset(filename)
         x_size = dataset.RasterXSize
+        y_size = dataset.RasterYSize
+        band_list = band_numbers(dataset, bands)
+        no_data_value = bands_no_data_value(dataset, band_list)
 
-        upper_left_y = transform[3]
-        y_pixel = transform[5]
-        y_size = dataset.RasterYSize  # This will be a negative value.
-        band = dataset.GetRasterBand(1)
-        no_data_value = band.GetNoDataValue()
-        raster = band.ReadAsArray(0, 0, x_size, y_size)
+        window = (0, 0, x_size, y_size)
+        if lon is not None:
+            window = pixel_window(
+                lon, lat, upper_left_x, upper_left_y, x_pixel, y_pixel,
+                x_size, y_size, margin, pixel_cache=pixel_cache)
+            LOGGER.info('Reading a %i x %i pixel window of %s',
+                        window[2], window[3], filename)
+        if window[2] > 0 and window[3] > 0:
+            raster = read_bands(dataset, band_list, *window)
+        else:
+            band_shape = () if band_list is None else (len(band_list),)
+            raster = numpy.empty(band_shape + (window[3], window[2]),
+                                 dtype=numpy.float32)
         instance = cls(raster, upper_left_x, upper_left_y,
-                       x_pixel, y_pixel, no_data_value, x_size, y_size)
+                       x_pixel, y_pixel, no_data_value, x_size, y_size,
+                       window=window)
         return instance
 
     @classmethod
@@ -131,46 +211,101 @@ class Raster(object):
                        x_pixel, y_pixel, no_data_value, x_size, y_size)
         return instance
 
-    def raster_data_at_points(self, lon, lat):
+    def raster_data_at_points(self, lon, lat, pixel_cache='memory'):
         """
         Get data at lat lon points of the raster.
 
+        Points on the edges of the raster are inside it. Each pixel is
+        sampled once, however many points are in it.
+
         :param lon: A 1D array of the longitude of the points.
         :param lat: A 1D array of the latitude of the points.
+        :param pixel_cache: Where the pixels of the points are cached,
+            so sampling another raster on the same grid doesn't find
+            them again. One of PIXEL_CACHE_MODES.
         :returns: A numpy array, First dimension being the points/sites.
+            For several bands the shape is (sites, bands).
         """
 
         assert lon.size == lat.size
 
-        values = numpy.empty(lon.size)
+        values = numpy.empty((lon.size,) + self.band_shape())
         values[:] = numpy.NAN
 
-        # get an index of all the values inside the grid
-        # there has to be a better way...
-        bad_indexes = set()
-        bad_indexes = bad_indexes.union(numpy.where(lon < self.ul_x)[0])
-        bad_indexes = bad_indexes.union(
-            numpy.where(lon > self.ul_x + self.x_size * self.x_pixel)[0])
-        bad_indexes = bad_indexes.union(numpy.where(lat > self.ul_y)[0])
-        bad_indexes = bad_indexes.union(
-            numpy.where(lat < self.ul_y + self.y_size * self.y_pixel)[0])
-        good_indexes = numpy.array(list(set(
-            range(lon.size)).difference(bad_indexes)))
-
-        if good_indexes.shape[0] > 0:
-            # compute pixel offset
-            raw_col_offset = (lon - self.ul_x) / self.x_pixel
-            col_offset = numpy.trunc(raw_col_offset).astype(int)
-            raw_row_offset = (lat - self.ul_y) / self.y_pixel
-            row_offset = numpy.trunc(raw_row_offset).astype(int)
-
-            values[good_indexes] = self.raster[row_offset[good_indexes],
-                                               col_offset[good_indexes]]
-            # Change NODATA_value to NAN
-            values = numpy.where(values == self.no_data_value, numpy.NAN,
-                                 values)
+        pixels, point_pixel, inside = grid_unique_pixels(
+            lon, lat, self.ul_x, self.ul_y, self.x_pixel, self.y_pixel,
+            self.x_size, self.y_size, pixel_cache=pixel_cache)
+        LOGGER.info('%i points inside and %i points outside the raster',
+                    point_pixel.size, lon.size - point_pixel.size)
+
+        if pixels.size > 0:
+            rows, cols = numpy.divmod(pixels, self.x_size)
+            # Pixels outside of the window read have no data
+            in_window = self.in_window(rows, cols)
+            pixel_values = numpy.empty(self.band_shape() + (pixels.size,))
+            pixel_values[:] = numpy.NAN
+            if in_window.any():
+                window_values = self.values_at_pixels(rows[in_window],
+                                                      cols[in_window])
+                # Change NODATA_value to NAN. This is compared in the
+                # raster dtype, since the no data value may not be exact
+                # as a double.
+                no_data = window_values == self.no_data_value
+                window_values = window_values.astype(float)
+                window_values[no_data] = numpy.NAN
+                pixel_values[..., in_window] = window_values
+            # For several bands, the pixels are the second axis
+            values[inside] = pixel_values.T[point_pixel]
         return values
 
+    def pixel_indices(self, lon, lat):
+        """
+        Find the pixel that each lat lon point is in.
+
+        The extent is closed, so points on the right or bottom edge are in
+        the last column or row.
+
+        :param lon: A 1D array of the longitude of the points.
+        :param lat: A 1D array of the latitude of the points.
+        :returns: rows, cols, inside
+          rows, cols: 1D integer arrays of the pixel of each point inside
+            the raster.
+          inside: A 1D boolean array, True for points inside the raster.
+        """
+        return grid_pixel_indices(lon, lat, self.ul_x, self.ul_y,
+                                  self.x_pixel, self.y_pixel,
+                                  self.x_size, self.y_size)
+
+    def in_window(self, rows, cols):
+        """
+        Find if pixels are in the window of the grid that was read.
+
+        :param rows: A 1D integer array of the pixel rows.
+        :param cols: A 1D integer array of the pixel columns.
+        :returns: A 1D boolean array, True for pixels in the window.
+        """
+        x_offset, y_offset, x_size, y_size = self.window
+        return ((rows >= y_offset) & (rows < y_offset + y_size) &
+                (cols >= x_offset) & (cols < x_offset + x_size))
+
+    def values_at_pixels(self, rows, cols):
+        """
+        Get the raster values of pixels in the window that was read.
+
+        :param rows: A 1D integer array of the pixel rows of the grid.
+        :param cols: A 1D integer array of the pixel columns of the grid.
+        :returns: A 1D array of the pixel values, or a 2D array,
+            (bands, pixels), for several bands.
+        """
+        x_offset, y_offset = self.window[:2]
+        return self.raster[..., rows - y_offset, cols - x_offset]
+
+    def band_shape(self):
+        """
+        :returns: () for one band, or (bands,) for several bands.
+        """
+        return self.raster.shape[:-2]
+
     def extent(self):
         """
         Return the extent, in lats and longs of the raster.
@@ -178,52 +313,786 @@ class Raster(object):
         :returns: min_long, min_lat, max_long, max_lat
         """
 
-        max_lat = self.ul_y
-        min_lat = self.ul_y + self.y_pixel * self.y_size
-        min_long = self.ul_x
-        max_long = self.ul_x + self.x_pixel * self.x_size
-        return min_long, min_lat, max_long, max_lat
+        return grid_extent(self.ul_x, self.ul_y, self.x_pixel, self.y_pixel,
+                           self.x_size, self.y_size)
+
+
+class BlockRaster(Raster):
+
+    """
+    A raster file that is read one GDAL block (tile) at a time, as
+    pixels are sampled. The blocks read are kept in a least recently
+    used cache, limited to cache_bytes.
+
+    This suits points spread sparsely over a large tiled raster, where
+    most of the raster is never sampled.
+    """
+
+    # pylint: disable=W0231
+    # The raster is not loaded, so Raster.__init__ is not used.
+    def __init__(self, dataset, upper_left_x, upper_left_y,
+                 x_pixel, y_pixel, cache_bytes=BLOCK_CACHE_BYTES,
+                 bands=None):
+        """
+        :param dataset: An open GDAL dataset.
+        :param cache_bytes: The memory limit of the block cache.
+        :param bands: The bands sampled. None samples the first band.
+            'all', or a list of band numbers, samples several bands.
+        See Raster for the other parameters.
+        """
+        # Keep the dataset, since the band is invalid without it
+        self.dataset = dataset
+        self.band_list = band_numbers(dataset, bands)
+        self.band = dataset.GetRasterBand(
+            1 if self.band_list is None else self.band_list[0])
+        self.raster = None
+        self.ul_x = upper_left_x
+        self.ul_y = upper_left_y
+        self.x_pixel = x_pixel
+        self.y_pixel = y_pixel
+        self.no_data_value = bands_no_data_value(dataset, self.band_list)
+        self.x_size = dataset.RasterXSize
+        self.y_size = dataset.RasterYSize
+        # The blocks of the whole grid can be read
+        self.window = (0, 0, self.x_size, self.y_size)
+        self.block_x_size, self.block_y_size = self.band.GetBlockSize()
+        self.file_extent = self.extent()
+
+        self.cache_bytes = cache_bytes
+        self.cache_size = 0
+        self.blocks = collections.OrderedDict()
+        self.blocks_read = 0
+
+    @classmethod
+    def from_file(cls, filename, cache_bytes=BLOCK_CACHE_BYTES, bands=None):
+        """
+        Open a file in a raster file format known to GDAL.
+        Note, image must be 'North up'.
+
+        :param filename: The raster file path string.
+        :param cache_bytes: The memory limit of the block cache.
+        :param bands: The bands sampled. See Raster.from_file.
+        :returns: A BlockRaster instance.
+        """
+        dataset, upper_left_x, upper_left_y, x_pixel, y_pixel = \
+            open_dataset(filename)
+        return cls(dataset, upper_left_x, upper_left_y, x_pixel, y_pixel,
+                   cache_bytes=cache_bytes, bands=bands)
+
+    def values_at_pixels(self, rows, cols):
+        """
+        Get the raster values of pixels, reading the blocks the pixels
+        are in.
+
+        :param rows: A 1D integer array of the pixel rows.
+        :param cols: A 1D integer array of the pixel columns.
+        :returns: A 1D array of the pixel values, in the raster dtype.
+            For several bands, a 2D array (bands, pixels).
+        """
+        values = None
+        block_rows = rows // self.block_y_size
+        block_cols = cols // self.block_x_size
+        n_block_cols = -(-self.x_size // self.block_x_size)
+        blocks, pixel_block = numpy.unique(
+            block_rows * n_block_cols + block_cols, return_inverse=True)
+
+        # Group the pixels by block
+        order = numpy.argsort(pixel_block, kind='stable')
+        splits = numpy.cumsum(numpy.bincount(pixel_block,
+                                             minlength=blocks.size))[:-1]
+        for block, pixels in zip(blocks, numpy.split(order, splits)):
+            block_row, block_col = divmod(int(block), n_block_cols)
+            y_offset = block_row * self.block_y_size
+            x_offset = block_col * self.block_x_size
+            data = self.read_block(x_offset, y_offset)
+            if values is None:
+                values = numpy.empty(data.shape[:-2] + (rows.size,),
+                                     dtype=data.dtype)
+            values[..., pixels] = data[..., rows[pixels] - y_offset,
+                                       cols[pixels] - x_offset]
+        return values
+
+    def band_shape(self):
+        """
+        :returns: () for one band, or (bands,) for several bands.
+        """
+        return () if self.band_list is None else (len(self.band_list),)
+
+    def read_block(self, x_offset, y_offset):
+        """
+        Get a block of the raster, from the cache if it has been read.
+
+        :param x_offset: The column of the upper left pixel of the block.
+        :param y_offset: The row of the upper left pixel of the block.
+        :returns: A 2D array of the block, or 3D for several bands.
+            Blocks on the right and bottom edges may be smaller than the
+            block size.
+        """
+        key = (x_offset, y_offset)
+        data = self.blocks.get(key)
+        if data is not None:
+            self.blocks.move_to_end(key)
+            return data
+
+        data = read_bands(
+            self.dataset, self.band_list, x_offset, y_offset,
+            min(self.block_x_size, self.x_size - x_offset),
+            min(self.block_y_size, self.y_size - y_offset))
+        self.blocks_read += 1
+        self.blocks[key] = data
+        self.cache_size += data.nbytes
+        # Remove the least recently used blocks
+        while self.cache_size > self.cache_bytes and len(self.blocks) > 1:
+            _, old = self.blocks.popitem(last=False)
+            self.cache_size -= old.nbytes
+        return data
+
+
+def open_dataset(filename):
+    """
+    Open a raster file with GDAL and get the georeference info.
+    Note, image must be 'North up'.
+
+    :param filename: The raster file path string.
+    :returns: dataset, upper_left_x, upper_left_y, x_pixel, y_pixel
+        See Raster for a description of the georeference info.
+    """
+    dataset = gdal.Open(filename, GA_ReadOnly)
+    if dataset is None:
+        raise RuntimeError('Invalid file: %s' % filename)
+
+    # get georeference info
+    transform = dataset.GetGeoTransform()
+    assert transform[2] == 0.0  # image is "north up"
+    assert transform[4] == 0.0  # image is "north up"
+    upper_left_x = transform[0]
+    x_pixel = transform[1]
+    upper_left_y = transform[3]
+    y_pixel = transform[5]  # This will be a negative value.
+    return dataset, upper_left_x, upper_left_y, x_pixel, y_pixel
+
+
+def band_numbers(dataset, bands):
+    """
+    Check the bands to read from a dataset.
+
+    :param dataset: An open GDAL dataset.
+    :param bands: None, 'all', a band number or a list of band numbers.
+        Band numbers start at 1.
+    :returns: None, for just the first band, or a list of band numbers.
+    """
+    if bands is None:
+        return None
+    if isinstance(bands, str):
+        if bands != 'all':
+            raise RuntimeError("Unknown bands, %s. Use 'all' or a list of "
+                               "band numbers" % bands)
+        return list(range(1, dataset.RasterCount + 1))
+    band_list = [int(band) for band in numpy.atleast_1d(bands)]
+    for band in band_list:
+        if band < 1 or band > dataset.RasterCount:
+            raise RuntimeError('Band %i is not in the raster, which has '
+                               '%i bands' % (band, dataset.RasterCount))
+    return band_list
+
+
+def bands_no_data_value(dataset, band_list):
+    """
+    Get the no data value of the bands of a dataset.
+
+    :param dataset: An open GDAL dataset.
+    :param band_list: None, for the first band, or a list of band numbers.
+    :returns: The no data value, if it is the same for all of the bands.
+        Otherwise a float array, shape (bands, 1).
+    """
+    if band_list is None:
+        return dataset.GetRasterBand(1).GetNoDataValue()
+    values = [dataset.GetRasterBand(band).GetNoDataValue()
+              for band in band_list]
+    if all(value == values[0] for value in values):
+        return values[0]
+    values = [numpy.NAN if value is None else value for value in values]
+    return numpy.array(values).reshape((-1, 1))
+
+
+def read_bands(dataset, band_list, x_offset, y_offset, x_size, y_size):
+    """
+    Read a window of the bands of a dataset.
+
+    :param dataset: An open GDAL dataset.
+    :param band_list: None, for the first band, or a list of band numbers.
+    :returns: A 2D array, or a 3D array (bands, rows, columns) if there
+        is a list of bands.
+    """
+    if band_list is None:
+        return dataset.GetRasterBand(1).ReadAsArray(
+            x_offset, y_offset, x_size, y_size)
+    data = None
+    for index, band in enumerate(band_list):
+        band_data = dataset.GetRasterBand(band).ReadAsArray(
+            x_offset, y_offset, x_size, y_size)
+        if data is None:
+            data = numpy.empty((len(band_list),) + band_data.shape,
+                               dtype=band_data.dtype)
+        data[index] = band_data
+    return data
+
+
+def is_tiled(filename):
+    """
+    Check if a raster file is tiled, i.e. its GDAL blocks are
+    narrower than the raster, rather than strips of whole rows.
+
+    :param filename: The raster file path string.
+    :returns: True if the first band of the file is tiled.
+    """
+    dataset = open_dataset(filename)[0]
+    block_x_size = dataset.GetRasterBand(1).GetBlockSize()[0]
+    return block_x_size < dataset.RasterXSize
+
+
+def grid_extent(upper_left_x, upper_left_y, x_pixel, y_pixel, x_size, y_size):
+    """
+    Return the extent, in lats and longs of a north up grid.
+
+    See Raster for a description of the parameters.
+
+    :returns: min_long, min_lat, max_long, max_lat
+    """
+    max_lat = upper_left_y
+    min_lat = upper_left_y + y_pixel * y_size
+    min_long = upper_left_x
+    max_long = upper_left_x + x_pixel * x_size
+    return min_long, min_lat, max_long, max_lat
+
+
+def grid_pixel_indices(lon, lat, upper_left_x, upper_left_y,
+                       x_pixel, y_pixel, x_size, y_size):
+    """
+    Find the pixel of a north up grid that each lat lon point is in.
+
+    The extent is closed, so points on the right or bottom edge are in
+    the last column or row.  See Raster for a description of the grid
+    parameters.
+
+    :param lon: A 1D array of the longitude of the points.
+    :param lat: A 1D array of the latitude of the points.
+    :returns: rows, cols, inside
+      rows, cols: 1D integer arrays of the pixel of each point inside
+        the grid.
+      inside: A 1D boolean array, True for points inside the grid.
+    """
+    min_long, min_lat, max_long, max_lat = grid_extent(
+        upper_left_x, upper_left_y, x_pixel, y_pixel, x_size, y_size)
+    inside = ((lon >= min_long) & (lon <= max_long) &
+              (lat >= min_lat) & (lat <= max_lat))
+    if x_size == 0 or y_size == 0:
+        inside[:] = False
+
+    cols = numpy.floor((lon[inside] - upper_left_x) / x_pixel)
+    rows = numpy.floor((lat[inside] - upper_left_y) / y_pixel)
+    cols = numpy.clip(cols, 0, x_size - 1).astype(int)
+    rows = numpy.clip(rows, 0, y_size - 1).astype(int)
+    return rows, cols, inside
+
+
+def grid_unique_pixels(lon, lat, upper_left_x, upper_left_y,
+                       x_pixel, y_pixel, x_size, y_size, pixel_cache=None):
+    """
+    Find the unique pixels of a north up grid that lat lon points are in.
+    See Raster for a description of the grid parameters.
+
+    :param lon: A 1D array of the longitude of the points.
+    :param lat: A 1D array of the latitude of the points.
+    :param pixel_cache: Where the pixels are cached. One of
+        PIXEL_CACHE_MODES.
+    :returns: A PixelIndices instance.  The arrays may be shared with the
+        cache, so they are read only.
+    """
+    if pixel_cache not in PIXEL_CACHE_MODES:
+        raise RuntimeError('Unknown pixel cache, %s. Use one of %s' %
+                           (pixel_cache, str(PIXEL_CACHE_MODES)))
+    grid = (upper_left_x, upper_left_y, x_pixel, y_pixel, x_size, y_size)
+    if pixel_cache is None:
+        return _calc_unique_pixels(lon, lat, grid)
+    return PIXEL_INDEX_CACHE.indices(lon, lat, grid,
+                                     on_disk=pixel_cache == 'disk')
+
+
+def _calc_unique_pixels(lon, lat, grid):
+    """
+    Find the unique pixels of a grid that lat lon points are in.
+
+    :param grid: (upper_left_x, upper_left_y, x_pixel, y_pixel,
+        x_size, y_size)
+    :returns: A PixelIndices instance.
+    """
+    rows, cols, inside = grid_pixel_indices(lon, lat, *grid)
+    pixels, point_pixel = numpy.unique(rows * grid[4] + cols,
+                                       return_inverse=True)
+    indices = PixelIndices(pixels, point_pixel, inside)
+    for array in indices:
+        array.flags.writeable = False
+    return indices
+
+
+class PixelIndexCache(object):
+
+    """
+    A cache of the pixels that sets of points are in, for grids.
+
+    A run often samples many rasters on the same grid, e.g. the events
+    of one hazard model, at the same exposure points. The pixels are
+    found for the first raster, and then only the pixel values are read
+    for the others.
+
+    Entries are keyed on the grid (origin, pixel size and shape) and a
+    hash of the point coordinates. The least recently used entries are
+    dropped when the entries use more than max_bytes.  Entries can also
+    be saved in the hazimp cache directory, so they are kept between
+    runs.
+    """
+
+    def __init__(self, max_bytes=PIXEL_CACHE_BYTES):
+        """
+        :param max_bytes: The memory limit of the entries.
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        # Guards the entries. Each key also has a lock, held while its
+        # pixels are found, so threads sampling rasters on the same grid
+        # only find them once, and other grids are found at the same time.
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        Remove the entries in memory.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def indices(self, lon, lat, grid, on_disk=False):
+        """
+        Get the unique pixels of a grid that lat lon points are in.
+
+        :param lon: A 1D array of the longitude of the points.
+        :param lat: A 1D array of the latitude of the points.
+        :param grid: (upper_left_x, upper_left_y, x_pixel, y_pixel,
+            x_size, y_size)
+        :param on_disk: True if the entry is also read from and saved to
+            the hazimp cache directory.
+        :returns: A PixelIndices instance.
+        """
+        key = points_grid_key(lon, lat, grid)
+        with self.lock:
+            indices = self._get(key)
+            if indices is not None:
+                return indices
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                # Another thread may have found the pixels
+                indices = self._get(key)
+                if indices is not None:
+                    return indices
+                self.misses += 1
+
+            file_name = cache_path('pixels-%s.npz' % key)
+            if on_disk and os.path.exists(file_name):
+                with numpy.load(file_name) as npz:
+                    indices = PixelIndices(*[npz[field] for field in
+                                             PixelIndices._fields])
+                for array in indices:
+                    array.flags.writeable = False
+            else:
+                indices = _calc_unique_pixels(lon, lat, grid)
+                if on_disk:
+                    write_cache_file(
+                        os.path.basename(file_name),
+                        lambda file_handle: numpy.savez(
+                            file_handle, **indices._asdict()))
+
+            with self.lock:
+                self._add(key, indices)
+                self.key_locks.pop(key, None)
+            return indices
+
+    def _get(self, key):
+        """
+        :returns: The entry of a key, or None. Call with the lock held.
+        """
+        indices = self.entries.get(key)
+        if indices is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return indices
+
+    def _add(self, key, indices):
+        """
+        Add an entry, dropping the least recently used entries if the
+        entries use more than max_bytes. Call with the lock held.
+        """
+        nbytes = sum(array.nbytes for array in indices)
+        if nbytes > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = indices
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, dropped = self.entries.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in dropped)
+
+
+def points_grid_key(lon, lat, grid):
+    """
+    Calculate a key for a set of points on a grid.
+
+    :param lon: A 1D array of the longitude of the points.
+    :param lat: A 1D array of the latitude of the points.
+    :param grid: (upper_left_x, upper_left_y, x_pixel, y_pixel,
+        x_size, y_size)
+    :returns: A sha1 hex digest of the grid and the point coordinates.
+    """
+    sha1 = hashlib.sha1(repr(tuple(grid)).encode())
+    sha1.update(numpy.ascontiguousarray(lon, dtype=float).tobytes())
+    sha1.update(numpy.ascontiguousarray(lat, dtype=float).tobytes())
+    return sha1.hexdigest()
+
+
+# The cache used by the 'memory' and 'disk' pixel cache modes
+PIXEL_INDEX_CACHE = PixelIndexCache()
+
+
+def pixel_window(lon, lat, upper_left_x, upper_left_y,
+                 x_pixel, y_pixel, x_size, y_size, margin=WINDOW_MARGIN,
+                 pixel_cache=None):
+    """
+    Find the window of pixels of a north up grid covering lat lon points.
+    See Raster for a description of the grid parameters.
+
+    :param lon: A 1D array of the longitude of the points.
+    :param lat: A 1D array of the latitude of the points.
+    :param margin: The number of pixels added around the points.
+    :param pixel_cache: Where the pixels of the points are cached.
+        One of PIXEL_CACHE_MODES.
+    :returns: x_offset, y_offset, x_size, y_size
+       The window, in pixels. The size is 0 if no points are in the grid.
+    """
+    pixels = grid_unique_pixels(lon, lat, upper_left_x, upper_left_y,
+                                x_pixel, y_pixel, x_size, y_size,
+                                pixel_cache=pixel_cache).pixels
+    if pixels.size == 0:
+        return 0, 0, 0, 0
+    rows, cols = numpy.divmod(pixels, x_size)
+    x_offset = max(int(cols.min()) - margin, 0)
+    y_offset = max(int(rows.min()) - margin, 0)
+    x_end = min(int(cols.max()) + margin + 1, x_size)
+    y_end = min(int(rows.max()) + margin + 1, y_size)
+    return x_offset, y_offset, x_end - x_offset, y_end - y_offset
 
 
-def files_raster_data_at_points(lon, lat, files):
+class BandReduction(object):
+
+    """
+    A running reduction of the bands of a raster at a set of pixels.
+    The bands are added one at a time, so only the current band and
+    the reduction, not all of the bands, are in memory.
+
+    NAN values are ignored. Pixels with no values in any band are NAN.
+    """
+
+    def __init__(self, reduction, size, threshold=None, time_step=1.):
+        """
+        :param reduction: One of REDUCTIONS.
+        :param size: The number of pixels.
+        :param threshold: The threshold of the 'time_above' reduction.
+        :param time_step: The time between bands. The 'sum' and
+            'time_above' reductions are multiplied by this, so the sum is
+            the time integrated value.
+        """
+        if reduction not in REDUCTIONS:
+            raise RuntimeError('Unknown band reduction, %s. Use one of %s' %
+                               (reduction, str(REDUCTIONS)))
+        if reduction == 'time_above' and threshold is None:
+            raise RuntimeError('The time_above reduction needs a threshold')
+        self.reduction = reduction
+        self.threshold = threshold
+        self.time_step = time_step
+        self.count = numpy.zeros(size, dtype=int)
+        if reduction == 'max':
+            self.total = numpy.empty(size)
+            self.total[:] = numpy.NAN
+        else:
+            self.total = numpy.zeros(size)
+
+    def add(self, values):
+        """
+        Add a band to the reduction.
+
+        :param values: A 1D float array of the band values at the pixels.
+        """
+        valid = ~numpy.isnan(values)
+        self.count += valid
+        if self.reduction == 'max':
+            numpy.fmax(self.total, values, out=self.total)
+        elif self.reduction == 'time_above':
+            self.total += values > self.threshold
+        else:
+            self.total[valid] += values[valid]
+
+    def result(self):
+        """
+        :returns: A 1D array of the reduced values at the pixels.
+        """
+        if self.reduction == 'max':
+            return self.total.copy()
+        values = numpy.empty(self.total.size)
+        values[:] = numpy.NAN
+        valid = self.count > 0
+        if self.reduction == 'mean':
+            values[valid] = self.total[valid] / self.count[valid]
+        else:
+            values[valid] = self.total[valid] * self.time_step
+        return values
+
+
+def file_reduce_bands_at_points(lon, lat, filename, reduction, bands=None,
+                                threshold=None, time_step=1.,
+                                pixel_cache='memory'):
+    """
+    Reduce the bands of a file, e.g. the time steps of a NetCDF
+    variable, to one value at lat lon points.
+
+    The bands are read one at a time, and only the window of pixels
+    covering the points is read. So the memory used does not depend on
+    the number of bands.
+
+    :param lon: A 1D array of the longitude of the points.
+    :param lat: A 1D array of the latitude of the points.
+    :param filename: The raster file path string.
+    :param reduction: One of REDUCTIONS.
+    :param bands: The bands reduced. None or 'all' reduces all of the
+        bands. Or a list of band numbers, starting at 1.
+    :param threshold: The threshold of the 'time_above' reduction.
+    :param time_step: The time between bands. See BandReduction.
+    :param pixel_cache: Where the pixels of the points are cached.
+        One of PIXEL_CACHE_MODES.
+    :returns: data, extent
+      data: A 1D numpy array of the reduced values at the points.
+      extent: (min_long, min_lat, max_long, max_lat) of the file.
+    """
+    dataset, upper_left_x, upper_left_y, x_pixel, y_pixel = \
+        open_dataset(filename)
+    x_size = dataset.RasterXSize
+    band_list = band_numbers(dataset, 'all' if bands is None else bands)
+    pixels, point_pixel, inside = grid_unique_pixels(
+        lon, lat, upper_left_x, upper_left_y, x_pixel, y_pixel,
+        x_size, dataset.RasterYSize, pixel_cache=pixel_cache)
+    reduced = BandReduction(reduction, pixels.size, threshold=threshold,
+                            time_step=time_step)
+
+    if pixels.size > 0:
+        rows, cols = numpy.divmod(pixels, x_size)
+        x_offset, y_offset = int(cols.min()), int(rows.min())
+        window_x_size = int(cols.max()) - x_offset + 1
+        window_y_size = int(rows.max()) - y_offset + 1
+        rows = rows - y_offset
+        cols = cols - x_offset
+        for band_number in band_list:
+            band = dataset.GetRasterBand(band_number)
+            window = band.ReadAsArray(x_offset, y_offset,
+                                      window_x_size, window_y_size)
+            pixel_values = window[rows, cols]
+            no_data = pixel_values == band.GetNoDataValue()
+            pixel_values = pixel_values.astype(float)
+            pixel_values[no_data] = numpy.NAN
+            reduced.add(pixel_values)
+    LOGGER.info('Reduced %i bands of %s with %s', len(band_list), filename,
+                reduction)
+
+    values = numpy.empty(lon.size)
+    values[:] = numpy.NAN
+    values[inside] = reduced.result()[point_pixel]
+    extent = grid_extent(upper_left_x, upper_left_y, x_pixel, y_pixel,
+                         x_size, dataset.RasterYSize)
+    return values, extent
+
+
+def file_raster_data_at_points(lon, lat, filename, read_mode='auto',
+                               block_cache_bytes=BLOCK_CACHE_BYTES,
+                               pixel_cache='memory', bands=None,
+                               reduction=None, threshold=None, time_step=1.):
+    """
+    Get data at lat lon points, based on a file.
+    See files_raster_data_at_points for a description of the parameters.
+
+    :returns: data, extent
+      data: A numpy array of the values at the points, shape (sites)
+        or (sites, bands).
+      extent: (min_long, min_lat, max_long, max_lat) of the file.
+    """
+    if reduction is not None:
+        return file_reduce_bands_at_points(
+            lon, lat, filename, reduction, bands=bands, threshold=threshold,
+            time_step=time_step, pixel_cache=pixel_cache)
+    if read_mode == 'auto':
+        read_mode = 'block' if is_tiled(filename) else 'full'
+    if read_mode == 'window':
+        a_raster = Raster.from_file(filename, lon, lat,
+                                    pixel_cache=pixel_cache, bands=bands)
+    elif read_mode == 'block':
+        a_raster = BlockRaster.from_file(filename,
+                                         cache_bytes=block_cache_bytes,
+                                         bands=bands)
+    else:
+        a_raster = Raster.from_file(filename, bands=bands)
+    data = a_raster.raster_data_at_points(lon, lat, pixel_cache=pixel_cache)
+    return data, a_raster.file_extent
+
+
+def files_raster_data_at_points(lon, lat, files, read_mode='auto',
+                                block_cache_bytes=BLOCK_CACHE_BYTES,
+                                workers=1, pixel_cache='memory',
+                                bands=None, reduction=None, threshold=None,
+                                time_step=1.):
     """
     Get data at lat lon points, based on a set of files
 
     :param files: A list of files.
     :param lon: A 1D array of the longitude of the points.
     :param lat: A 1d array of the latitude of the points.
+    :param read_mode: 'full' reads all of each file. 'window' only
+        reads the pixels covering the points, so the memory used depends
+        on the area of the points, not the size of the file. 'block' only
+        reads the GDAL blocks the points are in, which suits points spread
+        sparsely over a large tiled raster. 'auto' uses 'block' for tiled
+        files and 'full' for other files.
+    :param block_cache_bytes: The memory limit of the block cache, for
+        the 'block' read mode.
+    :param workers: The number of files read at the same time, using a
+        pool of threads.  GDAL releases the GIL while reading, so this
+        speeds up loading many files.
+    :param pixel_cache: Where the pixels of the points are cached.
+        None does not cache them. 'memory' keeps them for the rest of
+        the process, so files on the same grid only find them once.
+        'disk' also saves them in the hazimp cache directory.
+    :param bands: The bands sampled from each file. None samples the
+        first band. 'all', or a list of band numbers (starting at 1),
+        samples several bands.  The bands of each file are a hazard.
+    :param reduction: Reduce the bands of each file to one hazard, with
+        one of REDUCTIONS. The bands are read one at a time, so the
+        memory used does not depend on the number of bands. With a
+        reduction, bands=None reduces all of the bands.
+    :param threshold: The threshold of the 'time_above' reduction.
+    :param time_step: The time between bands, for the 'sum' and
+        'time_above' reductions.
     :returns: reshaped_data, max_extent
       reshaped_data: A numpy array, shape (sites, hazards) or shape (sites),
-        for one hazard.
+        for one hazard. With bands, the hazards are the bands of the
+        first file, then the bands of the next file and so on.
       max_extent: [min_long, min_lat, max_long, max_lat] A rectange covering
         the extents of all of the loaded rasters.
     """
+    if read_mode not in READ_MODES:
+        raise RuntimeError('Unknown raster read mode, %s. Use one of %s' %
+                           (read_mode, str(READ_MODES)))
+    if pixel_cache not in PIXEL_CACHE_MODES:
+        raise RuntimeError('Unknown pixel cache, %s. Use one of %s' %
+                           (pixel_cache, str(PIXEL_CACHE_MODES)))
 
-    data = []
+    # shape (sites, hazards), in the order of the files.
+    # Made when the first file is sampled, since the number of bands of
+    # the files is not known before then.
+    data = None
     max_extent = None
-    for filename in files:
-        a_raster = Raster.from_file(filename)
-        results = a_raster.raster_data_at_points(lon, lat)
-        data.append(results)
-
-        # Working out the maximum extent
-        extent = a_raster.extent()
-        if max_extent is None:
-            max_extent = list(extent)
-        else:
-            max_extent = recalc_max(max_extent, extent)
 
-    # shape (hazards, sites)
-    data = numpy.asarray(data)
-    if data.shape[0] == 1:
+    def sample(index):
+        """Sample a file, returning the index of the file as well."""
+        return (index,) + file_raster_data_at_points(
+            lon, lat, files[index], read_mode=read_mode,
+            block_cache_bytes=block_cache_bytes, pixel_cache=pixel_cache,
+            bands=bands, reduction=reduction, threshold=threshold,
+            time_step=time_step)
+
+    pool = None
+    futures = []
+    if workers > 1 and len(files) > 1:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        futures = [pool.submit(sample, index) for index in range(len(files))]
+        file_results = (future.result() for future in
+                        concurrent.futures.as_completed(futures))
+    else:
+        file_results = (sample(index) for index in range(len(files)))
+
+    try:
+        for index, results, extent in file_results:
+            results = results.reshape((lon.size, -1))
+            if data is None:
+                file_bands = results.shape[1]
+                data = numpy.empty((lon.size, len(files) * file_bands))
+            elif results.shape[1] != file_bands:
+                raise RuntimeError('%s has %i bands, not %i' %
+                                   (files[index], results.shape[1],
+                                    file_bands))
+            data[:, index * file_bands:(index + 1) * file_bands] = results
+
+            # Working out the maximum extent
+            if max_extent is None:
+                max_extent = list(extent)
+            else:
+                max_extent = recalc_max(max_extent, extent)
+    finally:
+        if pool is not None:
+            # Don't read the remaining files if there was an error
+            for future in futures:
+                future.cancel()
+            pool.shutdown()
+
+    if data.shape[1] == 1 and (bands is None or reduction is not None):
         # One hazard
-        reshaped_data = numpy.reshape(data, (data.shape[1]))
+        reshaped_data = numpy.reshape(data, (data.shape[0]))
     else:
-        reshaped_data = numpy.rollaxis(data, 1)
+        reshaped_data = data
 
     return reshaped_data, max_extent
 
 
+def files_extent(files, combine='union'):
+    """
+    Find the extent of a set of raster files. Only the file headers are
+    read, not the raster data.
+
+    :param files: A list of files.
+    :param combine: 'union' for the rectangle covering all of the
+        extents, or 'intersection' for the rectangle covered by every
+        extent.
+    :returns: [min_long, min_lat, max_long, max_lat]
+        For the intersection of extents that don't overlap, min_long is
+        more than max_long or min_lat is more than max_lat.
+    """
+    if combine not in EXTENT_COMBINES:
+        raise RuntimeError('Unknown extent combination, %s. Use one of %s' %
+                           (combine, str(EXTENT_COMBINES)))
+    combined = None
+    for filename in files:
+        dataset, upper_left_x, upper_left_y, x_pixel, y_pixel = \
+            open_dataset(filename)
+        extent = grid_extent(upper_left_x, upper_left_y, x_pixel, y_pixel,
+                             dataset.RasterXSize, dataset.RasterYSize)
+        if combined is None:
+            combined = list(extent)
+        elif combine == 'union':
+            combined = recalc_max(combined, extent)
+        else:
+            combined = recalc_min(combined, extent)
+    return combined
+
+
 def recalc_max(max_extent, extent):
     """
     Given an extent and a maximum extent modify maximum extent so
@@ -239,3 +1108,20 @@ def recalc_max(max_extent, extent):
     lim_funct = (min, min, max, max)
     return [lim(max_e, ext) for max_e, ext, lim in zip(max_extent, extent,
                                                        lim_funct)]
+
+
+def recalc_min(min_extent, extent):
+    """
+    Given an extent and a minimum extent modify minimum extent so
+    it only covers the area also covered by the extent.
+
+    Both parameters describe a rectangle;
+     [min_long, min_lat, max_long, max_lat]
+
+    :param min_extent: A list describing a rectangular area.
+    :param extent: A tuple/list describing the area that min_extent
+                   is limited to.
+    """
+    lim_funct = (max, max, min, min)
+    return [lim(min_e, ext) for min_e, ext, lim in zip(min_extent, extent,
+                                                       lim_funct)]
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014 Geoscience Australia
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A spatial index of points, to quickly find the points in an area.
+"""
+
+import numpy
+
+# The average number of points in a bucket of the grid index
+BUCKET_POINTS = 16
+
+
+class GridIndex(object):
+
+    """
+    A spatial index of points, using a uniform grid of buckets over the
+    extent of the points.
+
+    The points are sorted by bucket, and the buckets of a grid row are
+    next to each other. So the points in a rectangle are found from one
+    slice of the sorted points for each row the rectangle covers, and
+    only the points in the buckets on the edges of the rectangle are
+    checked.
+
+    Points with NAN coordinates are not in any bucket, so they are never
+    found.
+    """
+
+    # pylint: disable=R0902
+    def __init__(self, lon, lat, bucket_points=BUCKET_POINTS):
+        """
+        :param lon: A 1D array of the longitude of the points.
+        :param lat: A 1D array of the latitude of the points.
+        :param bucket_points: The average number of points in a bucket.
+        """
+        assert lon.size == lat.size
+
+        # The arrays are kept, so the index can be checked against them
+        self.lon = lon
+        self.lat = lat
+
+        valid = numpy.isfinite(lon) & numpy.isfinite(lat)
+        valid_size = int(numpy.count_nonzero(valid))
+        if valid_size == 0:
+            self.min_long, self.min_lat = 0., 0.
+            width, height = 0., 0.
+        else:
+            self.min_long = float(lon[valid].min())
+            self.min_lat = float(lat[valid].min())
+            width = float(lon[valid].max()) - self.min_long
+            height = float(lat[valid].max()) - self.min_lat
+
+        # Buckets with about the same width and height
+        buckets = max(valid_size // bucket_points, 1)
+        if width > 0 and height > 0:
+            self.x_size = int(min(max(round(numpy.sqrt(
+                buckets * width / height)), 1), buckets))
+        elif width > 0:
+            self.x_size = buckets
+        else:
+            self.x_size = 1
+        self.y_size = max(buckets // self.x_size, 1) if height > 0 else 1
+        self.x_cell = width / self.x_size if width > 0 else 1.
+        self.y_cell = height / self.y_size if height > 0 else 1.
+
+        bucket = numpy.full(lon.size, self.x_size * self.y_size)
+        bucket[valid] = (self._rows(lat[valid]) * self.x_size +
+                         self._cols(lon[valid]))
+        # The points in each bucket are order[starts[b]:starts[b + 1]]
+        self.order = numpy.argsort(bucket, kind='stable')[:valid_size]
+        self.starts = self._bucket_starts(bucket[self.order])
+
+    @property
+    def size(self):
+        """
+        The number of points indexed.
+        """
+        return self.lon.size
+
+    def _cols(self, lon):
+        """
+        :returns: The bucket column of longitudes, limited to the grid.
+        """
+        cols = numpy.floor((lon - self.min_long) / self.x_cell)
+        return numpy.clip(cols, 0, self.x_size - 1).astype(int)
+
+    def _rows(self, lat):
+        """
+        :returns: The bucket row of latitudes, limited to the grid.
+        """
+        rows = numpy.floor((lat - self.min_lat) / self.y_cell)
+        return numpy.clip(rows, 0, self.y_size - 1).astype(int)
+
+    def _bucket_starts(self, sorted_buckets):
+        """
+        :param sorted_buckets: The bucket of each point, in bucket order.
+        :returns: The start of each bucket in the sorted points, and the
+            end of the last bucket.
+        """
+        counts = numpy.bincount(sorted_buckets,
+                                minlength=self.x_size * self.y_size)
+        starts = numpy.zeros(self.x_size * self.y_size + 1, dtype=int)
+        numpy.cumsum(counts, out=starts[1:])
+        return starts
+
+    def _candidates(self, min_long, min_lat, max_long, max_lat):
+        """
+        :returns: The indexes of the points in the buckets that overlap
+            a rectangle.
+        """
+        if self.order.size == 0 or min_long > max_long or min_lat > max_lat:
+            return numpy.array([], dtype=int)
+        col_start, col_end = self._cols(numpy.array([min_long, max_long]))
+        row_start, row_end = self._rows(numpy.array([min_lat, max_lat]))
+        slices = []
+        for row in range(row_start, row_end + 1):
+            first = row * self.x_size
+            slices.append(self.order[self.starts[first + col_start]:
+                                     self.starts[first + col_end + 1]])
+        return numpy.concatenate(slices)
+
+    def bbox(self, min_long, min_lat, max_long, max_lat):
+        """
+        Find the points in a rectangle. Points on the edges are in it.
+
+        :returns: A 1D integer array of the indexes of the points, in
+            ascending order.
+        """
+        candidates = self._candidates(min_long, min_lat, max_long, max_lat)
+        lon = self.lon[candidates]
+        lat = self.lat[candidates]
+        inside = ((lon >= min_long) & (lon <= max_long) &
+                  (lat >= min_lat) & (lat <= max_lat))
+        return numpy.sort(candidates[inside])
+
+    def polygon(self, vertices):
+        """
+        Find the points in a polygon.
+
+        :param vertices: An array, shape (vertices, 2), of the
+            (longitude, latitude) of the polygon vertices. e.g.
+            numpy.asarray(shapely_polygon.exterior.coords)
+        :returns: A 1D integer array of the indexes of the points, in
+            ascending order.
+        """
+        vertices = numpy.asarray(vertices, dtype=float)
+        min_long, min_lat = vertices.min(axis=0)
+        max_long, max_lat = vertices.max(axis=0)
+        candidates = self._candidates(min_long, min_lat, max_long, max_lat)
+        inside = points_in_polygon(self.lon[candidates],
+                                   self.lat[candidates], vertices)
+        return numpy.sort(candidates[inside])
+
+    def take(self, indexes, lon, lat):
+        """
+        Make the index of a subset of the points, without sorting them
+        again. The buckets are the same.
+
+        :param indexes: A 1D integer array of the points in the subset,
+            in the order of the subset.
+        :param lon: A 1D array of the longitude of the subset points.
+        :param lat: A 1D array of the latitude of the subset points.
+        :returns: A GridIndex instance.
+        """
+        subset = self.__class__.__new__(self.__class__)
+        subset.__dict__.update(self.__dict__)
+        subset.lon = lon
+        subset.lat = lat
+
+        position = numpy.full(self.size, -1)
+        position[indexes] = numpy.arange(len(indexes))
+        order = position[self.order]
+        kept = order >= 0
+        subset.order = order[kept]
+        buckets = numpy.repeat(numpy.arange(self.starts.size - 1),
+                               numpy.diff(self.starts))
+        subset.starts = subset._bucket_starts(buckets[kept])
+        return subset
+
+
+def points_in_polygon(lon, lat, vertices):
+    """
+    Find if points are in a polygon, using the even-odd rule.
+
+    :param lon: A 1D array of the longitude of the points.
+    :param lat: A 1D array of the latitude of the points.
+    :param vertices: An array, shape (vertices, 2), of the
+        (longitude, latitude) of the polygon vertices.
+    :returns: A 1D boolean array, True for points in the polygon.
+    """
+    inside = numpy.zeros(lon.size, dtype=bool)
+    x_start, y_start = vertices[-1]
+    for x_end, y_end in vertices:
+        # The edges that a ray from each point to the east crosses
+        crosses = (y_end > lat) != (y_start > lat)
+        x_cross = (x_start + (lat[crosses] - y_start) *
+                   (x_end - x_start) / (y_end - y_start))
+        inside[crosses] ^= lon[crosses] < x_cross
+        x_start, y_start = x_end, y_end
+    return inside
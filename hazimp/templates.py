@@ -49,6 +49,7 @@ CALCCONTLOSS = 'calc_cont_loss'
 PERMUTATION = 'exposure_permutation'
 VULNFILE = 'vulnerability_filename'
 VULNSET = 'vulnerability_set'
+VULNCACHE = 'vulnerability_cache'
 WINDV3 = 'wind_v3'
 WINDV4 = 'wind_v4'
 WINDV5 = 'wind_v5'
@@ -80,6 +81,56 @@ CONT_MAP = {SAVE_CONT: "_SAVE", NO_ACTION_CONT: "_NOACTION",
 INSURE_MAP = {INSURED: "_INSURED", UNINSURED: "_UNINSURED"}
 
 
+def _load_wind_atts(config_list):
+    """
+    Get the load_raster attributes from the load_wind section.
+
+    The section is either the hazard files, or a dictionary of the
+    file_list and other load_raster options, e.g. bands.
+
+    :param config_list: A list describing the simulation.
+    :returns: The attributes of the load_raster job.
+    """
+    load_wind = find_atts(config_list, LOADWINDTCRM)
+    if isinstance(load_wind, dict):
+        atts = dict(load_wind)
+    else:
+        atts = {'file_list': load_wind}
+    atts['attribute_label'] = '0.2s gust at 10m height m/s'
+    return atts
+
+
+def _save_atts(config_list):
+    """
+    Get the save_all attributes from the save section.
+
+    The section is either the file name, or a dictionary of the
+    file_name and other save_all options, e.g. columns.
+
+    :param config_list: A list describing the simulation.
+    :returns: The attributes of the save_all job.
+    """
+    save = find_atts(config_list, SAVE)
+    if isinstance(save, dict):
+        return dict(save)
+    return {'file_name': save}
+
+
+def _vulnerability_atts(config_list, vul_filename):
+    """
+    Get the load_xml_vulnerability attributes.
+
+    The compiled curves are only cached if the optional
+    vulnerability_cache key is true.
+
+    :param config_list: A list describing the simulation.
+    :param vul_filename: The vulnerability file.
+    :returns: The attributes of the load_xml_vulnerability job.
+    """
+    use_cache = any(ele.get(VULNCACHE) for ele in config_list)
+    return {'file_name': vul_filename, 'use_cache': bool(use_cache)}
+
+
 def _wind_v3_reader(config_list):
     """
     From a wind configuration list build the job list.
@@ -92,14 +143,13 @@ def _wind_v3_reader(config_list):
     atts = find_atts(config_list, LOADCSVEXPOSURE)
     add_job(job_insts, LOADCSVEXPOSURE, atts)
 
-    file_list = find_atts(config_list, LOADWINDTCRM)
-    atts = {'file_list': file_list,
-            'attribute_label': '0.2s gust at 10m height m/s'}
+    atts = _load_wind_atts(config_list)
     add_job(job_insts, LOADRASTER, atts)
 
     vul_filename = os.path.join(misc.RESOURCE_DIR,
                                 'synthetic_domestic_wind_vul_curves.xml')
-    add_job(job_insts, LOADXMLVULNERABILITY, {'file_name': vul_filename})
+    add_job(job_insts, LOADXMLVULNERABILITY,
+            _vulnerability_atts(config_list, vul_filename))
 
     # The vulnerabilitySetID from the nrml file = 'domestic_flood_2012'
     # The column title in the exposure file = 'WIND_VULNERABILITY_FUNCTION_ID'
@@ -124,10 +174,9 @@ def _wind_v3_reader(config_list):
         'var_out': 'structural_loss'}
     add_job(job_insts, MDMULT, attributes)
 
-    file_name = find_atts(config_list, SAVE)
-    add_job(job_insts, SAVEALL, {'file_name': file_name})
+    add_job(job_insts, SAVEALL, _save_atts(config_list))
 
-    file_name = find_atts(config_list, SAVE)
+    file_name = _save_atts(config_list)['file_name']
     base, ext = os.path.splitext(file_name)
     file_name = f"{base}.xml"
     add_job(job_insts, SAVEPROVENANCE, {'file_name': file_name})
@@ -147,14 +196,13 @@ def _wind_v4_reader(config_list):
     atts = find_atts(config_list, LOADCSVEXPOSURE)
     add_job(job_insts, LOADCSVEXPOSURE, atts)
 
-    file_list = find_atts(config_list, LOADWINDTCRM)
-    atts = {'file_list': file_list,
-            'attribute_label': '0.2s gust at 10m height m/s'}
+    atts = _load_wind_atts(config_list)
     add_job(job_insts, LOADRASTER, atts)
 
     vul_filename = os.path.join(misc.RESOURCE_DIR, 
                                 find_atts(config_list, VULNFILE))
-    add_job(job_insts, LOADXMLVULNERABILITY, {'file_name': vul_filename})
+    add_job(job_insts, LOADXMLVULNERABILITY,
+            _vulnerability_atts(config_list, vul_filename))
 
     # The vulnerabilitySetID from the nrml file = 'domestic_flood_2012'
     # The column title in the exposure file = 'WIND_VULNERABILITY_FUNCTION_ID'
@@ -179,10 +227,9 @@ def _wind_v4_reader(config_list):
         'var_out': 'structural_loss'}
     add_job(job_insts, MDMULT, attributes)
 
-    file_name = find_atts(config_list, SAVE)
-    add_job(job_insts, SAVEALL, {'file_name': file_name})
+    add_job(job_insts, SAVEALL, _save_atts(config_list))
         
-    file_name = find_atts(config_list, SAVE)
+    file_name = _save_atts(config_list)['file_name']
     base, ext = os.path.splitext(file_name)
     file_name = f"{base}.xml"
     add_job(job_insts, SAVEPROVENANCE, {'file_name': file_name})
@@ -233,7 +280,8 @@ def _wind_nc_reader(config_list):
 
     vul_filename = os.path.join(misc.RESOURCE_DIR,
                                 find_atts(config_list, VULNFILE))
-    add_job(job_insts, LOADXMLVULNERABILITY, {'file_name': vul_filename})
+    add_job(job_insts, LOADXMLVULNERABILITY,
+            _vulnerability_atts(config_list, vul_filename))
     
     # The column title in the exposure file = 'WIND_VULNERABILITY_FUNCTION_ID'
     vulnerability_set_id = find_atts(config_list, VULNSET)
@@ -272,8 +320,7 @@ def _wind_nc_reader(config_list):
         file_name = find_atts(config_list, SAVEAGG)
         add_job(job_insts, SAVEAGG, {'file_name': file_name})
 
-    file_name = find_atts(config_list, SAVE)
-    add_job(job_insts, SAVEALL, {'file_name': file_name})
+    add_job(job_insts, SAVEALL, _save_atts(config_list))
     
 
     if config_dict.get(AGGREGATE):
@@ -292,7 +339,7 @@ def _wind_nc_reader(config_list):
 
     # Eventually, this needs to be included in pipeline.Pipeline and
     # automatically added to the list of jobs
-    file_name = find_atts(config_list, SAVE)
+    file_name = _save_atts(config_list)['file_name']
     base, ext = os.path.splitext(file_name)
     file_name = f"{base}.xml"
     add_job(job_insts, SAVEPROVENANCE, {'file_name': file_name})
@@ -313,14 +360,13 @@ def _wind_v5_reader(config_list):
     atts = find_atts(config_list, LOADCSVEXPOSURE)
     add_job(job_insts, LOADCSVEXPOSURE, atts)
 
-    file_list = find_atts(config_list, LOADWINDTCRM)
-    atts = {'file_list': file_list,
-            'attribute_label': '0.2s gust at 10m height m/s'}
+    atts = _load_wind_atts(config_list)
     add_job(job_insts, LOADRASTER, atts)
 
     vul_filename = os.path.join(misc.RESOURCE_DIR, 
                                 find_atts(config_list, VULNFILE))
-    add_job(job_insts, LOADXMLVULNERABILITY, {'file_name': vul_filename})
+    add_job(job_insts, LOADXMLVULNERABILITY,
+            _vulnerability_atts(config_list, vul_filename))
 
     # The column title in the exposure file = 'WIND_VULNERABILITY_FUNCTION_ID'
     vulnerability_set_id = find_atts(config_list, VULNSET)
@@ -356,15 +402,14 @@ def _wind_v5_reader(config_list):
         attributes = find_atts(config_list, TABULATE)
         add_job(job_insts, TABULATE, attributes)
 
-    file_name = find_atts(config_list, SAVE)
-    add_job(job_insts, SAVEALL, {'file_name': file_name})
+    add_job(job_insts, SAVEALL, _save_atts(config_list))
     
     file_name = find_atts(config_list, SAVEAGG)
     add_job(job_insts, SAVEAGG, {'file_name': file_name})
 
     # Eventually, this needs to be included in pipeline.Pipeline and
     # automatically added to the list of jobs
-    file_name = find_atts(config_list, SAVE)
+    file_name = _save_atts(config_list)['file_name']
     base, ext = os.path.splitext(file_name)
     file_name = f"{base}.xml"
     add_job(job_insts, SAVEPROVENANCE, {'file_name': file_name})
@@ -391,7 +436,8 @@ def _flood_fabric_v2_reader(config_list):
     add_job(job_insts, LOADRASTER, atts)
     vul_filename = os.path.join(misc.RESOURCE_DIR,
                                 'fabric_flood_avg_curve.xml')
-    add_job(job_insts, LOADXMLVULNERABILITY, {'file_name': vul_filename})
+    add_job(job_insts, LOADXMLVULNERABILITY,
+            _vulnerability_atts(config_list, vul_filename))
 
     floor_height_value = find_atts(config_list, FLOOR_HEIGHT)
     atts = {'var': FLOOR_HEIGHT, 'value': floor_height_value}
@@ -421,10 +467,9 @@ def _flood_fabric_v2_reader(config_list):
         'var_out': 'structural_loss'}
     add_job(job_insts, MDMULT, attributes)
 
-    file_name = find_atts(config_list, SAVE)
-    add_job(job_insts, SAVEALL, {'file_name': file_name})
+    add_job(job_insts, SAVEALL, _save_atts(config_list))
 
-    file_name = find_atts(config_list, SAVE)
+    file_name = _save_atts(config_list)['file_name']
     base, ext = os.path.splitext(file_name)
     file_name = f"{base}.xml"
     add_job(job_insts, SAVEPROVENANCE, {'file_name': file_name})
@@ -453,7 +498,8 @@ def _flood_contents_v2_reader(config_list):  # pylint: disable=R0915
     add_job(job_insts, LOADRASTER, atts)
     vul_filename = os.path.join(misc.RESOURCE_DIR,
                                 'content_flood_avg_curve.xml')
-    add_job(job_insts, LOADXMLVULNERABILITY, {'file_name': vul_filename})
+    add_job(job_insts, LOADXMLVULNERABILITY,
+            _vulnerability_atts(config_list, vul_filename))
 
     floor_height_value = find_atts(config_list, FLOOR_HEIGHT)
     atts = {'var': FLOOR_HEIGHT, 'value': floor_height_value}
@@ -526,10 +572,9 @@ def _flood_contents_v2_reader(config_list):  # pylint: disable=R0915
         'var_out': 'contents_loss'}
     add_job(job_insts, MDMULT, attributes)
 
-    file_name = find_atts(config_list, SAVE)
-    add_job(job_insts, SAVEALL, {'file_name': file_name})
+    add_job(job_insts, SAVEALL, _save_atts(config_list))
 
-    file_name = find_atts(config_list, SAVE)
+    file_name = _save_atts(config_list)['file_name']
     base, ext = os.path.splitext(file_name)
     file_name = f"{base}.xml"
     add_job(job_insts, SAVEPROVENANCE, {'file_name': file_name})
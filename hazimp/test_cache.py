@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014 Geoscience Australia
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0904
+# Disable too many public methods for test cases
+
+"""
+Test the cache module.
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+import numpy
+from scipy import allclose, asarray
+
+from hazimp import cache
+from hazimp import misc
+from hazimp.jobs.vulnerability_model import (vuln_sets_from_xml_file,
+                                             cached_vuln_sets_from_xml_file,
+                                             lazy_vuln_sets_from_xml_file,
+                                             PARSER_VERSION)
+from hazimp.jobs.test_vulnerability_model import build_example
+
+
+class TestCache(unittest.TestCase):
+
+    """
+    Test the cache module
+    """
+
+    def setUp(self):
+        self.old_dir = os.environ.get(cache.CACHE_DIR_ENV)
+        self.dir = tempfile.mkdtemp()
+        os.environ[cache.CACHE_DIR_ENV] = self.dir
+
+    def tearDown(self):
+        if self.old_dir is None:
+            del os.environ[cache.CACHE_DIR_ENV]
+        else:
+            os.environ[cache.CACHE_DIR_ENV] = self.old_dir
+        shutil.rmtree(self.dir)
+
+    def test_file_hash(self):
+        filename = os.path.join(self.dir, 'a.txt')
+        with open(filename, 'w') as file_handle:
+            file_handle.write('hazimp')
+        self.assertEqual(cache.file_hash(filename, block_size=4),
+                         'ef7cd8e72e11eeb4dc0ce6f8407e80000032d47b')
+
+    def test_cached_vuln_sets(self):
+        filename = build_example()
+        expected = vuln_sets_from_xml_file(filename)
+
+        # The first load compiles the curves
+        actual = cached_vuln_sets_from_xml_file(filename)
+        name = 'vuln_%s_v%i.npz' % (cache.file_hash(filename), PARSER_VERSION)
+        self.assertTrue(os.path.exists(cache.cache_path(name)))
+        self.assertEqual(os.listdir(self.dir), [name])
+
+        # The second load reads the cache, which must match the xml
+        actual = cached_vuln_sets_from_xml_file(filename)
+        self.assertEqual(sorted(actual), sorted(expected))
+        for set_id, vuln_set in expected.items():
+            cached_set = actual[set_id]
+            for att in ['intensity_measure_type', 'vulnerability_set_id',
+                        'asset_category', 'loss_category', 'default_loss']:
+                self.assertEqual(getattr(cached_set, att),
+                                 getattr(vuln_set, att))
+            self.assertTrue(allclose(cached_set.intensity_measure_level,
+                                     vuln_set.intensity_measure_level))
+            for func_id, func in vuln_set.vulnerability_functions.items():
+                cached_func = cached_set.vulnerability_functions[func_id]
+                self.assertTrue(allclose(cached_func.mean_loss,
+                                         func.mean_loss))
+                self.assertTrue(allclose(cached_func.coefficient_of_variation,
+                                         func.coefficient_of_variation))
+                self.assertEqual(cached_func.distribution, func.distribution)
+
+        # Changing the file invalidates the cache
+        with open(filename, 'a') as file_handle:
+            file_handle.write('\n')
+        cached_vuln_sets_from_xml_file(filename)
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+        os.remove(filename)
+
+    def test_lazy_cached_vuln_sets(self):
+        filename = build_example()
+        vuln_sets = lazy_vuln_sets_from_xml_file(filename, use_cache=True)
+        os.remove(filename)
+
+        # The curves are read from the cache
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        self.assertEqual(vuln_sets['NPAGER'].function_ids, ['AA', 'BB'])
+        curves = vuln_sets['NPAGER'].build_realised_vuln_curves(['BB', 'AA'])
+        self.assertTrue(allclose(curves.look_up(asarray([8.0, 11.0])),
+                                 [0.06, 0.36]))
+        self.assertEqual(vuln_sets['PAGER'].loss_category, 'feathers')
+
+    def test_compile_vulnerability(self):
+        filename = build_example()
+        compiled = cache.compile_vulnerability([filename])
+        self.assertEqual(compiled, [filename])
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+        os.remove(filename)
+
+    def test_cached_csv2dict(self):
+        filename = os.path.join(self.dir, 'assets.csv')
+        with open(filename, 'w') as file_handle:
+            file_handle.write('LAT, LONG, ID, NAME, N\n')
+            file_handle.write('1.5, 2., IR, a, 1\n')
+            file_handle.write('4., 5., PK, , 2\n')
+            file_handle.write('5., 6., IR, c, 3\n')
+            file_handle.write('6., 7., IR, d, 4\n')
+        expected = misc.csv2dict(filename, add_ids=True, categorical='auto')
+
+        # The first read caches the file
+        actual = cache.cached_csv2dict(filename, add_ids=True,
+                                       categorical='auto')
+        name = cache.exposure_cache_name(filename, categorical='auto')
+        self.assertTrue(os.path.exists(os.path.join(cache.cache_path(name),
+                                                    cache.MANIFEST)))
+
+        # The second read memory maps the cached columns
+        actual = cache.cached_csv2dict(filename, add_ids=True,
+                                       categorical='auto')
+        self.assertIsInstance(actual['LAT'].values, numpy.memmap)
+        self.assertEqual(list(actual), list(expected))
+        for key in ['LAT', 'LONG', 'N', misc.INTID]:
+            self.assertEqual(actual[key].dtype, expected[key].dtype)
+            self.assertTrue(allclose(actual[key], expected[key]))
+        self.assertEqual(actual['ID'].dtype.name, 'category')
+        self.assertEqual(list(actual['ID']), ['IR', 'PK', 'IR', 'IR'])
+        self.assertEqual(actual['NAME'].tolist()[::2], ['a', 'c'])
+        self.assertTrue(numpy.isnan(actual['NAME'][1]))
+
+        # Changing the values changes a copy, not the cache
+        actual['LAT'].values[0] = 10.
+        actual = cache.cached_csv2dict(filename, usecols=['N', 'missing'])
+        self.assertEqual(list(actual), ['N'])
+        actual = cache.cached_csv2dict(filename, add_ids=True,
+                                       categorical='auto')
+        self.assertEqual(actual['LAT'][0], 1.5)
+
+        # Other options are cached separately
+        cache.cached_csv2dict(filename, categorical=None,
+                              dtype={'N': 'float32'})
+        self.assertEqual(len([name for name in os.listdir(self.dir)
+                              if os.path.isdir(cache.cache_path(name))]), 3)
+
+        # Changing the file invalidates the cache
+        with open(filename, 'a') as file_handle:
+            file_handle.write('7., 8., PK, e, 5\n')
+        actual = cache.cached_csv2dict(filename, categorical='auto')
+        self.assertEqual(len(actual), 5)
+
+        removed = cache.clear_cache(prefix=cache.EXPOSURE_PREFIX)
+        self.assertEqual(os.listdir(self.dir), ['assets.csv'])
+        # The exposure directories and the index of the file hash
+        self.assertEqual(len(removed), 5)
+
+
+# -------------------------------------------------------------
+if __name__ == "__main__":
+    SUITE = unittest.makeSuite(TestCache, 'test')
+    RUNNER = unittest.TextTestRunner()
+    RUNNER.run(SUITE)
@@ -32,10 +32,12 @@ import tempfile
 import os
 
 from hazimp import config
+from hazimp import templates
 from hazimp.calcs import calcs
 from hazimp.config_build import (find_atts, _get_job_or_calc,
-                                      check_1st_level_keys, file_can_open,
-                                      check_files_to_load, check_attributes)
+                                 check_1st_level_keys, file_can_open,
+                                 check_files_to_load, check_attributes,
+                                 add_job, set_exposure_columns)
 from hazimp.jobs import jobs
 
 
@@ -152,6 +154,35 @@ class TestConfig(unittest.TestCase):
         atts = find_atts(config_list, jobs.LOADCSVEXPOSURE)
         self.assertEqual(atts, actual_atts)
 
+    def test_set_exposure_columns(self):
+        job_insts = []
+        add_job(job_insts, jobs.LOADCSVEXPOSURE,
+                {'file_name': 'yeah', 'usecols': 'auto',
+                 'exposure_latitude': 'LAT'})
+        add_job(job_insts, jobs.SIMPLELINKER,
+                {'vul_functions_in_exposure': {'set1': 'WIND_ID'}})
+        add_job(job_insts, jobs.MDMULT,
+                {'var1': 'structural', 'var2': 'REPLACEMENT_VALUE',
+                 'var_out': 'structural_loss'})
+        add_job(job_insts, jobs.SAVEALL,
+                {'file_name': 'out.csv',
+                 'columns': ['structural_loss', 'SUBURB']})
+        set_exposure_columns(job_insts)
+        self.assertEqual(job_insts[0].atts_to_add['usecols'],
+                         ['LAT', 'exposure_longitude', 'WIND_ID', 'structural',
+                          'REPLACEMENT_VALUE', 'structural_loss', 'SUBURB'])
+
+    def test_vulnerability_atts(self):
+        # The compiled curves are only cached if asked for
+        config_list = [{templates.VULNFILE: 'curves.xml'}]
+        self.assertEqual(
+            templates._vulnerability_atts(config_list, 'curves.xml'),
+            {'file_name': 'curves.xml', 'use_cache': False})
+        config_list.append({templates.VULNCACHE: True})
+        self.assertEqual(
+            templates._vulnerability_atts(config_list, 'curves.xml'),
+            {'file_name': 'curves.xml', 'use_cache': True})
+
 # -------------------------------------------------------------
 if __name__ == "__main__":
     Suite = unittest.makeSuite(TestConfig, 'test')
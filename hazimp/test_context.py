@@ -31,12 +31,18 @@ import numpy
 import unittest
 import tempfile
 import os
+import pandas
 
 from scipy import allclose, array, arange
 
 from hazimp import context
 from hazimp import misc
 
+try:
+    import pyarrow  # pylint: disable=W0611
+except ImportError:
+    pyarrow = None
+
 
 class TestContext(unittest.TestCase):
 
@@ -112,6 +118,65 @@ class TestContext(unittest.TestCase):
                                      actual[key]))
         os.remove(f.name)
 
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_save_exposure_atts_parquet(self):
+        f = tempfile.NamedTemporaryFile(suffix='.parquet',
+                                        prefix='test_save_exposure_atts',
+                                        delete=False)
+        f.close()
+        con = context.Context()
+        con.set_prov_label('test label')
+        depth = array([[5., 4., 3.], [3., 2, 1], [30., 20, 10]])
+        con.exposure_att = {'shoes': array([10, 11, 12]),
+                            'depth': depth,
+                            misc.INTID: array([0, 1, 2])}
+        con.exposure_lat = array([1, 2., 3])
+        con.exposure_long = array([10., 20., 30])
+        con.set_exposure_const('floor', 0.5)
+        con.save_exposure_atts(f.name, use_parallel=False,
+                               compression='zstd')
+
+        exp_dict = misc.read_columnar(f.name)
+        # Unlike a csv file, the dtypes and shapes are kept
+        self.assertEqual(exp_dict['shoes'].dtype, numpy.int64)
+        self.assertTrue(allclose(exp_dict['depth'], depth))
+        self.assertTrue(allclose(exp_dict['floor'], [0.5, 0.5, 0.5]))
+        self.assertTrue(allclose(exp_dict[context.EX_LONG], [10., 20, 30]))
+        os.remove(f.name)
+
+    def test_save_csv(self):
+        f = tempfile.NamedTemporaryFile(suffix='.csv',
+                                        prefix='test_save_csv',
+                                        delete=False)
+        f.close()
+        write_dict = {'ID': arange(5),
+                      'loss': array([0.1, 2., numpy.nan, 4., 5.5]),
+                      context.EX_LONG: array([10., 20., 30., 40., 50.]),
+                      'name': array(['a', 'b,c', 'd"e', 'f', 'g']),
+                      'depth': arange(10.).reshape((5, 2)),
+                      context.EX_LAT: array([1., 2., 3., 4., 5.]),
+                      'type': pandas.Series(['x', 'y', 'x', 'x', 'y'],
+                                            dtype='category'),
+                      'wet': array([True, False, True, True, False])}
+        # Several blocks, with a short last block
+        context.save_csv(write_dict, f.name, chunk_size=2)
+
+        with open(f.name, newline='') as hnd:
+            lines = hnd.read().split('\r\n')
+        self.assertEqual(lines[0], 'exposure_latitude,exposure_longitude,'
+                                   'ID,loss,name,depth,type,wet')
+        self.assertEqual(lines[1], '1.0,10.0,0,0.1,a,0.5,x,1.0')
+        self.assertEqual(lines[2], '2.0,20.0,1,2.0,"b,c",2.5,y,0.0')
+        self.assertEqual(lines[3], '3.0,30.0,2,nan,"d""e",4.5,x,1.0')
+        self.assertEqual(lines[6], '')
+        self.assertEqual(len(lines), 7)
+
+        exp_dict = pandas.read_csv(f.name)
+        self.assertEqual(exp_dict['name'].tolist(),
+                         write_dict['name'].tolist())
+        self.assertTrue(allclose(exp_dict['depth'], [0.5, 2.5, 4.5, 6.5, 8.5]))
+        os.remove(f.name)
+
     def test_clip_exposure(self):
 
         # These points are in the HazImp notebook.
@@ -149,6 +214,140 @@ class TestContext(unittest.TestCase):
             self.assertTrue(allclose(con.exposure_att[key],
                                      actual[key]))
 
+        # Clipping again uses the index of the clipped points
+        index = con.exposure_index
+        self.assertTrue(index.lat is con.exposure_lat)
+        con.clip_exposure(min_lat=-36, max_lat=-30,
+                          min_long=120, max_long=140)
+        self.assertTrue(allclose(con.exposure_long, [121]))
+        self.assertTrue(allclose(con.exposure_att['d3'], d3_array[4:5]))
+
+    def test_clip_exposure_nan(self):
+        # A site with a NAN coordinate is kept, unless its other
+        # coordinate is outside the rectangle
+        con = context.Context()
+        con.exposure_lat = array([-30., numpy.nan, numpy.nan, -30., -23.,
+                                  numpy.nan])
+        con.exposure_long = array([130., 130., 110., numpy.nan, numpy.nan,
+                                   numpy.nan])
+        con.exposure_att = {'ID': arange(6)}
+        con.clip_exposure(min_lat=-36, max_lat=-24,
+                          min_long=120, max_long=140)
+        self.assertEqual(con.exposure_att['ID'].tolist(), [0, 1, 3, 5])
+        self.assertTrue(allclose(con.exposure_long[:2], [130., 130.]))
+
+    def test_clip_exposure_to_polygon(self):
+        con = context.Context()
+        con.exposure_lat = array([-23., -30., -35., -25.])
+        con.exposure_long = array([110., 120., 121., 139.])
+        con.exposure_att = {'ID': arange(4)}
+        con.clip_exposure_to_polygon([(115., -40.), (140., -40.),
+                                      (115., -20.)])
+        self.assertTrue(allclose(con.exposure_att['ID'], [1, 2]))
+        self.assertTrue(allclose(con.exposure_lat, [-30., -35.]))
+
+    def test_exposure_const(self):
+        f = tempfile.NamedTemporaryFile(suffix='.csv',
+                                        prefix='test_exposure_const',
+                                        delete=False)
+        f.close()
+        con = context.Context()
+        con.set_prov_label('test label')
+        con.exposure_lat = array([-23., -30., -35.])
+        con.exposure_long = array([110., 120., 121.])
+        con.exposure_att = pandas.DataFrame({'depth': [1., 2., 3.],
+                                             misc.INTID: arange(3)})
+        con.set_exposure_const('floor', 0.5)
+        self.assertNotIn('floor', con.exposure_att)
+        self.assertRaises(RuntimeError, con.set_exposure_const,
+                          'bad', [1., 2.])
+
+        # A column calculated from a constant and a column is a column
+        con.set_exposure_column('above_floor',
+                                con.get_exposure_column('depth') -
+                                con.get_exposure_column('floor'))
+        self.assertTrue(allclose(con.exposure_att['above_floor'],
+                                 [0.5, 1.5, 2.5]))
+
+        # Clipping doesn't change the constant
+        con.clip_exposure(min_lat=-36, max_lat=-24,
+                          min_long=115, max_long=125)
+        self.assertEqual(con.get_exposure_column('floor'), 0.5)
+
+        con.save_exposure_atts(f.name, use_parallel=False)
+        exp_dict = misc.csv2dict(f.name)
+        self.assertTrue(allclose(exp_dict['floor'], [0.5, 0.5]))
+        self.assertTrue(allclose(exp_dict['above_floor'], [1.5, 2.5]))
+        self.assertTrue(con.is_exposure_const('floor'))
+        os.remove(f.name)
+
+        # Setting a column replaces the constant
+        con.set_exposure_column('floor', array([0.1, 0.2]))
+        self.assertFalse(con.is_exposure_const('floor'))
+        self.assertTrue(allclose(con.get_exposure_column('floor'),
+                                 [0.1, 0.2]))
+
+        # A constant with a site dimension is clipped with the sites
+        con.set_exposure_const('wall', [1., 2.])
+        con.clip_exposure(min_lat=-36, max_lat=-32,
+                          min_long=115, max_long=125)
+        self.assertTrue(allclose(con.get_exposure_column('wall'), [2.]))
+        con.materialize_exposure_const(['wall'])
+        self.assertTrue(allclose(con.exposure_att['wall'], [2.]))
+        self.assertTrue(allclose(con.exposure_att['above_floor'], [2.5]))
+
+    def test_exposure_scratch(self):
+        scratch = tempfile.mkdtemp(prefix='test_exposure_scratch')
+        f = tempfile.NamedTemporaryFile(suffix='.npz',
+                                        prefix='test_exposure_scratch',
+                                        delete=False)
+        f.close()
+        con = context.Context()
+        con.set_prov_label('test label')
+        con.exposure_lat = array([-23., -30., -35.])
+        con.exposure_long = array([110., 120., 121.])
+        con.exposure_att = pandas.DataFrame({
+            'depth': [1., 2., 3.],
+            'type': pandas.Categorical(['a', 'b', 'a']),
+            misc.INTID: arange(3)})
+        con.set_exposure_scratch(scratch)
+        self.assertTrue(misc.is_memory_mapped(con.exposure_att['depth']))
+        self.assertTrue(misc.is_memory_mapped(con.exposure_att[misc.INTID]))
+        # Categorical columns stay in memory
+        self.assertEqual(con.exposure_att['type'].dtype.name, 'category')
+        self.assertEqual(len(os.listdir(con.exposure_scratch.name)), 2)
+
+        # New and changed columns are mapped after each job
+        con.set_exposure_column('loss', con.get_exposure_column('depth') * 2)
+        con.set_exposure_column('depth', array([4., 5., 6.]))
+        self.assertFalse(misc.is_memory_mapped(con.exposure_att['loss']))
+        con.map_exposure_columns()
+        self.assertTrue(misc.is_memory_mapped(con.exposure_att['loss']))
+        self.assertTrue(misc.is_memory_mapped(con.exposure_att['depth']))
+        self.assertTrue(allclose(con.exposure_att['loss'], [2., 4., 6.]))
+        self.assertEqual(list(con.exposure_att.columns),
+                         ['depth', 'type', misc.INTID, 'loss'])
+        # The file of the old depth values is removed
+        self.assertEqual(len(os.listdir(con.exposure_scratch.name)), 3)
+
+        con.save_exposure_atts(f.name, use_parallel=False)
+        with numpy.load(f.name) as exp_dict:
+            self.assertTrue(allclose(exp_dict['depth'], [4., 5., 6.]))
+            self.assertTrue(allclose(exp_dict['loss'], [2., 4., 6.]))
+        os.remove(f.name)
+
+        # Clipping makes new arrays, which are mapped again
+        con.clip_exposure(min_lat=-36, max_lat=-24,
+                          min_long=115, max_long=125)
+        con.map_exposure_columns()
+        self.assertTrue(misc.is_memory_mapped(con.exposure_att['loss']))
+        self.assertTrue(allclose(con.exposure_att['loss'], [4., 6.]))
+
+        directory = con.exposure_scratch.name
+        con.exposure_scratch.cleanup()
+        self.assertFalse(os.path.exists(directory))
+        os.rmdir(scratch)
+
 
 # -------------------------------------------------------------
 if __name__ == "__main__":
@@ -36,6 +36,7 @@ import tempfile
 import os
 
 import numpy
+import pandas
 from scipy import allclose
 from zipfile import ZipFile
 from moto import mock_s3
@@ -45,7 +46,15 @@ from hazimp.misc import (csv2dict, get_required_args, sorted_dict_values,
                          get_temporary_directory, s3_path_segments_from_vsis3,
                          create_temporary_file_path_for_s3_if_applicable,
                          download_from_s3, upload_to_s3_if_applicable,
-                         download_file_from_s3_if_needed)
+                         download_file_from_s3_if_needed, add,
+                         insert_columns, write_columnar, read_columnar,
+                         csv2dict_blocks, ColumnarWriter,
+                         read_columnar_blocks, memory_map, is_memory_mapped)
+
+try:
+    import pyarrow  # pylint: disable=W0611
+except ImportError:
+    pyarrow = None
 
 
 class TestMisc(unittest.TestCase):
@@ -80,6 +89,221 @@ class TestMisc(unittest.TestCase):
                                          actual[key]))
         os.remove(f.name)
 
+    def test_csv2dict_usecols(self):
+        f = tempfile.NamedTemporaryFile(suffix='.txt',
+                                        prefix='test_misc',
+                                        delete=False,
+                                        mode='w+t')
+        f.write('X, Y, Z, A\n')
+        f.write('1., 2., 3., yeah\n')
+        f.write('4., 5., 6.,me \n')
+        f.close()
+
+        # Columns that are not in the file are ignored
+        file_dict = csv2dict(f.name, usecols=['Z', 'X', 'missing'],
+                             dtype={'Z': 'float32', 'A': 'float32'})
+        self.assertEqual(sorted(file_dict), ['X', 'Z'])
+        self.assertEqual(file_dict['Z'].dtype, numpy.float32)
+        self.assertTrue(allclose(file_dict['X'], [1., 4.]))
+        os.remove(f.name)
+
+    def test_csv2dict_categorical(self):
+        f = tempfile.NamedTemporaryFile(suffix='.txt',
+                                        prefix='test_misc',
+                                        delete=False,
+                                        mode='w+t')
+        f.write('X, ID, NAME\n')
+        f.write('1., IR, a\n')
+        f.write('4., PK, b\n')
+        f.write('5., IR, c\n')
+        f.write('6., IR, d\n')
+        f.close()
+
+        # Strings with few unique values are categorical
+        file_dict = csv2dict(f.name, categorical='auto',
+                             dtype={'X': 'float32'})
+        self.assertEqual(file_dict['ID'].dtype.name, 'category')
+        self.assertEqual(list(file_dict['ID'].cat.categories), ['IR', 'PK'])
+        self.assertEqual(list(file_dict['ID']), ['IR', 'PK', 'IR', 'IR'])
+        self.assertEqual(file_dict['NAME'].dtype, object)
+        self.assertEqual(file_dict['X'].dtype, numpy.float32)
+
+        file_dict = csv2dict(f.name, categorical=['NAME'])
+        self.assertEqual(file_dict['ID'].dtype, object)
+        self.assertEqual(file_dict['NAME'].dtype.name, 'category')
+        self.assertRaises(RuntimeError, csv2dict, f.name, categorical='all')
+
+        # Categorical strings can still be added
+        self.assertEqual(list(add(file_dict['NAME'], file_dict['ID'])),
+                         ['aIR', 'bPK', 'cIR', 'dIR'])
+        os.remove(f.name)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_columnar(self):
+        write_dict = {'X': numpy.array([1.5, 2.5, numpy.nan]),
+                      'N': numpy.array([1, 2, 3], dtype=numpy.int32),
+                      'ID': pandas.Series(['IR', 'PK', 'IR'],
+                                          dtype='category'),
+                      'NAME': numpy.array(['a', 'b', 'c']),
+                      'depth': numpy.arange(12.).reshape((3, 2, 2))}
+        for suffix, compression in [('.parquet', {'X': 'zstd'}),
+                                    ('.feather', 'zstd')]:
+            f = tempfile.NamedTemporaryFile(suffix=suffix,
+                                            prefix='test_misc',
+                                            delete=False)
+            f.close()
+            write_columnar(write_dict, f.name, compression=compression)
+            read_dict = read_columnar(f.name)
+            self.assertEqual(list(read_dict), list(write_dict))
+            self.assertTrue(allclose(read_dict['X'], write_dict['X'],
+                                     equal_nan=True))
+            self.assertEqual(read_dict['N'].dtype, numpy.int32)
+            self.assertEqual(list(read_dict['ID']), ['IR', 'PK', 'IR'])
+            self.assertEqual(read_dict['ID'].dtype.name, 'category')
+            self.assertEqual(list(read_dict['NAME']), ['a', 'b', 'c'])
+            # Multi-dimensional arrays keep their shape
+            self.assertEqual(read_dict['depth'].shape, (3, 2, 2))
+            self.assertTrue(allclose(read_dict['depth'],
+                                     write_dict['depth']))
+
+            # An exposure file can't have multi-dimensional columns
+            self.assertRaises(RuntimeError, csv2dict, f.name)
+            del write_dict['depth']
+            write_columnar(write_dict, f.name)
+            file_dict = csv2dict(f.name, add_ids=True,
+                                 dtype={'X': 'float32'})
+            self.assertEqual(file_dict['X'].dtype, numpy.float32)
+            self.assertEqual(file_dict['ID'].dtype.name, 'category')
+            self.assertEqual(list(file_dict['internal_id']), [0, 1, 2])
+            write_dict['depth'] = numpy.arange(12.).reshape((3, 2, 2))
+            os.remove(f.name)
+
+    def test_csv2dict_blocks(self):
+        f = tempfile.NamedTemporaryFile(suffix='.txt',
+                                        prefix='test_misc',
+                                        delete=False,
+                                        mode='w+t')
+        f.write('X, ID, NAME\n')
+        f.write('1., IR, a\n')
+        f.write('4., PK, b\n')
+        f.write('5., IR, c\n')
+        f.write('6., IR, d\n')
+        f.write('7., PK, e\n')
+        f.close()
+
+        whole = csv2dict(f.name, add_ids=True, usecols=['X', 'ID'])
+        blocks = list(csv2dict_blocks(f.name, 4, add_ids=True,
+                                      categorical='auto',
+                                      usecols=['X', 'ID']))
+        self.assertEqual([len(block) for block in blocks], [4, 1])
+        # The ids are numbered across the blocks
+        self.assertEqual(list(blocks[1]['internal_id']), [4])
+        # The categorical columns are chosen on the first block
+        self.assertEqual(blocks[1]['ID'].dtype.name, 'category')
+        dframe = pandas.concat(blocks)
+        self.assertEqual(list(dframe.columns), list(whole.columns))
+        self.assertTrue(allclose(dframe['X'], whole['X']))
+        self.assertEqual(list(dframe['ID']), list(whole['ID']))
+        self.assertEqual(list(dframe['internal_id']),
+                         list(whole['internal_id']))
+        os.remove(f.name)
+
+    def test_csv2dict_blocks_dtypes(self):
+        f = tempfile.NamedTemporaryFile(suffix='.txt',
+                                        prefix='test_misc',
+                                        delete=False,
+                                        mode='w+t')
+        f.write('N, M, X, NAME\n')
+        f.write('1, 10, 1., a\n')
+        f.write('2, 20, 2., b\n')
+        f.write('3, , , c\n')
+        f.write(', 40, , d\n')
+        f.close()
+
+        blocks = list(csv2dict_blocks(f.name, 2, dtype={'M': 'float32'}))
+        # The missing values are only in the second block
+        for block in blocks:
+            self.assertEqual(block['N'].dtype, numpy.float64)
+            self.assertEqual(block['M'].dtype, numpy.float32)
+            self.assertEqual(block['X'].dtype, numpy.float64)
+            self.assertEqual(block['NAME'].dtype, object)
+        dframe = pandas.concat(blocks)
+        self.assertTrue(allclose(dframe['N'], [1., 2., 3., numpy.nan],
+                                 equal_nan=True))
+        self.assertTrue(allclose(dframe['M'], [10., 20., numpy.nan, 40.],
+                                 equal_nan=True))
+
+        # A column can't change from numbers to strings
+        with open(f.name, 'w') as hnd:
+            hnd.write('N, X\n')
+            hnd.write('1, 1.\n')
+            hnd.write('2, x\n')
+        self.assertRaises(RuntimeError, list,
+                          csv2dict_blocks(f.name, 1))
+        os.remove(f.name)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_columnar_blocks(self):
+        blocks = [{'X': numpy.array([1.5, 2.5]),
+                   'ID': pandas.Series(['IR', 'PK'], dtype='category'),
+                   'depth': numpy.arange(4.).reshape((2, 2))},
+                  {'X': numpy.array([3.5]),
+                   'ID': pandas.Series(['CZ'], dtype='category'),
+                   'depth': numpy.arange(2.).reshape((1, 2))}]
+        for suffix in ['.parquet', '.feather']:
+            f = tempfile.NamedTemporaryFile(suffix=suffix,
+                                            prefix='test_misc',
+                                            delete=False)
+            f.close()
+            writer = ColumnarWriter(f.name, compression='zstd')
+            for block in blocks:
+                writer.write(block)
+            self.assertRaises(RuntimeError, writer.write,
+                              {'X': numpy.array(['a'])})
+            writer.close()
+
+            read_dict = read_columnar(f.name)
+            self.assertTrue(allclose(read_dict['X'], [1.5, 2.5, 3.5]))
+            self.assertEqual(list(read_dict['ID']), ['IR', 'PK', 'CZ'])
+            self.assertEqual(read_dict['depth'].shape, (3, 2))
+
+            read_blocks = list(read_columnar_blocks(f.name, 2,
+                                                    columns=['X', 'Y']))
+            self.assertEqual([list(block) for block in read_blocks],
+                             [['X'], ['X']])
+            self.assertTrue(allclose(read_blocks[1]['X'], [3.5]))
+            os.remove(f.name)
+
+    def test_insert_columns(self):
+        dframe = pandas.DataFrame({'A': [1., 2.], 'B': [3., 4.]})
+        dframe = insert_columns(dframe, {'B': numpy.array([5., 6.]),
+                                         'C': numpy.array([7., 8.])})
+        self.assertEqual(list(dframe.columns), ['A', 'B', 'C'])
+        self.assertTrue(allclose(dframe['B'], [5., 6.]))
+        self.assertTrue(allclose(dframe['C'], [7., 8.]))
+
+        adict = insert_columns({'A': 1}, {'C': 2})
+        self.assertEqual(adict, {'A': 1, 'C': 2})
+
+    def test_insert_columns_memory_mapped(self):
+        f = tempfile.NamedTemporaryFile(suffix='.npy',
+                                        prefix='test_misc',
+                                        delete=False)
+        f.close()
+        mapped = memory_map(numpy.array([1., 2.]), f.name)
+        self.assertTrue(is_memory_mapped(mapped))
+        self.assertFalse(is_memory_mapped(mapped * 2))
+        self.assertTrue(allclose(numpy.load(f.name), [1., 2.]))
+
+        dframe = pandas.DataFrame({'A': mapped, 'B': [3., 4.]}, copy=False)
+        dframe = insert_columns(dframe, {'C': numpy.array([7., 8.])})
+        self.assertEqual(list(dframe.columns), ['A', 'B', 'C'])
+        # The memory mapped column is not copied
+        self.assertTrue(is_memory_mapped(dframe['A']))
+        self.assertTrue(allclose(dframe['C'], [7., 8.]))
+        del mapped, dframe
+        os.remove(f.name)
+
     def test_get_required_args(self):
         def yeah(mandatory, why=0, me=1):
             """
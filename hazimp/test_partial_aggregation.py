@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014 Geoscience Australia
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=C0103
+# Since function names are based on what they are testing,
+# and if they are testing classes the function names will have capitals
+# C0103: 16:TestCalcs.test_AddTest: Invalid name "test_AddTest"
+# (should match [a-z_][a-z0-9_]{2,50}$)
+# pylint: disable=R0904
+# Disable too many public methods for test cases
+
+"""
+Test the partial_aggregation module.
+"""
+
+import unittest
+
+import numpy
+import pandas
+from scipy import allclose
+
+from hazimp.partial_aggregation import PartialAggregation
+
+
+class TestPartialAggregation(unittest.TestCase):
+
+    """
+    Test the partial_aggregation module
+    """
+
+    def setUp(self):
+        rng = numpy.random.RandomState(7)
+        self.dframe = pandas.DataFrame({
+            'region': pandas.Categorical(rng.choice(['a', 'b', 'c'], 50)),
+            'kind': rng.choice([1, 2], 50),
+            'loss': rng.rand(50) * 1000.,
+            'value': rng.randint(0, 100, 50)})
+        self.dframe.loc[3, 'loss'] = numpy.nan
+
+    def test_aggregation(self):
+        aggs = {'loss': ['sum', 'count', 'mean', 'var', 'std', 'min', 'max'],
+                'value': ['sum', 'mean', 'size', 'max']}
+        for groupby in ['region', ['region', 'kind']]:
+            aggregation = PartialAggregation(groupby, aggs)
+            # Blocks of different sizes, with a group missing from some
+            for start, stop in [(0, 1), (1, 13), (13, 40), (40, 50)]:
+                aggregation.add(self.dframe.iloc[start:stop])
+            actual = aggregation.result()
+            expected = self.dframe.groupby(groupby, observed=True).agg(aggs)
+            self.assertEqual(sorted(actual.columns),
+                             sorted(expected.columns))
+            self.assertEqual(len(actual), len(expected))
+            for column in expected.columns:
+                self.assertTrue(allclose(
+                    actual[column],
+                    expected[column].reindex(actual.index).astype(float)),
+                    column)
+            self.assertTrue(allclose(
+                aggregation.size(),
+                self.dframe.groupby(groupby).size().reindex(
+                    aggregation.size().index)))
+
+    def test_aggregation_string(self):
+        aggregation = PartialAggregation('region', {'value': 'sum'})
+        aggregation.add(self.dframe.iloc[:20])
+        aggregation.add(self.dframe.iloc[20:])
+        actual = aggregation.result()
+        expected = self.dframe.groupby('region').agg({'value': 'sum'})
+        self.assertEqual(list(actual.columns), ['value'])
+        self.assertEqual(actual['value'].dtype, numpy.int64)
+        self.assertEqual(list(actual['value']), list(expected['value']))
+
+    def test_bad_function(self):
+        self.assertRaises(RuntimeError, PartialAggregation, 'region',
+                          {'loss': ['sum', 'median']})
+
+
+# -------------------------------------------------------------
+if __name__ == "__main__":
+    Suite = unittest.makeSuite(TestPartialAggregation, 'test')
+    Runner = unittest.TextTestRunner()
+    Runner.run(Suite)
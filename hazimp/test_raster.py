@@ -33,12 +33,50 @@ Test the raster module.
 
 import unittest
 import tempfile
+import shutil
 import os
 
 import numpy
+import gdal
 from scipy import asarray, allclose, nan
 
-from hazimp.raster import Raster, recalc_max, files_raster_data_at_points
+from hazimp.raster import (Raster, BlockRaster, PixelIndexCache,
+                           PIXEL_INDEX_CACHE, recalc_max, is_tiled,
+                           files_raster_data_at_points,
+                           file_reduce_bands_at_points, files_extent)
+from hazimp.cache import CACHE_DIR_ENV
+from hazimp import raster as raster_module
+
+
+def build_tiled_tif(data, upper_left_x, upper_left_y, cell_size,
+                    block_size, no_data_value=-9999):
+    """Build a tiled GeoTIFF file.
+
+    data is 2D, or 3D (bands, rows, columns) for several bands.
+    no_data_value can be a list, with a value for each band.
+    If you call this remember to delete the file;  os.remove(filename).
+
+    Returns:
+        The name of the file
+    """
+    handle, filename = tempfile.mkstemp(suffix='.tif', prefix='test_raster')
+    os.close(handle)
+    data = data.reshape((-1,) + data.shape[-2:])
+    no_data_values = numpy.broadcast_to(no_data_value, data.shape[:1])
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(filename, data.shape[2], data.shape[1],
+                            data.shape[0], gdal.GDT_Float32,
+                            options=['TILED=YES',
+                                     'BLOCKXSIZE=%i' % block_size,
+                                     'BLOCKYSIZE=%i' % block_size])
+    dataset.SetGeoTransform((upper_left_x, cell_size, 0.0,
+                             upper_left_y, 0.0, -cell_size))
+    for index, band_data in enumerate(data):
+        band = dataset.GetRasterBand(index + 1)
+        band.SetNoDataValue(float(no_data_values[index]))
+        band.WriteArray(band_data)
+    dataset.FlushCache()
+    return filename
 
 
 class TestRaster(unittest.TestCase):
@@ -176,6 +214,23 @@ class TestRaster(unittest.TestCase):
 
         self.assertEqual(max_extent, [0, 0, 5, 4])
 
+        # Only reading the window around the points gives the same result
+        data, max_extent = files_raster_data_at_points(lon, lat, files,
+                                                       read_mode='window')
+        numpy.testing.assert_equal(data, actual)
+        self.assertEqual(max_extent, [0, 0, 5, 4])
+
+        # Reading the files at the same time gives the same result
+        data, max_extent = files_raster_data_at_points(lon, lat,
+                                                       files + files[::-1],
+                                                       workers=3)
+        numpy.testing.assert_equal(data, numpy.hstack((actual,
+                                                       actual[:, ::-1])))
+        self.assertEqual(max_extent, [0, 0, 5, 4])
+
+        self.assertRaises(RuntimeError, files_raster_data_at_points,
+                          lon, lat, files, read_mode='bad')
+
         for a_file in files:
             os.remove(a_file)
 
@@ -215,6 +270,362 @@ class TestRaster(unittest.TestCase):
         self.assertEqual(max_long, 200)
         self.assertEqual(max_lat, 300)
 
+    def test4_raster_data_at_edges(self):
+        raster = Raster.from_array([[1., 2., 3.], [4., 5., 6.]],
+                                   0., 10., 1., -9999)
+        # lon 0 - 3
+        # lat 8 - 10
+
+        # Corners, edges and outside points
+        lon = asarray([0., 3., 3., 0., 1., 3., 1.5, 3.0001, nan])
+        lat = asarray([10., 10., 8., 8., 8., 9., 10., 9., 9.])
+        data = raster.raster_data_at_points(lon, lat)
+        numpy.testing.assert_equal(
+            data, asarray([1., 3., 6., 4., 5., 6., 2., nan, nan]))
+
+        rows, cols, inside = raster.pixel_indices(lon, lat)
+        numpy.testing.assert_equal(inside, [True] * 7 + [False] * 2)
+        numpy.testing.assert_equal(rows, [0, 0, 1, 1, 1, 1, 0])
+        numpy.testing.assert_equal(cols, [0, 2, 2, 0, 1, 2, 1])
+
+    def test4_raster_unique_pixels(self):
+        raster = Raster.from_array([[1., 2., 3.], [4., 5., 6.]],
+                                   0., 10., 1., -9999)
+        sampled = []
+
+        def values_at_pixels(rows, cols):
+            sampled.append((rows, cols))
+            return raster.raster[rows, cols]
+        raster.values_at_pixels = values_at_pixels
+
+        # Many points in 2 pixels
+        lon = asarray([2.5, 0.5] * 50)
+        lat = asarray([8.5, 9.5] * 50)
+        data = raster.raster_data_at_points(lon, lat)
+        numpy.testing.assert_equal(data, asarray([6., 1.] * 50))
+        self.assertEqual(len(sampled), 1)
+        numpy.testing.assert_equal(sampled[0][0], [0, 1])
+        numpy.testing.assert_equal(sampled[0][1], [0, 2])
+
+    def test5_raster_window_from_file(self):
+        f = tempfile.NamedTemporaryFile(suffix='.aai',
+                                        prefix='test_raster',
+                                        delete=False,
+                                        mode='w+t')
+        f.write('ncols 6\r\n')
+        f.write('nrows 5\r\n')
+        f.write('xllcorner 0.0\r\n')
+        f.write('yllcorner 0.0\r\n')
+        f.write('cellsize 1.0\r\n')
+        f.write('NODATA_value -9999\r\n')
+        for row in range(5):
+            f.write(' '.join(str(row * 10 + col) for col in range(6)))
+            f.write('\r\n')
+        f.close()
+        # lon 0 - 6
+        # lat 0 - 5
+
+        lon = asarray([2.5, 3.5, 20.])
+        lat = asarray([2.5, 1.5, 20.])
+        raster = Raster.from_file(f.name, lon, lat, margin=1)
+        # The points are in pixel rows 2 - 3, columns 2 - 3
+        # With the margin, rows 1 - 4, columns 1 - 4 are read
+        self.assertEqual(raster.window, (1, 1, 4, 4))
+        self.assertEqual(raster.raster.shape, (4, 4))
+        # The grid is the grid of the whole file
+        self.assertEqual(raster.ul_x, 0.)
+        self.assertEqual(raster.ul_y, 5.)
+        self.assertEqual(raster.x_size, 6)
+        self.assertEqual(raster.y_size, 5)
+        self.assertEqual(raster.extent(), (0., 0., 6., 5.))
+        self.assertEqual(raster.file_extent, (0., 0., 6., 5.))
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   [22., 33., nan])
+        # Points in the file, outside of the window, have no data
+        numpy.testing.assert_equal(
+            raster.raster_data_at_points(asarray([0.5]), asarray([4.5])),
+            [nan])
+
+        # No points in the raster
+        raster = Raster.from_file(f.name, lon[2:], lat[2:])
+        self.assertEqual(raster.window[2:], (0, 0))
+        self.assertEqual(raster.file_extent, (0., 0., 6., 5.))
+        numpy.testing.assert_equal(
+            raster.raster_data_at_points(lon, lat), [nan, nan, nan])
+        os.remove(f.name)
+
+    def test5_raster_window_edges(self):
+        # A grid whose pixel edges are not exact in binary
+        f = tempfile.NamedTemporaryFile(suffix='.aai',
+                                        prefix='test_raster',
+                                        delete=False,
+                                        mode='w+t')
+        f.write('ncols 7\r\n')
+        f.write('nrows 9\r\n')
+        f.write('xllcorner 114.3\r\n')
+        f.write('yllcorner -31.7\r\n')
+        f.write('cellsize 0.1\r\n')
+        f.write('NODATA_value -9999\r\n')
+        for row in range(9):
+            f.write(' '.join(str(row * 10 + col) for col in range(7)))
+            f.write('\r\n')
+        f.close()
+
+        # Points on every pixel boundary, including the far edges
+        lon, lat = numpy.meshgrid(114.3 + 0.1 * numpy.arange(3, 8),
+                                  -31.7 + 0.1 * numpy.arange(0, 5))
+        lon = lon.ravel()
+        lat = lat.ravel()
+        full = Raster.from_file(f.name)
+        window = Raster.from_file(f.name, lon, lat, margin=0)
+        self.assertTrue(window.raster.size < full.raster.size)
+        expected = full.raster_data_at_points(lon, lat)
+        self.assertFalse(numpy.isnan(expected).any())
+        numpy.testing.assert_equal(window.raster_data_at_points(lon, lat),
+                                   expected)
+        os.remove(f.name)
+
+    def test6_block_raster(self):
+        data = numpy.arange(48 * 40, dtype=numpy.float32).reshape((40, 48))
+        data[5, 7] = -9999
+        filename = build_tiled_tif(data, 100., -10., 0.5, 16)
+        self.assertTrue(is_tiled(filename))
+
+        rng = numpy.random.RandomState(3)
+        lon = rng.uniform(99., 125., size=500)
+        lat = rng.uniform(-31., -9., size=500)
+        lon[:2] = [100 + 7.5 * 0.5, 124.]
+        lat[:2] = [-10 - 5.5 * 0.5, -30.]
+        expected = Raster.from_file(filename).raster_data_at_points(lon, lat)
+        self.assertTrue(numpy.isnan(expected[0]))
+        self.assertEqual(expected[1], data[-1, -1])
+
+        raster = BlockRaster.from_file(filename)
+        self.assertEqual(raster.extent(), (100., -30., 124., -10.))
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected)
+        # 3 x 3 blocks, each is read once
+        self.assertEqual(raster.blocks_read, 9)
+        raster.raster_data_at_points(lon, lat)
+        self.assertEqual(raster.blocks_read, 9)
+
+        # The cache only holds 2 full blocks
+        raster = BlockRaster.from_file(filename, cache_bytes=2 * 16 * 16 * 4)
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected)
+        self.assertTrue(raster.cache_size <= 2 * 16 * 16 * 4)
+        # The last row of blocks is half height
+        self.assertEqual(len(raster.blocks), 3)
+        self.assertEqual(list(raster.blocks), [(0, 32), (16, 32), (32, 32)])
+
+        # Tiled files are read in blocks by default
+        actual, extent = files_raster_data_at_points(lon, lat, [filename])
+        numpy.testing.assert_equal(actual, expected)
+        self.assertEqual(extent, [100., -30., 124., -10.])
+        os.remove(filename)
+
+    def test7_raster_native_dtype(self):
+        # The raster is kept as int16, with the no data values
+        data = numpy.array([[1, 2, -9999], [4, 5, 6]], dtype=numpy.int16)
+        raster = Raster(data, 0., 10., 1., -1., -9999, 3, 2)
+        self.assertEqual(raster.raster.dtype, numpy.int16)
+        self.assertTrue(raster.raster is data)
+        values = raster.raster_data_at_points(asarray([0.5, 2.5, 2.5]),
+                                              asarray([9.5, 9.5, 8.5]))
+        numpy.testing.assert_equal(values, [1., nan, 6.])
+
+        # A float32 file, where the no data value is not exact as float32
+        data = numpy.array([[0.5, -0.1], [2.5, 3.5]], dtype=numpy.float32)
+        filename = build_tiled_tif(data, 0., 2., 1., 16, no_data_value=-0.1)
+        raster = Raster.from_file(filename)
+        self.assertEqual(raster.raster.dtype, numpy.float32)
+        values = raster.raster_data_at_points(asarray([0.5, 1.5, 1.5]),
+                                              asarray([1.5, 1.5, 0.5]))
+        numpy.testing.assert_equal(values, [0.5, nan, 3.5])
+        os.remove(filename)
+
+    def test8_pixel_index_cache(self):
+        data = numpy.array([[1., 2., 3.], [4., 5., 6.]])
+        lon = asarray([0.5, 2.5, 2.5, 0.6, 5.])
+        lat = asarray([9.5, 9.5, 8.5, 9.6, 9.])
+        cache = PixelIndexCache()
+        grid = (0., 10., 1., -1., 3, 2)
+        indices = cache.indices(lon, lat, grid)
+        # Keep two entries the size of this one
+        cache.max_bytes = 2 * cache.nbytes
+        numpy.testing.assert_equal(indices.pixels, [0, 2, 5])
+        numpy.testing.assert_equal(indices.point_pixel, [0, 1, 2, 0])
+        numpy.testing.assert_equal(indices.inside,
+                                   [True, True, True, True, False])
+        self.assertFalse(indices.pixels.flags.writeable)
+
+        # The same grid and points are found in the cache
+        self.assertTrue(cache.indices(lon.copy(), lat, grid) is indices)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Moving the points or the grid is a different entry
+        lon[0] = 0.4
+        self.assertFalse(cache.indices(lon, lat, grid) is indices)
+        cache.indices(lon, lat, (0., 10., 1., -1., 3, 3))
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        self.assertEqual(len(cache.entries), 2)
+        self.assertTrue(cache.nbytes <= cache.max_bytes)
+
+        # An entry bigger than the limit is not kept
+        cache.max_bytes = 10
+        cache.indices(lon, lat, (0., 10., 1., -1., 4, 3))
+        self.assertEqual(len(cache.entries), 2)
+
+        # The pixels are found without holding the cache lock, so other
+        # grids can be found at the same time
+        locked = []
+
+        def calc_unique_pixels(*args):
+            locked.append(cache.lock.locked())
+            return calc(*args)
+        calc = raster_module._calc_unique_pixels
+        raster_module._calc_unique_pixels = calc_unique_pixels
+        try:
+            cache.indices(lon, lat, (0., 10., 1., -1., 5, 3))
+        finally:
+            raster_module._calc_unique_pixels = calc
+        self.assertEqual(locked, [False])
+
+        # Rasters on the same grid share the pixels
+        PIXEL_INDEX_CACHE.clear()
+        for pixel_cache in (None, 'memory', 'memory'):
+            raster = Raster.from_array(data * 2, 0., 10., 1., -9999)
+            values = raster.raster_data_at_points(lon, lat,
+                                                  pixel_cache=pixel_cache)
+            numpy.testing.assert_equal(values, [2., 6., 12., 2., nan])
+        self.assertEqual(len(PIXEL_INDEX_CACHE.entries), 1)
+        self.assertRaises(RuntimeError, raster.raster_data_at_points,
+                          lon, lat, pixel_cache='bad')
+
+        # The pixels can be kept on disk, between runs
+        cache_dir = tempfile.mkdtemp()
+        os.environ[CACHE_DIR_ENV] = cache_dir
+        cache.clear()
+        try:
+            disk = cache.indices(lon, lat, grid, on_disk=True)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cache.clear()
+            loaded = cache.indices(lon, lat, grid, on_disk=True)
+            self.assertFalse(loaded is disk)
+            for actual, expected in zip(loaded, disk):
+                numpy.testing.assert_equal(actual, expected)
+        finally:
+            del os.environ[CACHE_DIR_ENV]
+            shutil.rmtree(cache_dir)
+
+    def test9_multi_band(self):
+        data = numpy.arange(3 * 4 * 6, dtype=numpy.float32).reshape((3, 4, 6))
+        data[1, 0, 0] = -9999
+        filename = build_tiled_tif(data, 0., 4., 1., 2)
+        lon = asarray([0.5, 5.5, 2.5, 7.])
+        lat = asarray([3.5, 0.5, 2.5, 1.])
+        # shape (sites, bands)
+        expected = numpy.array([[0, nan, 48], [23, 47, 71],
+                                [8, 32, 56], [nan, nan, nan]])
+
+        raster = Raster.from_file(filename, bands='all')
+        self.assertEqual(raster.raster.shape, (3, 4, 6))
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected)
+        raster = Raster.from_file(filename, lon, lat, bands='all')
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected)
+        raster = BlockRaster.from_file(filename, bands='all')
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected)
+        raster = BlockRaster.from_file(filename, bands=[3, 1])
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected[:, [2, 0]])
+
+        # The first band, as before
+        actual, _ = files_raster_data_at_points(lon, lat, [filename])
+        numpy.testing.assert_equal(actual, expected[:, 0])
+        # A list of one band is still (sites, bands)
+        actual, _ = files_raster_data_at_points(lon, lat, [filename],
+                                                bands=[2], read_mode='full')
+        numpy.testing.assert_equal(actual, expected[:, 1:2])
+        # The bands of each file are hazards
+        actual, extent = files_raster_data_at_points(
+            lon, lat, [filename, filename], bands='all', workers=2)
+        numpy.testing.assert_equal(actual, numpy.hstack((expected,
+                                                         expected)))
+        self.assertEqual(extent, [0., 0., 6., 4.])
+
+        self.assertRaises(RuntimeError, Raster.from_file, filename,
+                          bands=[4])
+        self.assertRaises(RuntimeError, Raster.from_file, filename,
+                          bands='some')
+        os.remove(filename)
+
+        # The bands have different no data values
+        filename = build_tiled_tif(data, 0., 4., 1., 2,
+                                   no_data_value=[0., -9999, 71.])
+        raster = Raster.from_file(filename, bands='all')
+        expected[0, 0] = nan
+        expected[1, 2] = nan
+        numpy.testing.assert_equal(raster.raster_data_at_points(lon, lat),
+                                   expected)
+        os.remove(filename)
+
+    def test10_reduce_bands(self):
+        # 4 time steps of a 2 x 3 raster
+        data = numpy.array([[[1, 2, 3], [4, 5, 6]],
+                            [[3, 1, 3], [-9999, 5, 6]],
+                            [[2, 2, 9], [-9999, 5, 6]],
+                            [[0, 1, 3], [-9999, 5, 6]]], dtype=numpy.float32)
+        filename = build_tiled_tif(data, 0., 2., 1., 2)
+        lon = asarray([0.5, 2.5, 0.5, 1.5, 8.])
+        lat = asarray([1.5, 1.5, 0.5, 1.5, 1.])
+
+        expected = {'max': [3, 9, 4, 2, nan],
+                    'mean': [1.5, 4.5, 4, 1.5, nan],
+                    'sum': [12, 36, 8, 12, nan],
+                    'time_above': [2, 8, 2, 0, nan]}
+        for reduction, values in expected.items():
+            actual, extent = file_reduce_bands_at_points(
+                lon, lat, filename, reduction, threshold=2, time_step=2.)
+            numpy.testing.assert_equal(actual, values)
+            self.assertEqual(extent, (0., 0., 3., 2.))
+
+        # Only some of the bands
+        actual, _ = file_reduce_bands_at_points(lon, lat, filename, 'max',
+                                                bands=[1, 2])
+        numpy.testing.assert_equal(actual, [3, 3, 4, 2, nan])
+
+        # One hazard per file
+        actual, extent = files_raster_data_at_points(
+            lon, lat, [filename, filename], reduction='max', workers=2)
+        numpy.testing.assert_equal(actual, [[3, 3], [9, 9], [4, 4],
+                                            [2, 2], [nan, nan]])
+        actual, extent = files_raster_data_at_points(
+            lon, lat, [filename], reduction='mean')
+        numpy.testing.assert_equal(actual, expected['mean'])
+
+        self.assertRaises(RuntimeError, file_reduce_bands_at_points,
+                          lon, lat, filename, 'median')
+        self.assertRaises(RuntimeError, file_reduce_bands_at_points,
+                          lon, lat, filename, 'time_above')
+        os.remove(filename)
+
+    def test11_files_extent(self):
+        filenames = [build_tiled_tif(numpy.zeros((4, 6)), 0., 4., 1., 2),
+                     build_tiled_tif(numpy.zeros((4, 4)), 2., 6., 1., 2),
+                     build_tiled_tif(numpy.zeros((1, 1)), 8., 1., 1., 2)]
+        self.assertEqual(files_extent(filenames[:2]), [0., 0., 6., 6.])
+        self.assertEqual(files_extent(filenames[:2], 'intersection'),
+                         [2., 2., 6., 4.])
+        # Extents that don't overlap
+        min_long, min_lat, max_long, max_lat = files_extent(
+            filenames, 'intersection')
+        self.assertTrue(min_long > max_long or min_lat > max_lat)
+        self.assertRaises(RuntimeError, files_extent, filenames, 'some')
+        for filename in filenames:
+            os.remove(filename)
+
     def test3_recalc_max(self):
         max_extent = (0, 0, 0, 0)
         extent = [-10, -20, 20, 40]
@@ -34,9 +34,14 @@ Test the data in resources.  Can it be loaded?
 
 import unittest
 import os
+import glob
+
+from scipy import allclose
 
 from hazimp.misc import RESOURCE_DIR
-from hazimp.jobs.vulnerability_model import vuln_sets_from_xml_file
+from hazimp.xml_interface import XmlLayer
+from hazimp.jobs.vulnerability_model import (vuln_sets_from_xml_file,
+                                             vuln_sets_from_xml_node)
 
 
 class TestResources(unittest.TestCase):
@@ -57,6 +62,33 @@ class TestResources(unittest.TestCase):
         vul_funct = set_id.vulnerability_functions['FCM1_INSURED_NOACTION']
         self.assertAlmostEqual(vul_funct.mean_loss[0], 0.0)
 
+    def test_streaming_parse(self):
+        # The streaming parser must match the DOM parser
+        for filename in glob.glob(os.path.join(RESOURCE_DIR, '*.xml')):
+            vuln_sets = vuln_sets_from_xml_file(filename)
+            dom_sets = vuln_sets_from_xml_node(XmlLayer(filename=filename))
+            self.assertEqual(sorted(vuln_sets), sorted(dom_sets))
+            for set_id, dom_set in dom_sets.items():
+                vuln_set = vuln_sets[set_id]
+                for att in ['intensity_measure_type', 'asset_category',
+                            'loss_category', 'default_loss']:
+                    self.assertEqual(getattr(vuln_set, att),
+                                     getattr(dom_set, att))
+                self.assertTrue(allclose(vuln_set.intensity_measure_level,
+                                         dom_set.intensity_measure_level))
+                self.assertEqual(sorted(vuln_set.vulnerability_functions),
+                                 sorted(dom_set.vulnerability_functions))
+                for func_id, dom_func in \
+                        dom_set.vulnerability_functions.items():
+                    func = vuln_set.vulnerability_functions[func_id]
+                    self.assertTrue(allclose(func.mean_loss,
+                                             dom_func.mean_loss))
+                    self.assertTrue(allclose(
+                        func.coefficient_of_variation,
+                        dom_func.coefficient_of_variation))
+                    self.assertEqual(func.distribution,
+                                     dom_func.distribution)
+
 # -------------------------------------------------------------
 if __name__ == "__main__":
     Suite = unittest.makeSuite(TestResources, 'test')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014 Geoscience Australia
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=R0904
+# Disable too many public methods for test cases
+
+"""
+Test the spatial index module.
+"""
+
+import unittest
+
+import numpy
+
+from hazimp.spatial_index import GridIndex, points_in_polygon
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    """
+    Test the spatial index module
+    """
+
+    def setUp(self):
+        rng = numpy.random.RandomState(5)
+        self.lon = rng.uniform(110., 155., size=2000)
+        self.lat = rng.uniform(-45., -10., size=2000)
+        self.lon[:3] = [120., 130., numpy.nan]
+        self.lat[:3] = [-30., -20., -25.]
+
+    def brute_bbox(self, min_long, min_lat, max_long, max_lat):
+        inside = ((self.lon >= min_long) & (self.lon <= max_long) &
+                  (self.lat >= min_lat) & (self.lat <= max_lat))
+        return numpy.flatnonzero(inside)
+
+    def test_bbox(self):
+        index = GridIndex(self.lon, self.lat)
+        self.assertTrue(index.x_size * index.y_size > 1)
+        for box in [(120., -30., 130., -20.), (100., -50., 160., 0.),
+                    (111.3, -44., 111.9, -11.), (0., 0., 10., 10.),
+                    (130., -20., 120., -30.)]:
+            numpy.testing.assert_equal(index.bbox(*box),
+                                       self.brute_bbox(*box))
+        # Points on the edges are in the box
+        self.assertTrue(0 in index.bbox(120., -30., 125., -25.))
+        self.assertTrue(1 in index.bbox(125., -25., 130., -20.))
+
+    def test_polygon(self):
+        index = GridIndex(self.lon, self.lat)
+        # A square with a triangle cut out of the top
+        vertices = [(120., -40.), (140., -40.), (140., -20.), (130., -30.),
+                    (120., -20.)]
+        actual = index.polygon(vertices)
+        expected = self.brute_bbox(120., -40., 140., -20.)
+        cut_out = (self.lat[expected] - -30. >
+                   numpy.abs(self.lon[expected] - 130.))
+        numpy.testing.assert_equal(actual, expected[~cut_out])
+
+        inside = points_in_polygon(numpy.array([125., 130., 130., 150.]),
+                                   numpy.array([-35., -25., -35., -35.]),
+                                   numpy.array(vertices))
+        numpy.testing.assert_equal(inside, [True, False, True, False])
+
+    def test_take(self):
+        index = GridIndex(self.lon, self.lat)
+        indexes = index.bbox(115., -40., 150., -15.)[::3]
+        lon = self.lon[indexes]
+        lat = self.lat[indexes]
+        subset = index.take(indexes, lon, lat)
+        self.assertTrue(subset.lon is lon)
+        self.assertEqual(subset.order.size, indexes.size)
+        box = (120., -30., 130., -20.)
+        expected = numpy.flatnonzero((lon >= 120.) & (lon <= 130.) &
+                                     (lat >= -30.) & (lat <= -20.))
+        numpy.testing.assert_equal(subset.bbox(*box), expected)
+
+    def test_degenerate(self):
+        # One point, and points on a line
+        index = GridIndex(numpy.array([1.]), numpy.array([2.]))
+        numpy.testing.assert_equal(index.bbox(0., 0., 3., 3.), [0])
+        numpy.testing.assert_equal(index.bbox(2., 0., 3., 3.), [])
+        lon = numpy.arange(100.)
+        index = GridIndex(lon, numpy.zeros(100))
+        numpy.testing.assert_equal(index.bbox(10., -1., 20., 1.),
+                                   numpy.arange(10, 21))
+        index = GridIndex(numpy.array([]), numpy.array([]))
+        numpy.testing.assert_equal(index.bbox(0., 0., 3., 3.), [])
+
+
+# -------------------------------------------------------------
+if __name__ == "__main__":
+    SUITE = unittest.makeSuite(TestSpatialIndex, 'test')
+    RUNNER = unittest.TextTestRunner()
+    RUNNER.run(SUITE)
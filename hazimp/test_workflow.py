@@ -31,12 +31,14 @@ import unittest
 import tempfile
 import os
 
+import pandas
 from scipy import allclose, asarray
 
 from hazimp import workflow
 from hazimp import context
 from hazimp.calcs.calcs import CALCS
-from hazimp.jobs.jobs import JOBS, LOADCSVEXPOSURE, CONSTANT
+from hazimp.jobs.jobs import (JOBS, LOADCSVEXPOSURE, CONSTANT, SAVEALL,
+                              AGGREGATE_LOSS, PERMUTATE_EXPOSURE, LOADRASTER)
 from hazimp import parallel
 from hazimp import pipeline
 
@@ -115,6 +117,151 @@ class TestWorkFlow(unittest.TestCase):
         self.assertEqual(cont_in.exposure_att['d_test'], 35)
         self.assertEqual(cont_in.exposure_att['g_test'], 10)
 
+    def test_PipeLine_blocks(self):
+        f = tempfile.NamedTemporaryFile(mode='w+t',
+                                        suffix='.csv',
+                                        prefix='test_PipeLine_blocks',
+                                        delete=False)
+        f.write('LAT,LONG,a_test,b_test,SUBURB\n')
+        f.write('1.,2.,3.,30.,Dee\n')
+        f.write('4.,5.,6.,60.,Why\n')
+        f.write('7.,8.,1.,10.,Dee\n')
+        f.write('1.,2.,2.,20.,Zed\n')
+        f.write('4.,5.,8.,80.,Dee\n')
+        f.close()
+
+        results = []
+        for chunk_size in [None, 2]:
+            f2 = tempfile.NamedTemporaryFile(suffix='.csv',
+                                             prefix='test_PipeLine_blocks',
+                                             delete=False)
+            f2.close()
+            atts = {'file_name': f.name,
+                    context.EX_LAT: 'LAT',
+                    context.EX_LONG: 'LONG',
+                    'chunk_size': chunk_size}
+            caj1 = workflow.ConfigAwareJob(JOBS[LOADCSVEXPOSURE],
+                                           atts_to_add=atts)
+            atts = {'var': 'con_test', 'value': 30}
+            caj2 = workflow.ConfigAwareJob(JOBS[CONSTANT], atts_to_add=atts)
+            atts = {'groupby': 'SUBURB',
+                    'kwargs': {'c_test': ['sum', 'mean', 'std', 'max']}}
+            caj3 = workflow.ConfigAwareJob(JOBS[AGGREGATE_LOSS],
+                                           atts_to_add=atts)
+            atts = {'file_name': f2.name, 'use_parallel': False}
+            caj4 = workflow.ConfigAwareJob(JOBS[SAVEALL], atts_to_add=atts)
+
+            calc_list = [caj1, caj2, CALCS['add_test'], caj3, caj4]
+            cont_in = context.Context()
+            cont_in.set_prov_label('Test label')
+            the_pipeline = pipeline.PipeLine(calc_list)
+            the_pipeline.run(cont_in)
+            results.append((pandas.read_csv(f2.name), cont_in.exposure_agg))
+            os.remove(f2.name)
+
+        (whole, whole_agg), (blocks, blocks_agg) = results
+        self.assertEqual(list(whole.columns), list(blocks.columns))
+        self.assertTrue(allclose(blocks['c_test'], [33., 66., 11., 22., 88.]))
+        self.assertTrue(allclose(whole['c_test'], blocks['c_test']))
+        self.assertTrue(allclose(blocks['con_test'], 30))
+        self.assertEqual(list(whole_agg.columns), list(blocks_agg.columns))
+        self.assertEqual(blocks_agg['SUBURB_'].tolist(), ['Dee', 'Why', 'Zed'])
+        for column in ['c_test_sum', 'c_test_mean', 'c_test_std',
+                       'c_test_max']:
+            self.assertTrue(allclose(whole_agg[column], blocks_agg[column],
+                                     equal_nan=True))
+        os.remove(f.name)
+
+    def test_PipeLine_blocks_outside_hazard(self):
+        f = tempfile.NamedTemporaryFile(mode='w+t',
+                                        suffix='.csv',
+                                        prefix='test_PipeLine_blocks',
+                                        delete=False)
+        f.write('LAT,LONG,ID\n')
+        f.write('7.9,1.5,1\n')  # Out of the hazard area
+        f.write('8.9,3.1,2\n')  # Out of the hazard area
+        f.write('8.1,0.1,3\n')
+        f.write('8.9,2.9,4\n')
+        f.close()
+        f_haz = tempfile.NamedTemporaryFile(mode='w+t',
+                                            suffix='.aai',
+                                            prefix='test_PipeLine_blocks',
+                                            delete=False)
+        f_haz.write('ncols 3\n')
+        f_haz.write('nrows 2\n')
+        f_haz.write('xllcorner +0.\n')
+        f_haz.write('yllcorner +8.\n')
+        f_haz.write('cellsize 1\n')
+        f_haz.write('NODATA_value -9999\n')
+        f_haz.write('1 2 -9999\n')
+        f_haz.write('4 5 6\n')
+        f_haz.close()
+        f2 = tempfile.NamedTemporaryFile(suffix='.csv',
+                                         prefix='test_PipeLine_blocks',
+                                         delete=False)
+        f2.close()
+
+        def run(exposure_file):
+            atts = {'file_name': exposure_file,
+                    context.EX_LAT: 'LAT',
+                    context.EX_LONG: 'LONG',
+                    'chunk_size': 2}
+            caj1 = workflow.ConfigAwareJob(JOBS[LOADCSVEXPOSURE],
+                                           atts_to_add=atts)
+            atts = {'file_list': [f_haz.name], 'attribute_label': 'haz',
+                    'clip_exposure2all_hazards': True}
+            caj2 = workflow.ConfigAwareJob(JOBS[LOADRASTER],
+                                           atts_to_add=atts)
+            atts = {'file_name': f2.name, 'use_parallel': False}
+            caj3 = workflow.ConfigAwareJob(JOBS[SAVEALL], atts_to_add=atts)
+            cont_in = context.Context()
+            cont_in.set_prov_label('Test label')
+            pipeline.PipeLine([caj1, caj2, caj3]).run(cont_in)
+            return cont_in
+
+        # The first block has no sites in the hazard area
+        cont_in = run(f.name)
+        saved = pandas.read_csv(f2.name)
+        self.assertEqual(saved['ID'].tolist(), [3, 4])
+        self.assertTrue(allclose(saved['haz'], [4., 6.]))
+        # The hazard file provenance is added once
+        hazards = [record for record in cont_in.prov.get_records()
+                   if str(record.identifier) == 'Hazard data']
+        self.assertEqual(len(hazards), 1)
+
+        # No block has sites in the hazard area
+        with open(f.name, 'w') as hnd:
+            hnd.write('LAT,LONG,ID\n')
+            hnd.write('7.9,1.5,1\n')
+            hnd.write('8.9,3.1,2\n')
+            hnd.write('7.9,2.5,3\n')
+        self.assertRaises(RuntimeError, run, f.name)
+        os.remove(f.name)
+        os.remove(f_haz.name)
+        os.remove(f2.name)
+
+    def test_PipeLine_blocks_bad_job(self):
+        f = tempfile.NamedTemporaryFile(mode='w+t',
+                                        suffix='.csv',
+                                        prefix='test_PipeLine_blocks',
+                                        delete=False)
+        f.write('LAT,LONG,a_test\n')
+        f.write('1.,2.,3.\n')
+        f.close()
+        atts = {'file_name': f.name,
+                context.EX_LAT: 'LAT',
+                context.EX_LONG: 'LONG',
+                'chunk_size': 2}
+        caj1 = workflow.ConfigAwareJob(JOBS[LOADCSVEXPOSURE],
+                                       atts_to_add=atts)
+        # Permutating the exposure needs all of the sites
+        calc_list = [caj1, JOBS[PERMUTATE_EXPOSURE]]
+        cont_in = context.Context()
+        cont_in.set_prov_label('Test label')
+        the_pipeline = pipeline.PipeLine(calc_list)
+        self.assertRaises(RuntimeError, the_pipeline.run, cont_in)
+        os.remove(f.name)
+
 # -------------------------------------------------------------
 if __name__ == "__main__":
     Suite = unittest.makeSuite(TestWorkFlow, 'test')
@@ -2,7 +2,9 @@ import setuptools
 setuptools.setup(name='hazimp',
                  version='0.3',
                  packages=setuptools.find_packages(),
-                 entry_points = dict(console_scripts=['hazimp=hazimp.main:cli']),
+                 entry_points = dict(console_scripts=[
+                     'hazimp=hazimp.main:cli',
+                     'hazimp-cache=hazimp.cache:cli']),
                  
                  # metadata:
                  author = "Craig Arthur",